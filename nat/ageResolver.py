@@ -5,9 +5,11 @@ Created on Mon Aug 14 12:28:29 2017
 @author: oreilly
 """
 
+import numpy as np
+import pandas as pd
 from quantities import Quantity
 #from ontoManager import OntoManager
-from .treeData import getChildren
+from .treeData import getDescendantIds, getOntologyVersion
 
 
     
@@ -25,39 +27,25 @@ class AgeResolver:
         
     #ontoMng = OntoManager(recomputer=True)
 
-    
-    @staticmethod
-    def resolve_fromIDs(speciesId, ageCategoryId, unit=None, typeValue=""):
-        
-        def resolve_age(ageCatDict, ageCategoryId):  
-            for ageCategoryId2 in ageCatDict:
-                #ontoMng.
-                if ageCategoryId2 == ageCategoryId:
-                    return ageCatDict[ageCategoryId]
-                    
-            return None
-
-        def resolve_species_age(speciesId, ageCategoryId):
-            for speciesId2 in AgeResolver.ageEquivalence:
-                #ontoMng.
-                if speciesId2 == speciesId:
-                    return resolve_age(AgeResolver.ageEquivalence[speciesId2], ageCategoryId)
-                    
-                if speciesId in getChildren(speciesId2):
-                    return resolve_age(AgeResolver.ageEquivalence[speciesId2], ageCategoryId)
-    
-            return None    
+    # Resolution tables and resolved ages, built once per (ontology version,
+    # unit, typeValue). See resolutionTable().
+    __resolutionTables = {}
 
-        age = resolve_species_age(speciesId, ageCategoryId)
-        if age is None:
-            return None
-        
+
+    @staticmethod
+    def selectAge(ageBounds, unit=None, typeValue=""):
+        """
+        Return the age selected by typeValue ("min", "max", "median", or
+        the list of bounds otherwise) from the age bounds, rescaled to unit. 
+        """
         if typeValue == "min":
-            age = age[0]
+            age = ageBounds[0]
         elif typeValue == "max":
-            age = age[1]
+            age = ageBounds[1]
         elif typeValue == "median":
-            age = (age[1]+age[0])/2.0
+            age = (ageBounds[1]+ageBounds[0])/2.0
+        else:
+            age = ageBounds
     
         if not unit is None:
             if isinstance(age, list):
@@ -67,6 +55,90 @@ class AgeResolver:
         return age
 
 
+    @staticmethod
+    def resolutionTable(unit=None, typeValue=""):
+        """
+        Return a DataFrame mapping every (SpeciesId, AgeCategoryId) pair that
+        can be resolved to its age ("age", as returned by resolve_fromIDs()) 
+        and, when typeValue selects a single value, its magnitude ("ageValue").
+        Species include all the descendants of the species of ageEquivalence.
+        The table is built once per unit and typeValue, and again when the
+        ontology files change.
+        """
+        return AgeResolver.__resolution(unit, typeValue)[0]
+
+
+    @staticmethod
+    def __resolution(unit, typeValue):
+        # The descendants of the species depend on the ontology files.
+        ontologyVersion = getOntologyVersion()
+        key = (ontologyVersion, unit, typeValue)
+        if not key in AgeResolver.__resolutionTables:
+
+            # The tables of the previous versions of the ontologies are dropped.
+            for oldKey in [oldKey for oldKey in AgeResolver.__resolutionTables 
+                                  if oldKey[0] != ontologyVersion]:
+                del AgeResolver.__resolutionTables[oldKey]
+
+            # A species is resolved with the first entry of ageEquivalence 
+            # that is either this species or one of its ancestors.
+            speciesRoots = {}
+            for speciesId2 in AgeResolver.ageEquivalence:
+                speciesRoots.setdefault(speciesId2, speciesId2)
+                for childId in getDescendantIds(speciesId2):
+                    speciesRoots.setdefault(childId, speciesId2)
+
+            resolvedAges = {}
+            for speciesId, speciesId2 in speciesRoots.items():
+                for ageCategoryId, ageBounds in AgeResolver.ageEquivalence[speciesId2].items():
+                    resolvedAges[(speciesId, ageCategoryId)] = AgeResolver.selectAge(ageBounds, unit, typeValue)
+
+            ages = list(resolvedAges.values())
+            table = pd.DataFrame({"SpeciesId"    : [speciesId for speciesId, _ in resolvedAges],
+                                  "AgeCategoryId": [ageCategoryId for _, ageCategoryId in resolvedAges],
+                                  "age"          : pd.Series(ages, dtype=object)})
+            if not typeValue in ["min", "max", "median"]:
+                table["ageValue"] = np.nan
+            else:
+                table["ageValue"] = np.array([float(age.magnitude) for age in ages], dtype=float)
+
+            AgeResolver.__resolutionTables[key] = (table, resolvedAges)
+
+        return AgeResolver.__resolutionTables[key]
+
+
+    @staticmethod
+    def clearResolutionTables():
+        """
+        Clear the resolution tables. Must be called if ageEquivalence is modified.
+        """
+        AgeResolver.__resolutionTables.clear()
+
+
+    @staticmethod
+    def resolve(speciesIds, ageCategoryIds, unit=None, typeValue="", column="age"):
+        """
+        Vectorized version of resolve_fromIDs(): return as an array the 
+        resolved ages (or the values of another column of the resolution 
+        table) for the sequences of species and age category IDs. Pairs that
+        cannot be resolved are attributed None.
+        """
+        table = AgeResolver.resolutionTable(unit, typeValue)
+        query = pd.DataFrame({"SpeciesId": pd.Series(speciesIds, dtype=object), 
+                              "AgeCategoryId": pd.Series(ageCategoryIds, dtype=object)})
+        resolved = query.merge(table.astype({"SpeciesId": object, "AgeCategoryId": object}), 
+                               how="left", on=["SpeciesId", "AgeCategoryId"])[column]
+        resolved = resolved.values.astype(object)
+        resolved[pd.isnull(resolved)] = None
+        return resolved
+
+
+    @staticmethod
+    def resolve_fromIDs(speciesId, ageCategoryId, unit=None, typeValue=""):
+        resolvedAges = AgeResolver.__resolution(unit, typeValue)[1]
+        return resolvedAges.get((speciesId, ageCategoryId))
+
+
     #def resolve_fromLabels(species, ageCategory)    
 
     
@@ -6,33 +6,202 @@ Created on Mon Aug 29
 """
 
 import numpy as np
+import pandas as pd
 from .modelingParameter import getParameterTypeNameFromID
 
 
+# Aggregation methods implemented in this module, in addition to the 
+# methods accepted by pandas.DataFrame.aggregate() (e.g., "mean", "median").
+#   - "inverse_variance_mean": mean of the samples weighted by the inverse 
+#     of their squared standard error, i.e., the fixed-effect pooled estimate.
+#   - "n_weighted_mean": mean of the samples weighted by their size N.
+#   - "bootstrap": mean (or N-weighted mean) with a percentile bootstrap 
+#     confidence interval.
+pooledMethods = ["inverse_variance_mean", "n_weighted_mean", "bootstrap"]
+
+# Factors converting the width of a confidence interval to a standard error.
+ciWidthToSEM = {"CI_95_width": 2*1.959964, "CI_98_width": 2*2.326348}
+
+
+
 class AggregatedIndex:
     
-    def __init__(self, index, value, ids):
+    def __init__(self, index, value, ids, stats=None):
         self.index = index
         self.value = value
         self.ids   = ids
+        # Supplementary statistics of the estimate (e.g., "sem", "ci_low"). 
+        self.stats = {} if stats is None else stats
         
     def toJSON(self):
         json = {"index":self.index,
                 "value":self.value,
                 "ids"  :self.ids}        
+        if self.stats:
+            json["stats"] = self.stats
         return json
 
         
     @staticmethod
     def fromJSON(jsonParams):
-        return AggregatedIndex(jsonParams["index"], jsonParams["value"],  jsonParams["ids"])
+        # JSON turns the tuples (e.g., the multi-factor indexes and the index 
+        # () of the whole sample) into lists, which cannot be used as keys.
+        index = jsonParams["index"]
+        if isinstance(index, list):
+            index = tuple(index)
+        return AggregatedIndex(index, jsonParams["value"], tuple(jsonParams["ids"]), 
+                               jsonParams.get("stats"))
+
+
+
+def sampleDispersion(param):
+    """
+    Return the size (N) and the standard error of the mean reported for a
+    parameter holding a single (possibly compound) value. The standard error
+    is derived from the available deviation statistic, and is NaN if it 
+    cannot be determined (e.g., values reported as mean and N only).
+    """
+    values = param.description.depVar.values
+    if len(values) != 1:
+        return np.nan, np.nan
+
+    N = float(np.asarray(values.size("within"), dtype=float).ravel()[0])
+    deviation = values.deviation("within", returnStat=True)
+    if deviation is None:
+        return N, np.nan
+    deviation, stat = deviation
+    deviation = float(np.asarray(deviation, dtype=float).ravel()[0])
+
+    if stat == "sem":
+        sem = deviation
+    elif stat == "sd":
+        sem = deviation/np.sqrt(N)
+    elif stat == "var":
+        sem = np.sqrt(deviation/N)
+    elif stat in ciWidthToSEM:
+        sem = deviation/ciWidthToSEM[stat]
+    else:
+        sem = np.nan
+
+    # A null deviation carries no information on the precision of the sample.
+    if not sem > 0:
+        sem = np.nan
+    return N, sem
+
+
+
+def inverseVarianceMean(values, sems):
+    """
+    Return the inverse-variance weighted mean of the values, its standard
+    error, and the boolean mask of the values used. Values without a valid
+    standard error are ignored.
+    """
+    isUsable = np.isfinite(sems)
+    if not isUsable.any():
+        return np.nan, np.nan, isUsable
+    weights = 1.0/sems[isUsable]**2
+    return (np.sum(weights*values[isUsable])/np.sum(weights), np.sqrt(1.0/np.sum(weights)), 
+            isUsable)
+
+
+
+def nWeightedMean(values, N):
+    """
+    Return the mean of the values weighted by the sample sizes N. Samples
+    with an unknown size are given a weight of 1.
+    """
+    weights = np.where(np.isfinite(N) & (N > 0), N, 1.0)
+    return np.sum(weights*values)/np.sum(weights)
+
+
+
+def bootstrapMean(values, N=None, nbResamples=10000, confidenceLevel=0.95, rng=None, 
+                  maxMatrixSize=10**7):
+    """
+    Return the mean (N-weighted if N is given) of the values with the bounds 
+    of its percentile bootstrap confidence interval. The resamples are drawn
+    as one matrix of indices (split in blocks of at most maxMatrixSize 
+    elements to bound memory use) and their means computed in one operation.
+    """
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    nbValues = len(values)
+    if N is None:
+        weights = np.ones(nbValues)
+    else:
+        weights = np.where(np.isfinite(N) & (N > 0), N, 1.0)
+    estimate = np.sum(weights*values)/np.sum(weights)
+
+    blockSize = max(1, maxMatrixSize//max(1, nbValues))
+    means = []
+    for start in range(0, nbResamples, blockSize):
+        indices = rng.integers(0, nbValues, size=(min(blockSize, nbResamples-start), nbValues))
+        resampledWeights = weights[indices]
+        means.append(np.sum(values[indices]*resampledWeights, axis=1)/np.sum(resampledWeights, axis=1))
+    means = np.concatenate(means)
+
+    alpha = (1.0 - confidenceLevel)/2.0
+    ciLow, ciHigh = np.percentile(means, [100*alpha, 100*(1-alpha)])
+    return estimate, ciLow, ciHigh
         
         
 
+def prepareAggregationData(sample, groupingFactors=(), withDispersion=False):
+    """
+    Return, for the valid rows of the sample, a DataFrame with the columns 
+    used by the aggregators: the parameter name, the values coerced to 
+    floats, the parameter instance ID, and the grouping factors. Rows whose
+    values cannot be converted to floats are dropped. If withDispersion is
+    True, the sample size ("N") and standard error ("sem") of each row are 
+    also included (see sampleDispersion()).
+    """
+    df = sample.validSample
+    params  = df["obj_parameter"].values
+    typeIds = [param.typeId for param in params]
+
+    # Parameter names are resolved once per parameter type.
+    paramNames = {typeId: getParameterTypeNameFromID(typeId) for typeId in set(typeIds)}
+
+    data = pd.DataFrame({"paramName": [paramNames[typeId] for typeId in typeIds],
+                         "Values"   : pd.to_numeric(df["Values"], errors="coerce").values,
+                         "paramId"  : [param.id for param in params]},
+                        index=df.index)
+    for factor in groupingFactors:
+        data[factor] = df[factor].values
+
+    if withDispersion:
+        dispersion = np.array([sampleDispersion(param) for param in params], dtype=float).reshape(-1, 2)
+        data["N"]   = dispersion[:, 0]
+        data["sem"] = dispersion[:, 1]
+
+    return data[data["Values"].notnull()]
+
+
+
+def aggregateSample(sample, aggregators):
+    """
+    Run all the aggregators on the sample in a single pass: the data shared
+    by the aggregators is prepared once and split by parameter name, then 
+    each aggregator only processes the rows of its parameter.
+    """
+    groupingFactors = []
+    for aggregator in aggregators:
+        groupingFactors.extend([factor for factor in aggregator.groupingFactors 
+                                if not factor in groupingFactors])
+
+    withDispersion = any([aggregator.method in pooledMethods for aggregator in aggregators])
+    data = prepareAggregationData(sample, groupingFactors, withDispersion)
+    dataByParam = {paramName: paramData for paramName, paramData in data.groupby("paramName", sort=False)}
+    for aggregator in aggregators:
+        aggregator.aggregateData(dataByParam.get(aggregator.paramName, data.iloc[:0]))
+
+
+
 class SampleAggregator:
     
     def __init__(self, paramId=None, paramName=None, groupingFactors=None, 
-                 method="mean", categoryGrouping=None):
+                 method="mean", categoryGrouping=None, methodOptions=None):
         if not paramName is None:
             if not paramId is None:
                 if getParameterTypeNameFromID(paramId) != paramName:
@@ -45,12 +214,21 @@ class SampleAggregator:
             paramName = getParameterTypeNameFromID(paramId)        
         
         self.paramName          = paramName
-        if categoryGrouping is None:
+        if groupingFactors is None:
             self.groupingFactors = []
         else:
             self.groupingFactors    = groupingFactors
         self.method             = method
-        self.categoryGrouping   = categoryGrouping
+        # Options of the pooled methods. For "bootstrap": "nbResamples", 
+        # "confidenceLevel", "seed" and "weighted" (N-weighted mean if True).
+        if methodOptions is None:
+            self.methodOptions = {}
+        else:
+            self.methodOptions = methodOptions
+        if categoryGrouping is None:
+            self.categoryGrouping = []
+        else:
+            self.categoryGrouping   = categoryGrouping
         #self.usedParamInstances = []
         self.aggreatedLst       = []
     
@@ -58,6 +236,7 @@ class SampleAggregator:
         return "SampleAggregator(paramName=" + self.paramName + \
                ", groupingFactors=" + str(self.groupingFactors) + \
                ", method=" + str(self.method) + \
+               ", methodOptions=" + str(self.methodOptions) + \
                ", categoryGrouping=" + str(self.categoryGrouping) + ")"
 
     def values(self, sample=None):
@@ -65,59 +244,132 @@ class SampleAggregator:
             self.aggregate(sample)
             
         return {aggIndex.index:aggIndex.value for aggIndex in self.aggreatedLst}
+
+
+    def stats(self, sample=None):
+        """
+        Return the supplementary statistics of the aggregated values (e.g., 
+        bootstrap confidence intervals) for the pooled methods.
+        """
+        if not sample is None:
+            self.aggregate(sample)
+            
+        return {aggIndex.index:aggIndex.stats for aggIndex in self.aggreatedLst}
         
         
         
     def aggregate(self, sample):
+        aggregateSample(sample, [self])
 
-        indices = []
-        for index, row in sample.sampleDF.iterrows():
-            if not row["isValid"]:
-                continue
-            
-            if self.paramName != getParameterTypeNameFromID(row["obj_parameter"].typeId):
-                print("Not the right parameter.")
-                continue
-        
-            try:
-                float(row["Values"]) 
-                indices.append(index)
-            except:          
-                statusStr = "Cannot be converted to a float value implicitly.\n"
-                row["isValid"]   = False
-                row["statusStr"] += statusStr                
-       
-        #self.usedParamInstances = [param.id for param in sample.sampleDF.loc[indices, "obj_parameter"]]
-
-        data = sample.sampleDF.iloc[indices].copy()
-        
+
+    def categoryMapping(self):
+        """
+        Return the category grouping as a mapping table with, for each 
+        combination of grouping factor values to replace, the values
+        replacing them (columns suffixed with '_target').
+        """
+        sources = []
+        targets = []
         for catGroup in self.categoryGrouping:
             for valuesToReplace in catGroup[1:]:
-                condition = np.ones(data.shape[0])
-                for key, value in zip(self.groupingFactors, valuesToReplace):                  
-                    condition *= data[key] == value
-                for key, value in zip(self.groupingFactors, catGroup[0]):   
-                    data.loc[condition.astype(bool), key] = value
-        
-        values = data["Values"].astype(float).values
-        data.loc[:, "Values"]  = values
-        data.loc[:, "paramId"] = [param.id for param in sample.sampleDF.loc[indices, "obj_parameter"]]
-
-        fields = ["Values", "paramId"]
-        fields.extend(self.groupingFactors)
-        values = data[fields].groupby(self.groupingFactors).aggregate({"Values":self.method, 
-                                                                "paramId":lambda ids: tuple([id for id in ids])})
-        
-        self.aggreatedLst = [AggregatedIndex(index, row["Values"], row["paramId"]) 
+                sources.append(list(valuesToReplace))
+                targets.append(list(catGroup[0]))
+
+        targetFactors = [factor + "_target" for factor in self.groupingFactors]
+        mapping = pd.DataFrame(sources, columns=self.groupingFactors)
+        mapping[targetFactors] = pd.DataFrame(targets, columns=targetFactors)
+
+        # A combination replaced by more than one group is attributed to the first one.
+        return mapping.drop_duplicates(subset=self.groupingFactors)
+
+
+    def regroupCategories(self, data):
+        """
+        Replace the values of the grouping factors according to 
+        categoryGrouping, through a join with the mapping table.
+        """
+        if not self.categoryGrouping:
+            return data
+
+        mapping = self.categoryMapping()
+        merged  = data.merge(mapping, how="left", on=self.groupingFactors, indicator=True)
+        matched = (merged["_merge"] == "both").values
+
+        data = data.copy()
+        for factor in self.groupingFactors:
+            values = data[factor].values.astype(object)
+            values[matched] = merged[factor + "_target"].values[matched]
+            data[factor] = values
+        return data
+
+
+    def aggregateData(self, data):
+        """
+        Aggregate the rows of the data prepared by prepareAggregationData()
+        for the parameter of this aggregator.
+        """
+        data = self.regroupCategories(data)
+
+        if len(self.groupingFactors):
+            groups = data.groupby(self.groupingFactors)
+        else:
+            groups = data.groupby(np.zeros(len(data), dtype=int))
+
+        if self.method in pooledMethods:
+            self.aggreatedLst = self.aggregatePooled(data, groups)
+            return
+
+        values = groups.aggregate({"Values" :self.method, 
+                                   "paramId":lambda ids: tuple([id for id in ids])})
+
+        # Without grouping factors, the whole sample is aggregated under the index ().
+        self.aggreatedLst = [AggregatedIndex(index if len(self.groupingFactors) else (), 
+                                             row["Values"], row["paramId"]) 
                                       for index, row in values.iterrows()]
 
+
+    def aggregatePooled(self, data, groups):
+        values  = data["Values"].values.astype(float)
+        N       = data["N"].values
+        sems    = data["sem"].values
+        ids     = data["paramId"].values
+
+        # A single generator, consumed in the order of the groups, makes the 
+        # bootstrap reproducible for a given seed.
+        rng = np.random.default_rng(self.methodOptions.get("seed", 0))
+
+        aggreatedLst = []
+        for index, rows in groups.indices.items():
+            stats = {}
+            if self.method == "inverse_variance_mean":
+                value, stats["sem"], isUsable = inverseVarianceMean(values[rows], sems[rows])
+                # Only the samples with a standard error contribute.
+                rows = rows[isUsable]
+            elif self.method == "n_weighted_mean":
+                value = nWeightedMean(values[rows], N[rows])
+                stats["N"] = float(np.nansum(N[rows]))
+            else:
+                nbResamples     = self.methodOptions.get("nbResamples", 10000)
+                confidenceLevel = self.methodOptions.get("confidenceLevel", 0.95)
+                weighted        = self.methodOptions.get("weighted", False)
+                value, stats["ci_low"], stats["ci_high"] = \
+                    bootstrapMean(values[rows], N[rows] if weighted else None, 
+                                  nbResamples, confidenceLevel, rng)
+                stats["confidenceLevel"] = confidenceLevel
+
+            stats = {key: float(stat) for key, stat in stats.items()}
+            aggreatedLst.append(AggregatedIndex(index if len(self.groupingFactors) else (), 
+                                                float(value), tuple(ids[rows]), stats))
+        return aggreatedLst
+
         
     @staticmethod
     def fromJSON(jsonParams):
         obj = SampleAggregator(paramName=jsonParams["paramName"], 
                                groupingFactors=jsonParams["groupingFactors"], 
                                method=jsonParams["method"],
-                               categoryGrouping=jsonParams["categoryGrouping"] )
+                               categoryGrouping=jsonParams["categoryGrouping"],
+                               methodOptions=jsonParams.get("methodOptions"))
         obj.aggreatedLst = [AggregatedIndex.fromJSON(aggJSON) for aggJSON in jsonParams["aggreatedLst"]]
         return obj
 
@@ -128,7 +380,7 @@ class SampleAggregator:
                 "groupingFactors": self.groupingFactors,
                 "method": self.method,
                 "categoryGrouping": self.categoryGrouping,
+                "methodOptions": self.methodOptions,
                 "aggreatedLst":[aggIndex.toJSON() for aggIndex in self.aggreatedLst]}
 
         return json
-
@@ -5,17 +5,32 @@ Created on Fri Jun  3 16:48:25 2016
 @author: oreilly
 """
 
+import os
 import re
-import numpy as np
-from difflib import SequenceMatcher
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join, isfile
+from threading import Lock
+
 from nat.restClient import RESTClient
+from nat.textIndex import TextIndex
+from nat import contextCache
+from nat import utils
 
 class AnnotTextLocalizer:
+    """
+     Find the locations of annotated strings in the texts of the papers. The
+     n-gram indexes (see TextIndex) of the last indexCacheSize papers are 
+     kept in memory.
+    """
     
-    def __init__(self, dbPath, contextLength=50, restServerURL=None):
-        self.dbPath        = dbPath
-        self.contextLength = contextLength
+    def __init__(self, dbPath, contextLength=50, restServerURL=None, indexCacheSize=32):
+        self.dbPath         = dbPath
+        self.contextLength  = contextLength
+        self.indexCacheSize = indexCacheSize
+        self.__indexes      = OrderedDict()  # paperId -> (signature, TextIndex)
+        self.__indexesLock  = Lock()
         if not restServerURL is None:
             self.restClient = RESTClient(restServerURL)
         else:
@@ -29,132 +44,184 @@ class AnnotTextLocalizer:
         
     def localizeTextAnnot(self, paperId, textToAnnotate):
 
-        if self.fullTextAvailable(paperId):
+        if self.fullTextLocallyAvailable(paperId):
             return self.localTextLocalization(paperId, textToAnnotate)
         else:
             return self.remoteTextLocalization(paperId, textToAnnotate)
         
             
     def remoteTextLocalization(self, paperId, textToAnnotate):
+        """
+         Localize the text in the paper text fetched from the server (or from 
+         the cache of contextCache). Return None if the text is not available.
+        """
+        index = self.getRemoteIndex(paperId)
+        if index is None:
+            return None
+        return index.search(textToAnnotate, self.contextLength)
+
+
+    def getRemoteIndex(self, paperId):
+        """
+         Return the TextIndex of the text of the paper on the server, built 
+         again if the version of the text changed, or None if the text is not
+         available.
+        """
         if self.restClient is None:
             return None
-            
-        return self.restClient.localizeAnnotation(paperId, textToAnnotate)
+
+        text, version = contextCache.fetchText(self.restClient, paperId, contextCache.getDefaultCache())
+        if text is None:
+            return None
+        return self.__getIndex(("remote", paperId), version, lambda: text)
             
 
-    
-    def localTextLocalization(self, paperId, textToAnnotate):
-        
-        def recursiveSearch(queryString, text, a=0, level=0, maxLevel=5):
-
-            starts = [(a, m.start(), len(queryString)) for m in re.finditer(re.escape(queryString), text)]
-            if len(starts) == 0:
-                if level < maxLevel and len(queryString) > 4:
-                    N = len(queryString)
-                    starts = []
-                    starts.extend(recursiveSearch(queryString[:int(N/2)], text, a,             level+1, maxLevel))
-                    starts.extend(recursiveSearch(queryString[int(N/2):], text, a+int(N/2), level+1, maxLevel))
-                    return starts
-                else:
-                    return starts
-            else:
-                return starts
-
-        def processBlocks(blocks, textToAnnotate, fileText, contextLength):
-            for block in blocks:
-                matcher = SequenceMatcher(None, textToAnnotate, fileText[block["start"]:block["end"]])
-                ratio = matcher.ratio()
-
-                matcher.set_seq2(fileText[block["start"]-1:block["end"]])
-                new_ratio = matcher.ratio()
-                while new_ratio >= ratio and block["start"] > 0: 
-                    block["start"] -= 1
-                    ratio = new_ratio
-                    matcher.set_seq2(fileText[block["start"]-1:block["end"]])
-                    new_ratio = matcher.ratio()
-
-                matcher.set_seq2(fileText[block["start"]+1:block["end"]])
-                new_ratio = matcher.ratio()
-                while new_ratio >= ratio and block["start"] < len(fileText)-1: 
-                    block["start"] += 1
-                    ratio = new_ratio
-                    matcher.set_seq2(fileText[block["start"]+1:block["end"]])
-                    new_ratio = matcher.ratio()
-
-                matcher.set_seq2(fileText[block["start"]:block["end"]-1])
-                new_ratio = matcher.ratio()
-                while new_ratio >= ratio and block["end"] > 0: 
-                    block["end"] -= 1
-                    ratio = new_ratio
-                    matcher.set_seq2(fileText[block["start"]:block["end"]-1])
-                    new_ratio = matcher.ratio()
-
-                matcher.set_seq2(fileText[block["start"]:block["end"]+1])
-                new_ratio = matcher.ratio()
-                while new_ratio >= ratio and block["end"] < len(fileText)-1: 
-                    block["end"] += 1
-                    ratio = new_ratio
-                    matcher.set_seq2(fileText[block["start"]:block["end"]+1])
-                    new_ratio = matcher.ratio()
-
-
-                block["contextBefore"]    = fileText[max(0, block["start"]-contextLength):block["start"]]
-                block["candidate"]        = fileText[block["start"]:block["end"]]
-                block["contextAfter"]     = fileText[block["end"]:min(len(fileText), block["end"]+contextLength)]
-                block["ratio"]            = ratio
-                block["candidate"]        = block["candidate"].replace("\n", " ")        
-
-            return np.array([block for block in blocks if block["ratio"] > 0.5])
+    def __getIndex(self, key, signature, readText):
+        with self.__indexesLock:
+            if key in self.__indexes and self.__indexes[key][0] == signature:
+                self.__indexes.move_to_end(key)
+                return self.__indexes[key][1]
+
+        index = TextIndex(readText())
+        with self.__indexesLock:
+            self.__indexes[key] = (signature, index)
+            self.__indexes.move_to_end(key)
+            while len(self.__indexes) > self.indexCacheSize:
+                self.__indexes.popitem(last=False)
+        return index
+
+
+    def getIndex(self, paperId):
+        """
+         Return the TextIndex of the local text of the paper, built again 
+         if the text file changed.
+        """
+        txtFileName = join(self.dbPath, paperId) + ".txt"
+        fileStat    = os.stat(txtFileName)
 
+        def readText():
+            with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
+                return f.read()
 
+        return self.__getIndex(paperId, (fileStat.st_mtime_ns, fileStat.st_size), readText)
 
-        txtFileName = join(self.dbPath, paperId) + ".txt"
-        with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
-            fileText = f.read()
-
-        ## We try to find an exact match...
-        starts = [m.start() for m in re.finditer(re.escape(textToAnnotate), fileText)]
-
-        ## If no exact match was found...        
-        if len(starts) == 0:
-
-            N = len(textToAnnotate)
-
-            ## We try to find partial matches using a recursive algorithm that sequentially
-            ## splits the query string and try to find these subsetrings
-            blocks = []
-            for a, b, size in recursiveSearch(textToAnnotate, fileText):
-                start = max(0, b-a)
-                blocks.append({"start":start,
-                               "end"  :min(start+N, len(fileText))})
-            blocks = processBlocks(blocks, textToAnnotate, fileText, self.contextLength)
-
-            u, indices = np.unique([str(block["start"]) + "-" + str(block["end"]) for block in blocks], return_index=True)
-            blocks = blocks[indices]
-            blocks = sorted(blocks, key=lambda match: match["ratio"], reverse=True)
-
-        elif len(starts) == 1:
-            start = starts[0]        
-            end   = start+N
-            block = {"start":start, "end":end, "candidate":textToAnnotate}       
-            block["contextBefore"]    = fileText[max(0, start-self.contextLength):start]
-            block["contextAfter"]     = fileText[end:min(len(fileText), end+self.contextLength)]
-            blocks = [block]
+    
+    def localTextLocalization(self, paperId, textToAnnotate):
+        """
+         Return the candidate locations of the text in the paper, best first
+         (see TextIndex.search). Exact matches all have a ratio of 1.0.
+        """
+        return self.getIndex(paperId).search(textToAnnotate, self.contextLength)
+
+
+    def localizeTextAnnots(self, paperId, textsToAnnotate):
+        """
+         Batch version of localizeTextAnnot() for several texts of the same 
+         paper, whose text is read (or fetched from the server) and indexed 
+         once.
+        """
+        if self.fullTextLocallyAvailable(paperId):
+            index = self.getIndex(paperId)
         else:
-            blocks = [{"start"        : m.start(), 
-                       "end"          : m.start()+N, 
-                       "contextBefore": fileText[max(0, m.start()-self.contextLength):m.start()],
-                       "contextAfter" : fileText[(m.start()+N):min(len(fileText), m.start()+N+self.contextLength)],
-                       "candidate"    : textToAnnotate} 
-                       for m in re.finditer(self.textToAnnotateTxt.text(), fileText)]         
-      
-        return blocks
-                       
-                       
-                       
-                       
-                       
-                       
-                       
-                  
-
+            index = self.getRemoteIndex(paperId)
+            if index is None:
+                return [None]*len(textsToAnnotate)
+        return [index.search(textToAnnotate, self.contextLength) for textToAnnotate in textsToAnnotate]
+
+
+
+# The escapes written by Annotation.text (newlines and backslashreplace).
+escapePattern = re.compile(r"\\(?:n|x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8})")
+
+def unescapeAnnotationText(text):
+    """
+     Return the text of a TextLocalizer as in the paper. The annotations store 
+     it in ASCII, with the other characters and the newlines backslash-escaped
+     (see Annotation.text). Only these escapes are decoded, the other 
+     backslashes (e.g., in "\\alpha") being kept as they are. A ValueError is
+     raised for the escapes of invalid code points.
+    """
+    def decode(match):
+        escape = match.group(0)
+        if escape == "\\n":
+            return "\n"
+        codePoint = int(escape[2:], 16)
+        if codePoint > 0x10FFFF:
+            raise ValueError("Invalid code point: " + escape)
+        return chr(codePoint)
+    return escapePattern.sub(decode, text)
+
+
+
+def relocalizePaper(txtFileName, queries, minRatio=0.5):
+    """
+     Localize the (annotId, text, start) queries in the text file. Return the
+     list of (annotId, newStart) pairs, newStart being None if the text is not
+     found. Among equally good candidates, the closest to start is chosen.
+    """
+    with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
+        index = TextIndex(f.read())
+
+    results = []
+    for annotId, text, start in queries:
+        blocks = index.search(text, contextLength=0, minRatio=minRatio)
+        if not len(blocks):
+            results.append((annotId, None))
+            continue
+        bestRatio = blocks[0]["ratio"]
+        best = min((block for block in blocks if block["ratio"] == bestRatio),
+                   key=lambda block: abs(block["start"] - start))
+        results.append((annotId, best["start"]))
+    return results
+
+
+
+def relocalizeAnnotations(annotations, dbPath, nbProcesses=None, minRatio=0.5, update=False):
+    """
+     Localize again the text annotations in the local texts of their paper 
+     (e.g., after the text has been extracted again with OCR or pdftotext). 
+     Each paper is read and indexed once, and the papers are processed in 
+     parallel by nbProcesses processes (by default, one per CPU). The papers
+     whose text is not available locally are skipped.
+
+     Return a dictionary {annotId: (oldStart, newStart)} for the annotations 
+     whose start changed, newStart being None for those not found anymore. 
+     If update is True, the localizers of the annotations found at another
+     position are updated. The annotations whose text cannot be decoded are
+     skipped, with a warning.
+    """
+    from nat.annotation import TextLocalizer
+
+    queries = OrderedDict()
+    localizers = {}
+    for annot in annotations:
+        if not isinstance(annot.localizer, TextLocalizer):
+            continue
+        txtFileName = join(dbPath, utils.Id2FileName(annot.pubId)) + ".txt"
+        if not isfile(txtFileName):
+            continue
+        try:
+            text = unescapeAnnotationText(annot.localizer.text)
+        except ValueError as error:
+            warnings.warn("The text of the annotation " + str(annot.ID) + " cannot be decoded: " + str(error))
+            continue
+        queries.setdefault(txtFileName, []).append((annot.ID, text, annot.localizer.start))
+        localizers[annot.ID] = annot.localizer
+
+    if len(queries) > 1 and nbProcesses != 1:
+        with ProcessPoolExecutor(max_workers=nbProcesses) as executor:
+            paperResults = list(executor.map(relocalizePaper, list(queries), list(queries.values()),
+                                             [minRatio]*len(queries)))
+    else:
+        paperResults = [relocalizePaper(txtFileName, paperQueries, minRatio) 
+                        for txtFileName, paperQueries in queries.items()]
+
+    changes = {}
+    for results in paperResults:
+        for annotId, newStart in results:
+            oldStart = localizers[annotId].start
+            if newStart != oldStart:
+                changes[annotId] = (oldStart, newStart)
+                if update and not newStart is None:
+                    localizers[annotId].start = newStart
+    return changes
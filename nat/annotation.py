@@ -11,7 +11,8 @@ from .parameterInstance import ParameterInstance
 from .paramDesc import ParamRef
 from .tag import Tag
 from . import utils
-from .restClient import RESTClient
+from .restClient import sharedClient
+from . import contextCache
 from .ontoServ import getOntoCategory
 from .treeData import getChildren, rootIDs
 
@@ -336,38 +337,7 @@ class Annotation:
 
     # FIXME Delayed refactoring. Define only once the REST server URL.
     def getContext(self, contextLength=100, dbPath="./curator_DB", restServerURL="https://bbpteam.epfl.ch/neurocurator/api/v1.0/"):
-        
-        if not isinstance(self.localizer, TextLocalizer):
-            return ""        
-
-        try:
-            txtFileName = join(dbPath, utils.Id2FileName(self.pubId)) + ".txt"
-            
-            if isfile(txtFileName):
-                # Context is fetch locally
-                with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
-                    fileText = f.read()
-                    contextStart = max(0, self.localizer.start - contextLength)
-                    contextEnd = min(self.localizer.start + len(self.localizer.text) + contextLength, len(fileText))
-                    return fileText[contextStart:contextEnd]
-                    
-            else:
-                # Context is fetch through the RESTful server
-                if restServerURL is None:
-                    raise IOError("The context cannot be determined. The text " +
-                                  "is not available in the local database and " +
-                                  "no RESTful server URL has been provided to " +
-                                  "fetch it remotely.")
-                
-                restClient = RESTClient(restServerURL)
-                context = restClient.getContext(self.pubId, contextLength,
-                                             self.localizer.start, self.localizer.text)    
-                return context
-
-
-        except FileNotFoundError:
-            print("File not found.")
-            return ""
+        return getContexts([self], contextLength, dbPath, restServerURL)[0]
 
 
 
@@ -445,6 +415,121 @@ class Annotation:
         
             
     
+# FIXME Delayed refactoring. Define only once the REST server URL.
+def getContexts(annotations, contextLength=100, dbPath="./curator_DB", 
+                restServerURL="https://bbpteam.epfl.ch/neurocurator/api/v1.0/"):
+    """
+     Batch version of Annotation.getContext(). Each local text file is read 
+     once and the contexts of the papers not available locally are fetched 
+     with a single request to the RESTful server. For these papers, the texts
+     and contexts are looked up first in the on-disk cache of contextCache, 
+     if it is enabled.
+    """
+    contexts    = [""]*len(annotations)
+    localTexts  = {}
+    remoteItems = []
+    for no, annot in enumerate(annotations):
+        if not isinstance(annot.localizer, TextLocalizer):
+            continue
+
+        txtFileName = join(dbPath, utils.Id2FileName(annot.pubId)) + ".txt"
+        if not txtFileName in localTexts:
+            if isfile(txtFileName):
+                with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
+                    localTexts[txtFileName] = f.read()
+            else:
+                localTexts[txtFileName] = None
+
+        fileText = localTexts[txtFileName]
+        if fileText is None:
+            remoteItems.append(no)
+        else:
+            contexts[no] = extractContext(fileText, annot, contextLength)
+
+    if not len(remoteItems):
+        return contexts
+
+    if restServerURL is None:
+        raise IOError("The context cannot be determined. The text " +
+                      "is not available in the local database and " +
+                      "no RESTful server URL has been provided to " +
+                      "fetch it remotely.")
+
+    # Opened only when some texts are not available locally.
+    cache = contextCache.getDefaultCache()
+    if not cache is None:
+        cachedTexts = {}
+        uncachedItems = []
+        for no in remoteItems:
+            pubId = annotations[no].pubId
+            if not pubId in cachedTexts:
+                cachedTexts[pubId] = cache.getFreshText(pubId)
+            if cachedTexts[pubId] is None:
+                uncachedItems.append(no)
+            else:
+                contexts[no] = extractContext(cachedTexts[pubId], annotations[no], contextLength)
+        remoteItems = uncachedItems
+        if not len(remoteItems):
+            return contexts
+
+    queries = [(annotations[no].pubId, annotations[no].localizer.start,
+                len(annotations[no].localizer.text), contextLength) for no in remoteItems]
+    if cache is None:
+        fetched = sharedClient(restServerURL).getContexts(queries)
+    else:
+        fetched  = cache.getContexts(queries)
+        missing  = [no for no, context in enumerate(fetched) if context is None]
+        if len(missing):
+            missingContexts = sharedClient(restServerURL).getContexts([queries[no] for no in missing])
+            for no, context in zip(missing, missingContexts):
+                fetched[no] = context
+            # Contexts of the papers not available on the server are not cached.
+            found = [no for no in missing if not fetched[no] is None]
+            cache.addContexts([queries[no] for no in found], [fetched[no] for no in found])
+
+    for no, context in zip(remoteItems, fetched):
+        if not context is None:
+            contexts[no] = context
+
+    return contexts
+
+
+
+def extractContext(fileText, annot, contextLength):
+    contextStart = max(0, annot.localizer.start - contextLength)
+    contextEnd = min(annot.localizer.start + len(annot.localizer.text) + contextLength, len(fileText))
+    return fileText[contextStart:contextEnd]
+
+
+
+# FIXME Delayed refactoring. Define only once the REST server URL.
+def prefetchTexts(annotations, dbPath="./curator_DB", 
+                  restServerURL="https://bbpteam.epfl.ch/neurocurator/api/v1.0/"):
+    """
+     Fetch in the on-disk cache of contextCache the texts of the papers of 
+     the annotations (e.g., of a search result) which are not available 
+     locally, so that their contexts can then be computed offline. Only 
+     possible if the server allows the download of the texts. The cached 
+     texts are downloaded again only if they changed on the server. Return 
+     the number of texts available in the cache.
+    """
+    pubIds = set(annot.pubId for annot in annotations if isinstance(annot.localizer, TextLocalizer))
+    pubIds = [pubId for pubId in sorted(pubIds) 
+              if not isfile(join(dbPath, utils.Id2FileName(pubId)) + ".txt")]
+    if not len(pubIds):
+        return 0
+
+    cache = contextCache.getDefaultCache()
+    if cache is None:
+        raise ValueError("The context cache is disabled or cannot be created (see contextCache).")
+
+    client = sharedClient(restServerURL)
+    texts  = client.concurrentMap(lambda pubId: contextCache.fetchText(client, pubId, cache), 
+                                  [(pubId,) for pubId in pubIds])
+    return sum(not text is None for text, version in texts)
+
+
+
 import os
 from glob import glob
 def resaveAnnotation(pathDB, pathOut=None):
@@ -10,8 +10,9 @@ import pandas as pd
 import numpy as np
 import os.path
 import pickle
+import hashlib
 
-from .annotation import Annotation
+from .annotation import Annotation, getContexts
 from .modelingParameter import getParameterTypeNameFromID
 from .variable import NumericalVariable, Variable
 from .treeData import flatten_list
@@ -32,6 +33,23 @@ parameterResultFields  = ["Required tag names", "Result type", "Values", "Parame
 
 
 
+def getCorpusVersion(pathDB):
+    """
+    Return a string identifying the state of the annotation files (.pcr) 
+    of the database. It changes whenever a file is added, removed or modified.
+    """
+    if pathDB is None:
+        pathDB = os.path.join(os.path.dirname(__file__), 'curator_DB')
+
+    version = hashlib.sha1()
+    for fileName in sorted(glob(os.path.join(pathDB, "*.pcr"))):
+        fileStat = os.stat(fileName)
+        version.update("{};{};{}\n".format(os.path.basename(fileName), fileStat.st_size, 
+                                            fileStat.st_mtime_ns).encode("utf-8"))
+    return version.hexdigest()
+
+
+
 class CompiledCorpus:
     
     def __init__(self, binPath="annotations.bin"):
@@ -164,11 +182,14 @@ class AnnotationSearch(Search):
         super(AnnotationSearch, self).__init__(pathDB, compiledCorpus)
         self.resultFields = annotationResultFields
 
-    def search(self):
+    def selectItems(self):
         if self.findEquivalences:
             self.conditions = EquivalenceFinder(self.conditions).run()
         self.selectedItems = self.conditions.apply_annot(self.annotations)
-        resultDF           = self.formatOutput(self.selectedItems)
+        return self.selectedItems
+
+    def search(self):
+        resultDF           = self.formatOutput(self.selectItems())
         return resultDF
 
 
@@ -221,11 +242,14 @@ class ParameterSearch(Search):
         self.contextLength       = 100
 
 
-    def search(self):
+    def selectItems(self):
         if self.findEquivalences:
             self.conditions = EquivalenceFinder(self.conditions).run()
         self.selectedItems = self.conditions.apply_param(self.parameters)
-        resultDF           = self.formatOutput(self.selectedItems)
+        return self.selectedItems
+
+    def search(self):
+        resultDF           = self.formatOutput(self.selectItems())
         return resultDF
 
 
@@ -244,7 +268,7 @@ class ParameterSearch(Search):
                 results[field] = [annot.text for annot in annotations]                
             
             elif field == "Context":
-                results[field] = [annot.getContext(self.contextLength, dbPath=self.pathDB) for annot in annotations]
+                results[field] = getContexts(annotations, self.contextLength, dbPath=self.pathDB)
 
             elif field == "Result type":
                 results[field] = [param.description.type for param in parameters]               
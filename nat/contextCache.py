@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the paper contexts and texts fetched from the RESTful
+server, so that repeated searches do not fetch them again while they are 
+fresh. The cached entries expire after defaultCacheExpiry (24 h): the 
+contexts are then fetched again and the texts revalidated with the server
+(only resent if they changed), so that repeated searches still need the
+network beyond this delay.
+"""
+
+import os
+import sqlite3
+import time
+import warnings
+from os.path import join, expanduser, dirname
+from threading import Lock
+
+
+# Cache used by annotation.getContexts() and AnnotTextLocalizer for the 
+# papers whose text is not available locally. It is enabled by default, in
+# the ~/.nat directory of the user. Set defaultCachePath to None to disable
+# it.
+defaultCachePath   = join(expanduser("~"), ".nat", "context_cache.sqlite")
+defaultCacheSize   = 200*2**20
+defaultCacheExpiry = 24*3600
+
+
+class ContextCache:
+    """
+     Contexts, keyed by (pubId, start, length, contextLength), and whole
+     paper texts with their version on the server, keyed by pubId, stored 
+     in a SQLite file. Since the texts change when they are extracted again
+     (e.g., after OCR), the contexts are used for expiry seconds and the
+     texts are then checked again against the server (see fetchText). When 
+     the cached strings exceed maxSize characters, the least recently used 
+     entries are evicted, down to evictionTarget*maxSize characters so that 
+     they are evicted in batches. The size of the cache is tracked in 
+     memory between evictions, the entries added by other processes being
+     only counted at the next eviction.
+    """
+
+    schemaVersion  = 2
+    evictionTarget = 0.9
+
+    def __init__(self, pathCache, maxSize=defaultCacheSize, expiry=defaultCacheExpiry):
+        self.pathCache = pathCache
+        self.maxSize   = maxSize
+        self.expiry    = expiry
+        if dirname(pathCache):
+            os.makedirs(dirname(pathCache), exist_ok=True)
+
+        # Caches written by previous versions are emptied.
+        if self.__execute("PRAGMA user_version")[0][0] != self.schemaVersion:
+            self.__execute("DROP TABLE IF EXISTS contexts")
+            self.__execute("DROP TABLE IF EXISTS texts")
+            self.__execute("PRAGMA user_version = " + str(self.schemaVersion))
+        self.__execute("CREATE TABLE IF NOT EXISTS contexts (pubId TEXT, start INTEGER, "
+                       "length INTEGER, contextLength INTEGER, context TEXT, size INTEGER, "
+                       "accessed REAL, fetched REAL, PRIMARY KEY (pubId, start, length, contextLength))")
+        self.__execute("CREATE TABLE IF NOT EXISTS texts (pubId TEXT PRIMARY KEY, text TEXT, "
+                       "version TEXT, size INTEGER, accessed REAL, fetched REAL)")
+
+        # Upper bound of the size, replaced entries being counted twice.
+        self.__size     = self.size()
+        self.__sizeLock = Lock()
+
+
+    def __execute(self, query, parameters=()):
+        # A connection per call, since the cache can be used by several threads.
+        connection = sqlite3.connect(self.pathCache, timeout=30)
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+
+    def isFresh(self, fetched):
+        return time.time() - fetched < self.expiry
+
+
+    def getText(self, pubId):
+        """
+         Return (text, version, fetched) for the cached text of the paper, 
+         fetched being the time it was last checked with the server, or None
+         if it is not cached.
+        """
+        rows = self.__execute("SELECT text, version, fetched FROM texts WHERE pubId=?", (pubId,))
+        if not rows:
+            return None
+        self.__execute("UPDATE texts SET accessed=? WHERE pubId=?", (time.time(), pubId))
+        return tuple(rows[0])
+
+
+    def getFreshText(self, pubId):
+        # The cached text if it has been checked with the server recently.
+        cached = self.getText(pubId)
+        if cached is None or not self.isFresh(cached[2]):
+            return None
+        return cached[0]
+
+
+    def addText(self, pubId, text, version):
+        now = time.time()
+        self.__execute("INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?, ?)",
+                       (pubId, text, version, len(text), now, now))
+        self.__added(len(text))
+
+
+    def touchText(self, pubId):
+        # The cached text is still the version on the server.
+        self.__execute("UPDATE texts SET fetched=? WHERE pubId=?", (time.time(), pubId))
+
+
+    def getContexts(self, keys):
+        """
+         Return the cached contexts for a list of (pubId, start, length,
+         contextLength) keys, None for the ones not cached or expired.
+        """
+        contexts = []
+        now = time.time()
+        connection = sqlite3.connect(self.pathCache, timeout=30)
+        try:
+            with connection:
+                for key in keys:
+                    rows = connection.execute("SELECT context FROM contexts WHERE pubId=? AND start=? "
+                                              "AND length=? AND contextLength=? AND fetched>?", 
+                                              tuple(key) + (now - self.expiry,)).fetchall()
+                    if rows:
+                        connection.execute("UPDATE contexts SET accessed=? WHERE pubId=? AND start=? "
+                                           "AND length=? AND contextLength=?", (now,) + tuple(key))
+                    contexts.append(rows[0][0] if rows else None)
+        finally:
+            connection.close()
+        return contexts
+
+
+    def addContexts(self, keys, contexts):
+        now = time.time()
+        connection = sqlite3.connect(self.pathCache, timeout=30)
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO contexts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       [tuple(key) + (context, len(context), now, now)
+                                        for key, context in zip(keys, contexts)])
+        finally:
+            connection.close()
+        self.__added(sum(len(context) for context in contexts))
+
+
+    def size(self):
+        return sum(self.__execute("SELECT COALESCE(SUM(size), 0) FROM " + table)[0][0]
+                   for table in ["contexts", "texts"])
+
+
+    def __added(self, size):
+        with self.__sizeLock:
+            self.__size += size
+            if self.__size <= self.maxSize:
+                return
+        self.evict()
+
+
+    def evict(self):
+        # Least recently used entries first, contexts and texts together.
+        size   = self.size()
+        excess = size - self.evictionTarget*self.maxSize
+        if size <= self.maxSize or excess <= 0:
+            with self.__sizeLock:
+                self.__size = size
+            return
+
+        removed = {"contexts": [], "texts": []}
+        connection = sqlite3.connect(self.pathCache, timeout=30)
+        try:
+            with connection:
+                # Only the entries to evict are read.
+                entries = connection.execute("SELECT 'contexts', rowid, size, accessed FROM contexts UNION ALL "
+                                             "SELECT 'texts', rowid, size, accessed FROM texts ORDER BY accessed")
+                for table, rowid, entrySize, accessed in entries:
+                    if excess <= 0:
+                        break
+                    removed[table].append((rowid,))
+                    excess -= entrySize
+                    size   -= entrySize
+                for table, rowids in removed.items():
+                    connection.executemany("DELETE FROM " + table + " WHERE rowid=?", rowids)
+        finally:
+            connection.close()
+        with self.__sizeLock:
+            self.__size = size
+
+
+    def clear(self):
+        self.__execute("DELETE FROM contexts")
+        self.__execute("DELETE FROM texts")
+        with self.__sizeLock:
+            self.__size = 0
+
+
+
+def fetchText(restClient, pubId, cache=None):
+    """
+     Return (text, version) for the text of the paper on the server, or 
+     (None, None) if it cannot be downloaded. The text is taken from the 
+     cache while it is fresh; it is then checked against the server, which
+     sends it again only if its version changed.
+    """
+    cached = None if cache is None else cache.getText(pubId)
+    if not cached is None and cache.isFresh(cached[2]):
+        return cached[0], cached[1]
+
+    text, version = restClient.getText(pubId, None if cached is None else cached[1])
+    if text is None:
+        if version is None or cached is None:
+            return None, None
+        # Not modified.
+        cache.touchText(pubId)
+        return cached[0], cached[1]
+
+    if not cache is None:
+        cache.addText(pubId, text, version)
+    return text, version
+
+
+
+_defaultCache     = None
+_defaultCacheLock = Lock()
+_failedCachePath  = None
+
+def getDefaultCache():
+    """
+     Return the cache at defaultCachePath, created on the first call. Return
+     None if it is disabled or if it cannot be created (e.g., read-only home 
+     directory), the contexts being then fetched without cache.
+    """
+    global _defaultCache, _failedCachePath
+    with _defaultCacheLock:
+        if defaultCachePath is None or defaultCachePath == _failedCachePath:
+            return None
+        if _defaultCache is None or _defaultCache.pathCache != defaultCachePath:
+            try:
+                _defaultCache = ContextCache(defaultCachePath, defaultCacheSize, defaultCacheExpiry)
+            except (OSError, sqlite3.Error) as error:
+                warnings.warn("The context cache cannot be used: " + str(error))
+                _failedCachePath = defaultCachePath
+                _defaultCache    = None
+    return _defaultCache
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+Gunicorn settings of the REST server (see nat.wsgi):
+
+    NAT_DB_PATH=/mnt/curator_DB/ gunicorn -c python:nat.gunicornConfig -w 4 --threads 4 nat.wsgi:app
+"""
+
+# The search corpus and the similarity index are loaded before forking.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # The threads of the OCR queue do not survive the fork, so the queue is
+    # started in each worker. The jobs left queued, or interrupted by a 
+    # restart, are resumed without waiting for a request to create it.
+    from nat.restServer import getOCRQueue
+    getOCRQueue()
@@ -2,8 +2,15 @@
 
 __author__ = "Christian O'Reilly"
 
-import urllib
-from bs4 import BeautifulSoup
+import json
+import sqlite3
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os.path import join, expanduser, dirname
+from threading import Lock
 from dateutil.parser import parse
 import re
 
@@ -12,51 +19,298 @@ try:
 except SystemError:
     from nat.utils import Id2FileName
 
-def getPMIDSoup(PMID):
-    url = "http://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool=neurocurator&email=christian.oreilly@epfl.ch&ids=" + PMID + "&format=json&versions=no"
-    return getSoup(url)
- 
-def getDOISoup(DOI): 
-    url = "http://doi.org/api/handles/" + DOI
-    return getSoup(url)
- 
- 
-def getSoup(url):
+
+eutilsURL   = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=pubmed&retmode=json&id="
+idconvURL   = ("https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool=neurocurator&"
+               "email=christian.oreilly@epfl.ch&format=json&versions=no&ids=")
+crossrefURL = "https://api.crossref.org/works/"
+handleURL   = "https://doi.org/api/handles/"
+
+# Cache of the metadata used by the functions of this module. Set 
+# defaultCachePath to None to disable it.
+defaultCachePath = join(expanduser("~"), ".nat", "metadata_cache.sqlite")
+
+# Errors of the requests, after which the identifiers are left unresolved
+# (and not cached), and errors of the parsing of incomplete records, which 
+# only leave the identifier concerned unresolved.
+requestErrors = (urllib.error.URLError, OSError, ValueError)
+parseErrors   = (KeyError, IndexError, TypeError, AttributeError)
+
+
+def fetchJSON(url):
+    """
+     Return the decoded JSON response of the URL, or None if the resource 
+     is not found (HTTP 404). Other errors are raised.
+    """
     try:
-        with urllib.request.urlopen(url) as response:
-           html = response.read()
-    except urllib.error.HTTPError:
-        return None
-    
-    return BeautifulSoup(html, "lxml")    
-     
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as error:
+        if error.code == 404:
+            return None
+        raise
+
+
+
+class MetadataResolver:
+    """
+     Resolve publication metadata from PMIDs and DOIs. The PMIDs are sent
+     batchSize at a time to the E-utilities, the DOIs are looked up
+     concurrently by nbWorkers threads, and all the requests are limited
+     to maxRequestsPerSecond. The results are cached in a SQLite file for 
+     expiry seconds, and the identifiers not found (or DOIs not registered)
+     for missExpiry seconds, since they might be registered later.
+
+     fetch(url) returns the decoded JSON of a URL, or None if not found;
+     it can be replaced (e.g., to replay recorded responses in tests).
+    """
+
+    def __init__(self, cachePath=None, expiry=30*24*3600, missExpiry=24*3600, batchSize=200, 
+                 nbWorkers=4, maxRequestsPerSecond=3, fetch=fetchJSON):
+        self.cachePath   = cachePath
+        self.expiry      = expiry
+        self.missExpiry  = missExpiry
+        self.batchSize   = batchSize
+        self.nbWorkers   = nbWorkers
+        self.minInterval = 1.0/maxRequestsPerSecond
+        self.fetch       = fetch
+        self.__rateLock  = Lock()
+        self.__nextRequest = 0.0
+        if not cachePath is None:
+            if dirname(cachePath):
+                makedirs(dirname(cachePath), exist_ok=True)
+            self.__execute("CREATE TABLE IF NOT EXISTS metadata (kind TEXT, key TEXT, value TEXT, "
+                           "fetched REAL, PRIMARY KEY (kind, key))")
+
+
+    def __execute(self, query, parameters=()):
+        # A connection per call, since the DOIs are looked up by several threads.
+        connection = sqlite3.connect(self.cachePath, timeout=30)
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+
+    def cached(self, kind, keys):
+        """
+         Return the dictionary {key: value} of the keys of this kind cached 
+         and not expired.
+        """
+        if self.cachePath is None or not len(keys):
+            return {}
+        values = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start+500]
+            rows = self.__execute("SELECT key, value FROM metadata WHERE kind=? AND fetched>CASE "
+                                  "WHEN value IN ('null', 'false') THEN ? ELSE ? END AND key IN (" +
+                                  ", ".join("?"*len(batch)) + ")", 
+                                  [kind, time.time() - self.missExpiry, time.time() - self.expiry] + batch)
+            values.update((key, json.loads(value)) for key, value in rows)
+        return values
+
+
+    def store(self, kind, values):
+        if self.cachePath is None or not len(values):
+            return
+        now = time.time()
+        connection = sqlite3.connect(self.cachePath, timeout=30)
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                                       [(kind, key, json.dumps(value), now) for key, value in values.items()])
+        finally:
+            connection.close()
+
+
+    def __request(self, url):
+        # Waits for the turn of the request to respect the rate limit.
+        with self.__rateLock:
+            wait = self.__nextRequest - time.time()
+            self.__nextRequest = max(time.time(), self.__nextRequest) + self.minInterval
+        if wait > 0:
+            time.sleep(wait)
+        return self.fetch(url)
+
+
+    def __resolve(self, kind, keys, fetchBatch, raiseErrors=False):
+        # Values of the keys, fetching the ones not cached by batches. 
+        # fetchBatch(batch) returns the values of the keys of the batch; the
+        # keys it leaves out are unresolved (None) and not cached. The request
+        # errors leave the keys of the batch unresolved, unless raiseErrors.
+        keys    = list(dict.fromkeys(keys))
+        values  = self.cached(kind, keys)
+        missing = [key for key in keys if not key in values]
+        for start in range(0, len(missing), self.batchSize):
+            try:
+                fetched = fetchBatch(missing[start:start+self.batchSize])
+            except requestErrors:
+                if raiseErrors:
+                    raise
+                continue
+            self.store(kind, fetched)
+            values.update(fetched)
+        return {key: values.get(key) for key in keys}
+
+
+    def __resolveConcurrently(self, kind, keys, fetchOne, raiseErrors=False):
+        # fetchOne(key) returns the value of the key; an exception leaves the
+        # key unresolved (None) and not cached.
+        def fetchBatch(batch):
+            def tryFetch(key):
+                try:
+                    return fetchOne(key)
+                except parseErrors:
+                    return Ellipsis
+                except requestErrors:
+                    if raiseErrors:
+                        raise
+                    return Ellipsis
+            with ThreadPoolExecutor(max_workers=self.nbWorkers) as executor:
+                results = dict(zip(batch, executor.map(tryFetch, batch)))
+            return {key: value for key, value in results.items() if not value is Ellipsis}
+
+        return self.__resolve(kind, keys, fetchBatch, raiseErrors)
+
+
+    def pmidInfos(self, PMIDs):
+        """
+         Return {PMID: info} for the PMIDs, info being a dictionary with the 
+         keys authors, journal, year, issue, volume and title, or None if the
+         PMID is not found.
+        """
+        def fetchBatch(batch):
+            response = self.__request(eutilsURL + ",".join(batch))
+            result   = {} if response is None else response.get("result", {})
+            infos    = {}
+            for PMID in batch:
+                if not PMID in result or "error" in result[PMID]:
+                    infos[PMID] = None
+                    continue
+                try:
+                    infos[PMID] = parsePubMedSummary(result[PMID])
+                except parseErrors:
+                    pass
+            return infos
+
+        return self.__resolve("pmidInfo", [str(PMID) for PMID in PMIDs], fetchBatch)
+
+
+    def pmidIDs(self, PMIDs, raiseErrors=False):
+        """
+         Return {PMID: ID} for the PMIDs, ID being the DOI of the publication,
+         "PMID_" + PMID if it has no DOI, or None if the PMID is not found. 
+         If raiseErrors, the request errors are raised instead of leaving the
+         PMIDs unresolved (None).
+        """
+        def fetchBatch(batch):
+            response = self.__request(idconvURL + ",".join(batch))
+            if response is None or response.get("status") != "ok":
+                return {PMID: None for PMID in batch}
+            records = {record.get("pmid"): record for record in response.get("records", [])}
+            IDs = {}
+            for PMID in batch:
+                record = records.get(PMID)
+                if record is None or record.get("status") == "error":
+                    IDs[PMID] = None
+                else:
+                    IDs[PMID] = record["doi"] if "doi" in record else "PMID_" + PMID
+            return IDs
+
+        return self.__resolve("pmidID", [str(PMID) for PMID in PMIDs], fetchBatch, raiseErrors)
+
+
+    def doiInfos(self, DOIs):
+        """
+         Return {DOI: info} for the DOIs (see pmidInfos), looked up 
+         concurrently with Crossref.
+        """
+        def fetchOne(DOI):
+            response = self.__request(crossrefURL + Id2FileName(DOI))
+            return None if response is None else parseCrossrefWork(response["message"])
+
+        return self.__resolveConcurrently("doiInfo", DOIs, fetchOne)
+
+
+    def checkDOIs(self, DOIs, raiseErrors=False):
+        """
+         Return {DOI: True/False} according to whether the DOIs are registered,
+         or None for the DOIs that could not be checked. If raiseErrors, the 
+         request errors are raised instead.
+        """
+        def fetchOne(DOI):
+            response = self.__request(handleURL + Id2FileName(DOI))
+            return not response is None and response.get("responseCode") == 1
+
+        return self.__resolveConcurrently("doiValid", DOIs, fetchOne, raiseErrors)
+
+
+    def infos(self, IDs):
+        """
+         Return {ID: info} for publication IDs, either DOIs or "PMID_" + PMID.
+        """
+        PMIDs = {ID: ID.split("_")[1] for ID in IDs if "PMID" in ID}
+        pmidInfos = self.pmidInfos(list(PMIDs.values()))
+        doiInfos  = self.doiInfos([ID for ID in IDs if not ID in PMIDs])
+        return {ID: pmidInfos[PMIDs[ID]] if ID in PMIDs else doiInfos[ID] for ID in IDs}
+
+
+
+def parsePubMedSummary(summary):
+    authors = "; ".join([author["name"] for author in summary.get("authors", []) 
+                                        if author.get("authtype") == "Author" and "name" in author])
+    return {"authors":authors,
+            "journal":summary.get('fulljournalname', ""),
+            "year":getYear(summary.get('pubdate', "")),    
+            "issue":summary.get('issue', ""), 
+            "volume":summary.get('volume', ""),
+            "title":summary['title']} 
+
+
+
+def parseCrossrefWork(work):
+    # Some authors have no given name (e.g., consortia, which only have a name).
+    authors = "; ".join([", ".join([author[key] for key in ["family", "given"] if key in author]) 
+                         or author.get("name", "") for author in work.get("author", [])])   
+    retData = {"authors":authors,
+               "journal":work["container-title"][0] if work.get("container-title") else "",
+               "year":work["issued"]["date-parts"][0][0],    
+               "title":work["title"][0]}     
+    retData["issue"]  = work["issue"] if "issue" in work else ""
+    retData["volume"] = work["volume"] if "volume" in work else ""
+    return retData
+
+
+
+_defaultResolver     = None
+_defaultResolverLock = Lock()
+
+def getDefaultResolver():
+    global _defaultResolver
+    with _defaultResolverLock:
+        if _defaultResolver is None or _defaultResolver.cachePath != defaultCachePath:
+            _defaultResolver = MetadataResolver(defaultCachePath)
+    return _defaultResolver
+ 
  
  
 def getIDfromPMID(PMID):
-    soup = getPMIDSoup(PMID)
-    if soup is None:
-        return None
-    
-    jsonStr = eval(str(soup)[15:-19])
-    if jsonStr["status"] == "ok":
-        if "doi" in jsonStr["records"][0]:
-            return jsonStr["records"][0]["doi"]
-        else:
-            return "PMID_" + PMID
-    else:
-        return None
-
-    
+    return getDefaultResolver().pmidIDs([PMID])[str(PMID)]
 
 
 
 def getInfoFromID(ID): 
-    if "PMID" in ID:
-        idKind, PMID = ID.split("_")
-        return getInfoFromPMID(PMID)
-    else:
-        DOI = Id2FileName(ID)        
-        return getInfoFromDOI(DOI)
+    return getInfoFromIDs([ID])[ID]
+
+
+def getInfoFromIDs(IDs):
+    """
+     Batch version of getInfoFromID(): the PMIDs are resolved by batches and
+     the DOIs concurrently.
+    """
+    return getDefaultResolver().infos(IDs)
 
 
 
@@ -70,54 +324,12 @@ def getYear(dateStr):
             return re.search(r'[12]\d{3}', dateStr).group(0)
 
 def getInfoFromPMID(PMID):
-    soup = getSoup("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=pubmed&id=" + PMID + "&retmode=json")
-    if soup is None:
-        return None
-
-    result = eval(str(soup)[15:-19])["result"]
-    if PMID not in result:
-        return None
-    
-    authors = "; ".join([author["name"] for author in result[PMID]["authors"] 
-                                        if author["authtype"] == "Author"])
-    retData = {"authors":authors,
-               "journal":result[PMID]['fulljournalname'],
-               "year":getYear(result[PMID]['pubdate']),    
-               "issue":result[PMID]['issue'], 
-               "volume":result[PMID]['volume'],
-               "title":result[PMID]['title']} 
-
-    return retData
+    return getDefaultResolver().pmidInfos([PMID])[str(PMID)]
 
 
 
 def getInfoFromDOI(DOI):
-    soup = getSoup("http://api.crossref.org/works/" + DOI)
-    if soup is None:
-        return None
-    soup = str(soup)[15:-18]       
-    soup = soup.replace("true", "True")
-    soup = soup.replace("false", "False")
-    soup = eval(soup)["message"]
-    
-    authors = "; ".join([author["family"] + ", " + author["given"] for author in soup["author"]])   
-    year    = soup["issued"]["date-parts"][0][0]
-    #try:
-    #    year    = soup["published-print"]["date-parts"][0][0]
-    #except KeyError:
-    #    print(list(soup.keys()))
-    #    print(list(soup["issued"]['date-parts']))
-    #    print(list(soup["published-online"]['date-parts']))
-    
-    retData = {"authors":authors,
-               "journal":soup["container-title"][0],
-               "year":year,    
-               "title":soup["title"][0]}     
-    
-    retData["issue"]  = soup["issue"] if "issue" in soup else ""
-    retData["volume"] = soup["volume"] if "volume" in soup else ""
-
-    return retData 
+    return getDefaultResolver().doiInfos([DOI])[DOI]
  
 
 
@@ -130,27 +342,14 @@ def checkID(ID):
 
 
 def checkPMID(ID):
+    # Request errors (e.g., offline) are raised rather than taken as invalid IDs.
     idKind, PMID = ID.split("_")
-    soup = getPMIDSoup(PMID)
-    if soup is None:
-        return False
-     
-    return eval(str(soup)[15:-19])["status"] == "ok"
+    return not getDefaultResolver().pmidIDs([PMID], raiseErrors=True)[PMID] is None
 
 
 
 def checkDOI(DOI):
-    DOI = Id2FileName(DOI)
-    soup = getDOISoup(DOI)
-    if soup is None:
-        return False
-
-    # For some reason the "soup" string sometime contrains 
-    # dictionnary entries with values that are equare to 
-    # 'true' instead of 'True' which cannot be processed
-    # by the python's eval function.
-    soup = str(soup)[15:-18].replace("true", "True")
-    return eval(soup)["responseCode"] == 1
+    return bool(getDefaultResolver().checkDOIs([DOI], raiseErrors=True)[DOI])
 
 
 
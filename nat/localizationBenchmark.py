@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the localization of annotated strings in long paper texts
+(see TextIndex), with queries altered by OCR-like noise, e.g.:
+
+    python -m nat.localizationBenchmark --nbChars 500000 --noiseRate 0.05
+"""
+
+import argparse
+import random
+import string
+import time
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from .textIndex import TextIndex
+
+
+# Characters often confused by OCR.
+ocrConfusions = {"l": "1", "1": "l", "O": "0", "0": "O", "e": "c", "c": "e",
+                 "m": "rn", "i": "l", "S": "5", "B": "8", ",": "."}
+
+
+def generateText(nbChars, seed=0):
+    # Random words from a fixed vocabulary, with line breaks as in the
+    # texts extracted from PDFs.
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 10)))
+                  for _ in range(5000)]
+    words  = []
+    length = 0
+    lineLength = 0
+    while length < nbChars:
+        word = rng.choice(vocabulary)
+        if rng.random() < 0.05:
+            word = word.capitalize() + rng.choice([".", ","])
+        separator = " "
+        lineLength += len(word) + 1
+        if lineLength > 80:
+            separator  = "\n"
+            lineLength = 0
+        words.append(word + separator)
+        length += len(word) + 1
+    return "".join(words)[:nbChars]
+
+
+def addNoise(text, noiseRate, rng):
+    # Character confusions, deletions and insertions, as in OCR output.
+    chars = []
+    for char in text:
+        draw = rng.random()
+        if draw < noiseRate/2 and char in ocrConfusions:
+            chars.append(ocrConfusions[char])
+        elif draw < noiseRate*3/4:
+            continue
+        elif draw < noiseRate:
+            chars.append(char + rng.choice(string.ascii_lowercase + " "))
+        else:
+            chars.append(char)
+    return "".join(chars)
+
+
+def baselineLocalization(text, query):
+    # Longest common block found by difflib and extended to the query length.
+    matcher = SequenceMatcher(None, text, query, autojunk=False)
+    match   = matcher.find_longest_match(0, len(text), 0, len(query))
+    start   = max(0, match.a - match.b)
+    return start, start + len(query)
+
+
+def runBenchmark(nbChars=200000, nbQueries=100, queryLength=(50, 300),
+                 noiseRate=0.05, nbBaselineQueries=0, seed=0):
+    """
+     Localize nbQueries random passages of a generated text, altered with
+     noiseRate OCR-like noise, and return the index build time, the mean
+     query time (in seconds), the fraction of queries whose best candidate
+     overlaps the true location (accuracy) and, for these queries, the mean 
+     and maximal distance in characters between the start (and end) of the 
+     candidate and of the true location. If nbBaselineQueries > 0, the same
+     is measured for a difflib-based search on this number of queries.
+    """
+    rng  = random.Random(seed)
+    text = generateText(nbChars, seed)
+
+    start = time.perf_counter()
+    index = TextIndex(text)
+    buildTime = time.perf_counter() - start
+
+    queries = []
+    for _ in range(nbQueries):
+        length = rng.randint(*queryLength)
+        begin  = rng.randint(0, len(text) - length)
+        queries.append((begin, begin + length, addNoise(text[begin:begin+length], noiseRate, rng)))
+
+    def overlaps(span, begin, end):
+        return span[0] < end and begin < span[1]
+
+    def summarize(spans, queries, prefix=""):
+        # Accuracy and boundary errors of the spans found (None if not found).
+        found = [(span, begin, end) for span, (begin, end, query) in zip(spans, queries)
+                 if not span is None and overlaps(span, begin, end)]
+        startErrors = [abs(span[0] - begin) for span, begin, end in found] or [np.nan]
+        endErrors   = [abs(span[1] - end)   for span, begin, end in found] or [np.nan]
+        results = {"accuracy"      : len(found)/len(spans),
+                   "meanStartError": float(np.mean(startErrors)),
+                   "maxStartError" : float(np.max(startErrors)),
+                   "meanEndError"  : float(np.mean(endErrors)),
+                   "maxEndError"   : float(np.max(endErrors))}
+        if prefix:
+            results = {prefix + key[0].upper() + key[1:]: value for key, value in results.items()}
+        return results
+
+    queryTimes = []
+    spans = []
+    for begin, end, query in queries:
+        start  = time.perf_counter()
+        blocks = index.search(query)
+        queryTimes.append(time.perf_counter() - start)
+        spans.append((blocks[0]["start"], blocks[0]["end"]) if len(blocks) else None)
+
+    results = {"nbChars": len(text),
+               "noiseRate": noiseRate,
+               "buildTime": buildTime,
+               "queryTime": float(np.mean(queryTimes))}
+    results.update(summarize(spans, queries))
+
+    if nbBaselineQueries:
+        queryTimes = []
+        spans = []
+        for begin, end, query in queries[:nbBaselineQueries]:
+            start = time.perf_counter()
+            spans.append(baselineLocalization(text, query))
+            queryTimes.append(time.perf_counter() - start)
+        results["baselineQueryTime"] = float(np.mean(queryTimes))
+        results.update(summarize(spans, queries[:nbBaselineQueries], "baseline"))
+
+    return results
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the text localization.")
+    parser.add_argument("--nbChars", type=int, default=200000)
+    parser.add_argument("--nbQueries", type=int, default=100)
+    parser.add_argument("--noiseRate", type=float, default=0.05)
+    parser.add_argument("--nbBaselineQueries", type=int, default=5)
+    args = parser.parse_args()
+
+    results = runBenchmark(args.nbChars, args.nbQueries, noiseRate=args.noiseRate,
+                           nbBaselineQueries=args.nbBaselineQueries)
+    for key, value in results.items():
+        print("{:>22}: {}".format(key, round(value, 6) if isinstance(value, float) else value))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent queue of the OCR jobs run by the REST server.
+"""
+
+import os
+import sqlite3
+import time
+import uuid
+from threading import Condition, Lock, Thread
+
+
+class OCRQueueFullError(Exception):
+    pass
+
+
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+
+class OCRJobQueue:
+    """
+     Run OCR jobs in a pool of worker threads. The jobs are recorded in a 
+     SQLite table so that they can be polled by id and the unfinished ones
+     are run again when the server restarts. The table can be shared by the
+     queues of several server processes (e.g., gunicorn workers): the idle 
+     workers of every process claim the oldest queued job, and the bounds 
+     on the number of running jobs (nbWorkers) and of pending jobs 
+     (maxQueueSize) apply to all of them together. The process running a 
+     job renews its lease on it every leaseDuration/4 seconds. A job whose
+     lease expired, or whose process is gone, is queued again: process ids
+     are reused (e.g., after a container restart) and cannot tell alone 
+     whether a job is still running.
+    """
+
+    activeStatuses = ("queued", "running")
+
+    def __init__(self, pathDB, runJob, nbWorkers=2, maxQueueSize=20, pollInterval=5.0, 
+                 leaseDuration=120.0):
+        """
+         runJob(fileName, setProgress) is called by the workers. It signals
+         a failure by raising an exception. The jobs submitted by other 
+         processes are looked for every pollInterval seconds.
+        """
+        self.pathDB       = pathDB
+        self.runJob       = runJob
+        self.nbWorkers    = nbWorkers
+        self.maxQueueSize = maxQueueSize
+        self.pollInterval  = pollInterval
+        self.leaseDuration = leaseDuration
+        self.__lock        = Lock()
+        self.__newJob      = Condition()
+        self.__stopped     = False
+        self.__runningJobs = set()
+
+        self.__execute("CREATE TABLE IF NOT EXISTS ocrJobs (jobId TEXT PRIMARY KEY, "
+                       "fileName TEXT, status TEXT, progress TEXT, error TEXT, "
+                       "submitted REAL, started REAL, finished REAL, owner INTEGER)")
+        # Tables created before the owner and lease columns were added.
+        for column in ["owner INTEGER", "leaseExpiry REAL"]:
+            try:
+                self.__execute("ALTER TABLE ocrJobs ADD COLUMN " + column)
+            except sqlite3.OperationalError:
+                pass
+
+        # Every process can run all the jobs, e.g., if it is the only one left.
+        self.__workers = [Thread(target=self.__work, daemon=True) for _ in range(nbWorkers)]
+        self.__workers.append(Thread(target=self.__renewLeases, daemon=True))
+        for worker in self.__workers:
+            worker.start()
+
+
+    def __connect(self):
+        # A connection per call, since the workers run in other threads. 
+        # Transactions are started explicitly.
+        connection = sqlite3.connect(self.pathDB, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+
+    def __execute(self, query, parameters=()):
+        connection = self.__connect()
+        try:
+            rows = connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+        return [dict(row) for row in rows]
+
+
+    def __update(self, jobId, **fields):
+        assignments = ", ".join(key + "=?" for key in fields)
+        self.__execute("UPDATE ocrJobs SET " + assignments + " WHERE jobId=?",
+                       list(fields.values()) + [jobId])
+
+
+    def __claimNext(self):
+        """
+         Mark as running, on behalf of this process, the oldest queued job
+         and return it, or return None if there is none or if nbWorkers jobs
+         are already running in all the processes.
+        """
+        connection = self.__connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+
+            # Jobs interrupted by a restart of the server (i.e., whose 
+            # process is gone or whose lease expired) are queued again.
+            now = time.time()
+            for job in connection.execute("SELECT jobId, owner, leaseExpiry FROM ocrJobs "
+                                          "WHERE status='running'").fetchall():
+                if (job["owner"] is None or not isProcessAlive(job["owner"]) or
+                    job["leaseExpiry"] is None or job["leaseExpiry"] < now):
+                    connection.execute("UPDATE ocrJobs SET status='queued', progress='' WHERE jobId=?", 
+                                       (job["jobId"],))
+
+            nbRunningJobs = connection.execute("SELECT COUNT(*) FROM ocrJobs "
+                                               "WHERE status='running'").fetchone()[0]
+            job = None
+            if nbRunningJobs < self.nbWorkers:
+                job = connection.execute("SELECT * FROM ocrJobs WHERE status='queued' "
+                                         "ORDER BY submitted LIMIT 1").fetchone()
+            if not job is None:
+                connection.execute("UPDATE ocrJobs SET status='running', started=?, owner=?, "
+                                   "leaseExpiry=? WHERE jobId=?", 
+                                   (now, os.getpid(), now + self.leaseDuration, job["jobId"]))
+            connection.execute("COMMIT")
+            return None if job is None else dict(job)
+        finally:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            connection.close()
+
+
+    def __work(self):
+        while not self.__stopped:
+            job = self.__claimNext()
+            if job is None:
+                with self.__newJob:
+                    if not self.__stopped:
+                        self.__newJob.wait(self.pollInterval)
+                continue
+            self.__run(job["jobId"], job["fileName"])
+
+
+    def __renewLeases(self):
+        while not self.__stopped or len(self.__runningJobs):
+            with self.__lock:
+                jobIds = list(self.__runningJobs)
+            for jobId in jobIds:
+                self.__execute("UPDATE ocrJobs SET leaseExpiry=? WHERE jobId=? AND "
+                               "status='running' AND owner=?", 
+                               (time.time() + self.leaseDuration, jobId, os.getpid()))
+            with self.__newJob:
+                if not self.__stopped:
+                    self.__newJob.wait(self.leaseDuration/4)
+
+
+    def __run(self, jobId, fileName):
+        with self.__lock:
+            self.__runningJobs.add(jobId)
+        try:
+            self.runJob(fileName, lambda progress: self.__update(jobId, progress=progress))
+        except Exception as error:
+            self.__update(jobId, status="failed", error=str(error), finished=time.time())
+        else:
+            self.__update(jobId, status="done", progress="", finished=time.time())
+        finally:
+            with self.__lock:
+                self.__runningJobs.discard(jobId)
+        # A running slot is free for the jobs queued by all the processes.
+        with self.__newJob:
+            self.__newJob.notify_all()
+
+
+    def submit(self, fileName):
+        """
+         Queue an OCR job for the file and return its id. If a job is already
+         queued or running for this file, its id is returned instead.
+         Raise OCRQueueFullError if maxQueueSize jobs are already pending.
+        """
+        # The checks and the insertion are done in a single write transaction
+        # since other processes might submit jobs at the same time.
+        with self.__lock:
+            connection = self.__connect()
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                jobs = connection.execute("SELECT jobId FROM ocrJobs WHERE fileName=? AND "
+                                          "status IN (?, ?)", (fileName,) + self.activeStatuses).fetchall()
+                if len(jobs):
+                    connection.execute("COMMIT")
+                    return jobs[0]["jobId"]
+
+                nbPendingJobs = connection.execute("SELECT COUNT(*) FROM ocrJobs WHERE status IN (?, ?)",
+                                                   self.activeStatuses).fetchone()[0]
+                if nbPendingJobs >= self.maxQueueSize:
+                    connection.execute("COMMIT")
+                    raise OCRQueueFullError("The OCR queue is full (" + str(self.maxQueueSize) +
+                                            " pending jobs). Retry later.")
+
+                jobId = uuid.uuid4().hex
+                connection.execute("INSERT INTO ocrJobs (jobId, fileName, status, progress, "
+                                   "error, submitted) VALUES (?, ?, 'queued', '', '', ?)",
+                                   (jobId, fileName, time.time()))
+                connection.execute("COMMIT")
+            finally:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                connection.close()
+
+        with self.__newJob:
+            self.__newJob.notify()
+        return jobId
+
+
+    def job(self, jobId):
+        jobs = self.__execute("SELECT * FROM ocrJobs WHERE jobId=?", (jobId,))
+        return jobs[0] if jobs else None
+
+
+    def lastJob(self, fileName):
+        jobs = self.__execute("SELECT * FROM ocrJobs WHERE fileName=? "
+                              "ORDER BY submitted DESC LIMIT 1", (fileName,))
+        return jobs[0] if jobs else None
+
+
+    def nbPendingJobs(self):
+        return len(self.__execute("SELECT jobId FROM ocrJobs WHERE status IN (?, ?)",
+                                  self.activeStatuses))
+
+
+    def shutdown(self, wait=True):
+        """
+         Stop claiming jobs. The running jobs are completed; if wait is 
+         True, this method returns once they are.
+        """
+        with self.__newJob:
+            self.__stopped = True
+            self.__newJob.notify_all()
+        if wait:
+            for worker in self.__workers:
+                worker.join()
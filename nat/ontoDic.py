@@ -7,11 +7,11 @@ Created on Tue Sep  6 11:19:26 2016
 
 from .tagUtilities import nlx2ks
 from .ontoServ import getLabelFromCurie
-import collections
+import collections.abc
 import warnings
 
 # From http://stackoverflow.com/a/3387975/1825043
-class TransformedDict(collections.MutableMapping):
+class TransformedDict(collections.abc.MutableMapping):
     """A dictionary that applies an arbitrary key-altering
        function before accessing the keys"""
 
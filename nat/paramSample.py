@@ -5,22 +5,28 @@ Created on Tue Aug 15 17:14:30 2017
 @author: oreilly
 """
 
+import hashlib
 import json
 import os
+import pickle
 from copy import copy, deepcopy
+from glob import glob
+from tempfile import NamedTemporaryFile
 
 import numpy as np
+import pandas as pd
 from quantities import Quantity
 
 from nat.utils import data_directory
 from .ageResolver import AgeResolver
-from .aggregators import SampleAggregator
+from .aggregators import SampleAggregator, aggregateSample
 from .annotationSearch import ParameterGetter
 from .annotationSearch import ParameterSearch
+from .annotationSearch import getCorpusVersion
 from .condition import Condition
 from .modelingParameter import getParameterTypeIDFromName, getParameterTypeNameFromID
 from .paramDesc import ParamDescTrace
-from .treeData import getChildren
+from .treeData import getDescendantIds, getOntologyVersion
 from .values import ValuesSimple, ValuesCompound
 from .variable import NumericalVariable
 from .zotero_wrap import ZoteroWrap
@@ -29,7 +35,41 @@ from nat import utils
 
 class ParamSample:
 
-    def __init__(self, searcher=None, library_id=None, library_type=None, api_key=None):
+    # The validity of the rows is tracked in the integer column "status" of 
+    # sampleDF. Each reason for invalidating a row is registered with its own
+    # bit. The lowest bit flags rows whose validity has not been determined 
+    # yet (see validateUndefined()). A row is valid if its status is 0. The
+    # bits are keyed by reason code; the details of a reason that vary from 
+    # row to row (e.g., the unit) are kept apart, by row.
+    STATUS_UNDEFINED = 1
+    maxStatusReasons = 62
+
+    # Maximal size in bytes of the memoized plan results of cacheDir. The 
+    # least recently used ones are removed beyond it.
+    maxCacheSize = 2**30
+
+    def __init__(self, searcher=None, library_id=None, library_type=None, api_key=None, 
+                 lazy=False, cacheDir=None):
+
+        # In lazy mode, the search and the operations are only recorded in a 
+        # plan which is executed when sampleDF (or the report) is requested.
+        # The result of every executed plan prefix is memoized in cacheDir
+        # (no memoization if None).
+        self.lazy = lazy
+        self.cacheDir = cacheDir
+        self.__sampleDF = None
+        self.__searcher = None
+        self.__nbExecuted = 0
+        self.__executing = False
+        self.__planVersions = None
+        self.__statusReasons = {}
+        self.__statusDetails = {}
+        self.__operations = []
+
+        # Incremented each time sampleDF changes. Aggregated values are 
+        # cached until then.
+        self.__version = 0
+        self.__aggregatedVersion = None
 
         self.setSearchAttributes(searcher)
         self.setZoteroLib(library_id, library_type, api_key)
@@ -44,13 +84,17 @@ class ParamSample:
 
         self.__aggregators = {}
 
-        self.__operations = []
-
 
     def copy(self):
         # A bit intricated because we cannot deepcopy pandas DataFrames
         copiedSample = copy(self)
         copiedSample.sampleDF = self.sampleDF.copy()
+
+        # The containers modified in place must not be shared with the copy.
+        copiedSample.__operations    = list(self.__operations)
+        copiedSample.__statusReasons = dict(self.__statusReasons)
+        copiedSample.__statusDetails = dict(self.__statusDetails)
+        copiedSample.__aggregators   = dict(self.__aggregators)
         copiedSample.zotWrap  = self.setZoteroLib(self.library_id, self.library_type, self.api_key)
         return copiedSample
 
@@ -70,30 +114,275 @@ class ParamSample:
 
     def setSearchAttributes(self, searcher):
         if not searcher is None:
-            self.sampleDF            = searcher.search()
-            self.searchConditions    = searcher.conditions
-            self.onlyCentralTendancy = searcher.onlyCentralTendancy
-            self.pathDB              = searcher.pathDB
-            self.expandRequiredTags  = searcher.expandRequiredTags
-
-            self.sampleDF["isValid"] = None
-            self.sampleDF["statusStr"] = ""
-            self.__report = "Search string: " + str(self.searchConditions) + "\n"
-            if self.onlyCentralTendancy:
-                self.__report = "Search : Using central tendencies for single annotations containing multiple values.\n"
+            self.__searcher = searcher
+            self.__setSearchParameters(searcher.conditions, searcher.onlyCentralTendancy, 
+                                       searcher.pathDB, searcher.expandRequiredTags)
+            if not self.lazy:
+                self.__runSearch()
 
     def setSearchAttributes_withoutSearcher(self, pathDB, searchCondition, 
                                             onlyCentralTendancy=True, expandRequiredTags=True):
+        if self.lazy:
+            # The searcher loads the whole corpus. It is only built if the 
+            # search needs to be run when the plan is executed.
+            self.__searcher = None
+            self.__setSearchParameters(searchCondition, onlyCentralTendancy, 
+                                       pathDB, expandRequiredTags)
+            return
+
+        self.setSearchAttributes(self.__buildSearcher(pathDB, searchCondition, 
+                                                      onlyCentralTendancy, expandRequiredTags))
+
+
+    @staticmethod
+    def __buildSearcher(pathDB, searchCondition, onlyCentralTendancy, expandRequiredTags):
         searcher = ParameterSearch(pathDB=pathDB)
         searcher.setSearchConditions(searchCondition)
         searcher.expandRequiredTags = expandRequiredTags
         searcher.onlyCentralTendancy = onlyCentralTendancy
-        self.setSearchAttributes(searcher)
+        return searcher
+
+
+    def __setSearchParameters(self, searchConditions, onlyCentralTendancy, pathDB, expandRequiredTags):
+        self.searchConditions    = searchConditions
+        self.onlyCentralTendancy = onlyCentralTendancy
+        self.pathDB              = pathDB
+        self.expandRequiredTags  = expandRequiredTags
+
+        # Condition as specified by the user, before the search expands it
+        # with equivalent terms. Used to identify memoized plan results.
+        self.__searchConditionsJSON = searchConditions.toJSON()
+        self.__sampleDF   = None
+        self.__nbExecuted = 0
+
+        self.__report = "Search string: " + str(self.searchConditions) + "\n"
+        if self.onlyCentralTendancy:
+            self.__report = "Search : Using central tendencies for single annotations containing multiple values.\n"
+
+
+    def __runSearch(self):
+        if self.__searcher is None:
+            self.__searcher = self.__buildSearcher(self.pathDB, self.searchConditions, 
+                                                   self.onlyCentralTendancy, self.expandRequiredTags)
+
+        self.__sampleDF       = self.__searcher.search()
+        self.__version       += 1
+        self.searchConditions = self.__searcher.conditions
+
+        self.__sampleDF["status"] = np.full(len(self.__sampleDF), self.STATUS_UNDEFINED, dtype=np.int64)
+        self.__statusReasons = {}
+        self.__statusDetails = {}
+
+
+    @property
+    def sampleDF(self):
+        if self.lazy and not self.__executing:
+            self.execute()
+        return self.__sampleDF
+
+    @sampleDF.setter
+    def sampleDF(self, sampleDF):
+        self.__sampleDF = sampleDF
+        self.__version += 1
+
+
+    @property
+    def version(self):
+        """
+        Counter incremented each time the sample is modified through the 
+        methods of ParamSample. Modifying sampleDF in place directly is not 
+        tracked; call touch() afterward in that case.
+        """
+        return self.__version
+
+
+    def touch(self):
+        self.__version += 1
+
+
+    def __recordOperation(self, operation):
+        """
+        Record the operation in the list of operations of the sample. Return
+        True if its execution is deferred (lazy mode), in which case the 
+        calling method must return without processing the sample.
+        """
+        if self.__executing:
+            # Operations run internally by an operation of the plan 
+            # (e.g., preprocess_age running preprocess_species).
+            return False
+        self.__operations.append(operation)
+        if self.lazy:
+            return True
+        self.__nbExecuted = len(self.__operations)
+        self.__version += 1
+        return False
+
+
+    def __statusBit(self, code, message):
+        """
+        Return the status bit of the reason code, registering it with its
+        message if needed.
+        """
+        if not code in self.__statusReasons:
+            if len(self.__statusReasons) >= self.maxStatusReasons:
+                raise ValueError("Too many status reasons registered. At most " +
+                                 str(self.maxStatusReasons) + " reasons are supported.")
+            self.__statusReasons[code] = (self.STATUS_UNDEFINED << (len(self.__statusReasons) + 1), message)
+        return self.__statusReasons[code][0]
+
+
+    def __invalidate(self, mask, code, message, details=None):
+        """
+        Mark as invalid the rows of sampleDF selected by the boolean mask, 
+        setting the bit of the reason code in their status. If details is 
+        not None, message is a template whose "{}" is replaced by the details
+        of the row (the same for all the rows if details is a scalar). The 
+        details first recorded for a row are kept.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            return
+        bit = self.__statusBit(code, message)
+        status = self.__sampleDF["status"].values.copy()
+        status[mask] |= bit
+        self.__sampleDF["status"] = status
+
+        if not details is None:
+            if np.ndim(details):
+                details = np.asarray(details, dtype=object)[mask]
+            rowDetails = pd.Series(details, index=self.__sampleDF.index[mask], dtype=object)
+            if code in self.__statusDetails:
+                rowDetails = self.__statusDetails[code].combine_first(rowDetails)
+            self.__statusDetails[code] = rowDetails
+
+
+    def plan(self):
+        """
+        Return the operations of the plan that are still to be executed.
+        """
+        return self.__operations[self.__nbExecuted:]
+
+
+    def execute(self):
+        """
+        Execute the pending operations of the plan. The longest prefix of 
+        the plan whose result has been memoized in cacheDir is loaded instead
+        of being recomputed.
+        """
+        if self.__sampleDF is not None and self.__nbExecuted == len(self.__operations):
+            return
+
+        self.__executing = True
+        # The versions of the corpus and of the ontology are read once for
+        # all the plan prefixes looked up and memoized.
+        self.__planVersions = {"corpusVersion"  : getCorpusVersion(self.pathDB),
+                               "ontologyVersion": getOntologyVersion()}
+        try:
+            if self.__sampleDF is None:
+                self.__nbExecuted = 0
+                for nbOperations in range(len(self.__operations), -1, -1):
+                    if self.__loadCachedState(nbOperations):
+                        self.__nbExecuted = nbOperations
+                        break
+                else:
+                    self.__runSearch()
+                    self.__cacheState(0)
+
+            while self.__nbExecuted < len(self.__operations):
+                self.performOperation(self.__operations[self.__nbExecuted])
+                self.__nbExecuted += 1
+                self.__version += 1
+                self.__cacheState(self.__nbExecuted)
+        finally:
+            self.__executing = False
+            self.__planVersions = None
+
+
+    def __planKey(self, nbOperations):
+        plan = {"searchCondition"    : self.__searchConditionsJSON,
+                "onlyCentralTendancy": self.onlyCentralTendancy,
+                "expandRequiredTags" : self.expandRequiredTags,
+                "corpusVersion"      : self.__planVersions["corpusVersion"],
+                "ontologyVersion"    : self.__planVersions["ontologyVersion"],
+                "ageUnit"            : self.ageUnit,
+                "ageTypeValue"       : self.ageTypeValue,
+                "operations"         : self.__operations[:nbOperations]}
+        planStr = json.dumps(plan, sort_keys=True, default=str)
+        return hashlib.sha1(planStr.encode("utf-8")).hexdigest()
+
+
+    def __cachePath(self, nbOperations):
+        return os.path.join(self.cacheDir, self.__planKey(nbOperations) + ".pkl")
+
+
+    def __cacheState(self, nbOperations):
+        if self.cacheDir is None:
+            return
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        state = {"sampleDF"        : self.__sampleDF,
+                 "statusReasons"   : self.__statusReasons,
+                 "statusDetails"   : self.__statusDetails,
+                 "searchConditions": self.searchConditions,
+                 "report"          : self.__report,
+                 "attributes"      : {attr: getattr(self, attr) for attr in ["rootSpeciesId", "interpValues"]
+                                                                if hasattr(self, attr)}}
+        # Written to a unique temporary file first, since other processes 
+        # might read or write the same plan result.
+        with NamedTemporaryFile("wb", dir=self.cacheDir, suffix=".tmp", delete=False) as cacheFile:
+            pickle.dump(state, cacheFile)
+        os.replace(cacheFile.name, self.__cachePath(nbOperations))
+        self.__evictCachedStates()
+
+
+    def __evictCachedStates(self):
+        # Least recently used (written or loaded) plan results first.
+        entries = []
+        for fileName in glob(os.path.join(self.cacheDir, "*.pkl")):
+            try:
+                fileStat = os.stat(fileName)
+            except FileNotFoundError:
+                continue
+            entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+
+        excess = sum(size for _, size, _ in entries) - self.maxCacheSize
+        for _, size, fileName in sorted(entries):
+            if excess <= 0:
+                break
+            try:
+                os.remove(fileName)
+            except FileNotFoundError:
+                pass
+            excess -= size
+
+
+    def __loadCachedState(self, nbOperations):
+        if self.cacheDir is None:
+            return False
+        cachePath = self.__cachePath(nbOperations)
+        try:
+            with open(cachePath, "rb") as cacheFile:
+                state = pickle.load(cacheFile)
+            # Recently used results are evicted last.
+            os.utime(cachePath)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+        self.__sampleDF       = state["sampleDF"]
+        self.__version       += 1
+        self.__statusReasons  = state["statusReasons"]
+        self.__statusDetails  = state["statusDetails"]
+        self.searchConditions = state["searchConditions"]
+        self.__report         = state["report"]
+        for attr, value in state["attributes"].items():
+            setattr(self, attr, value)
+        return True
 
 
 
     def rescaleUnit(self, unit, rescaleStereo=True):
-        self.__operations.append(["rescaleUnit", unit, rescaleStereo])   
+        if self.__recordOperation(["rescaleUnit", unit, rescaleStereo]):
+            return
         
         def rescale2DStereo(paramID, thicknessValue, thicknessUnit, desiredUnit):
             density = paramGetter.getParam(paramID)
@@ -106,9 +395,11 @@ class ParamSample:
             self.__report += "Rescaling densities from 2D densities to 3D.\n"              
         
         paramGetter = ParameterGetter(pathDB=self.pathDB)
-        for param, annot, (index, row) in zip(self.sampleDF["obj_parameter"], 
-                                              self.sampleDF["obj_annotation"], 
-                                              self.sampleDF.iterrows()):
+        params        = self.sampleDF["obj_parameter"].values.copy()
+        cannotRescale = np.zeros(len(params), dtype=bool)
+        rescaled      = np.zeros(len(params), dtype=bool)
+        for ind, (param, annot) in enumerate(zip(self.sampleDF["obj_parameter"].values, 
+                                                 self.sampleDF["obj_annotation"].values)):
             if param.unit == unit:
                 continue
                                                   
@@ -123,35 +414,36 @@ class ParamSample:
                     if len(thicknessInstanceId) == 1:
                         thicknessParameter = paramGetter.getParam(thicknessInstanceId[0])
                         if len(thicknessParameter.values) == 1:
-                            param = rescale2DStereo(param.id, thicknessValue=thicknessParameter.values[0], 
-                                                    thicknessUnit=thicknessParameter.unit, 
-                                                    desiredUnit=unit)
-                            self.sampleDF.loc[index, "obj_parameter"] = param   
-                            self.sampleDF.loc[index, "Values"]        = param.valuesText()   
-                            self.sampleDF.loc[index, "Unit"]          = param.unit                   
+                            params[ind] = rescale2DStereo(param.id, thicknessValue=thicknessParameter.values[0], 
+                                                          thicknessUnit=thicknessParameter.unit, 
+                                                          desiredUnit=unit)
+                            rescaled[ind] = True
                             continue
                 
-                statusStr = "Cannot be rescaled to unit " + str(unit) + "\n"
-                self.sampleDF.loc[index, "isValid"]   = False
-                self.sampleDF.loc[index, "statusStr"] += statusStr
+                cannotRescale[ind] = True
                 continue                
 
             if Quantity(1, param.unit) != Quantity(1, unit):
-                statusStr = "Cannot be rescaled to unit " + str(unit) + "\n"
-                self.sampleDF.loc[index, "isValid"]   = False
-                self.sampleDF.loc[index, "statusStr"] += statusStr
+                cannotRescale[ind] = True
                 continue                            
                 
-            self.sampleDF.loc[index, "obj_parameter"] = param   
-            self.sampleDF.loc[index, "Values"]        = param.valuesText()   
-            self.sampleDF.loc[index, "Unit"]          = param.unit   
+            params[ind]   = param
+            rescaled[ind] = True
+
+        if rescaled.any():
+            self.sampleDF["obj_parameter"] = params
+            self.sampleDF.loc[rescaled, "Values"] = [param.valuesText() for param in params[rescaled]]
+            self.sampleDF.loc[rescaled, "Unit"]   = [param.unit for param in params[rescaled]]
+
+        self.__invalidate(cannotRescale, "rescale_unit", "Cannot be rescaled to unit {}.", str(unit))
 
 
 
 
 
     def reformatAsNumericalTraces(self, indepVarName = None, indepVarId = None):
-        self.__operations.append(["reformatAsNumericalTraces", indepVarName, indepVarId])   
+        if self.__recordOperation(["reformatAsNumericalTraces", indepVarName, indepVarId]):
+            return
             
         if not indepVarName is None:
             if not indepVarId is None:
@@ -174,55 +466,55 @@ class ParamSample:
                              + indepVarId + "'.\n"                        
 
                 
-        for index, row in self.sampleDF.iterrows():
-        
-            if row["Result type"] == "pointValue":
-                indepVar = row[indepVarName]
-                if indepVar is None:
-                    statusStr = "Cannot be transformed to a numerical trace: no values for the independant variable.\n"
-                    self.sampleDF.loc[index, "isValid"]   = False
-                    self.sampleDF.loc[index, "statusStr"] += statusStr
-                    continue                   
-                                
-                # Building the independant variables   
-                if isinstance(indepVar.magnitude.tolist(), list):
-                    indepValueLst = indepVar.magnitude.tolist()
+        isPointValue = (self.sampleDF["Result type"] == "pointValue").values
+        noIndepVar   = isPointValue & self.sampleDF[indepVarName].isnull().values
+        self.__invalidate(noIndepVar, "no_independent_variable", "Cannot be transformed to a numerical "
+                                      "trace: no values for the independant variable.")
+
+        toReformat = isPointValue & ~noIndepVar
+        for param, indepVar in zip(self.sampleDF["obj_parameter"].values[toReformat],
+                                   self.sampleDF[indepVarName].values[toReformat]):
+
+            # Building the independant variables   
+            if isinstance(indepVar.magnitude.tolist(), list):
+                indepValueLst = indepVar.magnitude.tolist()
+            else:
+                indepValueLst = [float(indepVar)]
+            
+            indepValues = ValuesSimple(indepValueLst, unit=str(indepVar.dimensionality))
+
+            indepVar = NumericalVariable(typeId = indepVarId, 
+                                         values = indepValues)
+
+            # Building the dependant variable 
+            depVar   = param.description.depVar   
+            if len(depVar.values) != len(indepValueLst): 
+                if len(indepValueLst) == 1:
+                    centralTendancy, statCT = param.centralTendancy(returnStat=True)  
+                    deviation, statDev      = param.deviation(returnStat=True)  
+                    size                    = param.size()  
+                    depUnit  = param.unit                        
+                    
+                    depValueLst = [ValuesSimple([centralTendancy],
+                                                 unit=depUnit, 
+                                                 statistic=statCT),
+                                   ValuesSimple([deviation],
+                                                 unit=depUnit, 
+                                                 statistic=statDev),
+                                   ValuesSimple([size],
+                                                 unit="dimensionless", 
+                                                 statistic="N")]
+
+                    depVar = NumericalVariable(typeId = depVar.typeId, 
+                                               values = ValuesCompound(depValueLst))
+                    
                 else:
-                    indepValueLst = [float(indepVar)]
-                
-                indepValues = ValuesSimple(indepValueLst, unit=str(indepVar.dimensionality))
-
-                indepVar = NumericalVariable(typeId = indepVarId, 
-                                             values = indepValues)
-
-                # Building the dependant variable 
-                depVar   = row["obj_parameter"].description.depVar   
-                if len(depVar.values) != len(indepValueLst): 
-                    if len(indepValueLst) == 1:
-                        centralTendancy, statCT = row["obj_parameter"].centralTendancy(returnStat=True)  
-                        deviation, statDev      = row["obj_parameter"].deviation(returnStat=True)  
-                        size                    = row["obj_parameter"].size()  
-                        depUnit  = row["obj_parameter"].unit                        
-                        
-                        depValueLst = [ValuesSimple([centralTendancy],
-                                                     unit=depUnit, 
-                                                     statistic=statCT),
-                                       ValuesSimple([deviation],
-                                                     unit=depUnit, 
-                                                     statistic=statDev),
-                                       ValuesSimple([size],
-                                                     unit="dimensionless", 
-                                                     statistic="N")]
-
-                        depVar = NumericalVariable(typeId = depVar.typeId, 
-                                                   values = ValuesCompound(depValueLst))
-                        
-                    else:
-                        raise ValueError("Ambiguous attemps to transform a parameter into a numerical trace.")
-                        
-                # Building the numerical trace parameter
-                row["obj_parameter"].description = ParamDescTrace(depVar, [indepVar])
-                row["Result type"] = "numericalTrace"
+                    raise ValueError("Ambiguous attemps to transform a parameter into a numerical trace.")
+                    
+            # Building the numerical trace parameter
+            param.description = ParamDescTrace(depVar, [indepVar])
+
+        self.sampleDF.loc[toReformat, "Result type"] = "numericalTrace"
 
 
         
@@ -232,79 +524,66 @@ class ParamSample:
         
     
     def preprocess_species(self):
-        self.__operations.append(["preprocess_species"])   
+        if self.__recordOperation(["preprocess_species"]):
+            return
         
-        speciesId = []
-        species   = []
-        for index, row in self.sampleDF.iterrows():
-            tags =row["Species"]
-            if len(tags) > 1 :                
-                statusStr = "Species ambiguous. More than one species associated to the annotation.\n"
-                self.sampleDF.loc[index, "isValid"]   = False
-                self.sampleDF.loc[index, "statusStr"] += statusStr                
-                speciesId.append("")
-                species.append("")                
-                continue
-                
-            speciesId.append(tags[0].id)
-            species.append(tags[0].name)
-            
-        self.sampleDF["SpeciesId"] = speciesId
-        self.sampleDF["Species"]   = species
+        tags      = self.sampleDF["Species"].values
+        nbTags    = np.array([len(tag) for tag in tags], dtype=int)
+        ambiguous = nbTags > 1
+        self.__invalidate(ambiguous, "species_ambiguous", "Species ambiguous. More than one species "
+                                                          "associated to the annotation.")
+
+        self.sampleDF["SpeciesId"] = [tag[0].id   if nb == 1 else "" for tag, nb in zip(tags, nbTags)]
+        self.sampleDF["Species"]   = [tag[0].name if nb == 1 else "" for tag, nb in zip(tags, nbTags)]
         
         self.__report += "Extracting species from annotations.\n"                  
 
 
     def preprocess_age(self):    
-        self.__operations.append(["preprocess_age"])           
+        if self.__recordOperation(["preprocess_age"]):
+            return
         
         if not "SpeciesId" in self.sampleDF:
             self.preprocess_species()
-            
-        ageCategoryIds = []
-        ageCategories  = []
-        numericalAges  = []
-        for index, row in self.sampleDF.iterrows():
-            
-            # First check if an experimental property with age as been attributed to the record            
-            ageExpProp = [expProp.instanceId for expProp in row["obj_annotation"].experimentProperties if expProp.paramTypeId == 'BBP-002001']
-            if len(ageExpProp) > 1 :
-                statusStr = "Age is ambiguous. More than one age experimentation property is associated with the annotation.\n"
-                self.sampleDF.loc[index, "isValid"]   = False
-                self.sampleDF.loc[index, "statusStr"] += statusStr                
-                continue   
-            
-            if len(ageExpProp) == 1 :
-                getter = ParameterGetter(pathDB=self.pathDB)
-                
-                ageParam = getter.getParam(ageExpProp[0])
-                
-                ageCategoryIds.append(None)
-                ageCategories.append(None)        
+
+        # Instance IDs of the age experimental properties ('BBP-002001') 
+        # attributed to each record.
+        ageExpProps = [[expProp.instanceId for expProp in annot.experimentProperties 
+                                           if expProp.paramTypeId == 'BBP-002001']
+                       for annot in self.sampleDF["obj_annotation"].values]
+        nbAgeExpProps = np.array([len(props) for props in ageExpProps], dtype=int)
+        self.__invalidate(nbAgeExpProps > 1, "age_property_ambiguous", 
+                          "Age is ambiguous. More than one age experimentation "
+                          "property is associated with the annotation.")
+
+        # Records without age experimental property use the age category, if any.
+        ageTags = self.sampleDF["AgeCategories"].values
+        nbAgeTags = np.array([len(tags) for tags in ageTags], dtype=int)
+        useCategory = (nbAgeExpProps == 0) & (nbAgeTags > 0)
+        self.__invalidate(useCategory & (nbAgeTags > 1), "age_category_ambiguous", 
+                          "Age is ambiguous. More than one age category is associated with the annotation.")
+
+        ageCategoryIds = np.array([tags[0].id   if use else None for tags, use in zip(ageTags, useCategory)], dtype=object)
+        ageCategories  = np.array([tags[0].name if use else None for tags, use in zip(ageTags, useCategory)], dtype=object)
+        numericalAges  = np.full(len(self.sampleDF), None, dtype=object)
+
+        # Age categories are resolved by a join with the age resolution table.
+        numericalAges[useCategory] = AgeResolver.resolve(self.sampleDF["SpeciesId"].values[useCategory], 
+                                                         ageCategoryIds[useCategory], 
+                                                         unit=self.ageUnit, typeValue=self.ageTypeValue)
+
+        # Ages from experimental properties. The parameter getter loads the 
+        # whole corpus, so it is created only if needed.
+        useExpProp = np.flatnonzero(nbAgeExpProps == 1)
+        if len(useExpProp):
+            getter = ParameterGetter(pathDB=self.pathDB)
+            for ind in useExpProp:
+                ageParam = getter.getParam(ageExpProps[ind][0])
                 try:
-                    numericalAges.append(Quantity(ageParam.centralTendancy(), ageParam.unit).rescale(self.ageUnit))
+                    numericalAges[ind] = Quantity(ageParam.centralTendancy(), ageParam.unit).rescale(self.ageUnit)
                 except ValueError:
-                    raise ValueError("Issue encountered while processing annotation Parameter instance ID: " + str(self.sampleDF.loc[index, "Parameter instance ID"]))
-
-            # No experimental property attributed. Check to use a age category if one has been attributed.
-            else:
-                tags = row["AgeCategories"]
-                if len(tags) > 1 :
-                    statusStr = "Age is ambiguous. More than one age category is associated with the annotation.\n"
-                    self.sampleDF.loc[index, "isValid"]   = False
-                    self.sampleDF.loc[index, "statusStr"] += statusStr                               
-                    
-                if len(tags) == 0:
-                    ageCategoryIds.append(None)
-                    ageCategories.append(None)
-                    numericalAges.append(None)
-                    continue
-                
-                ageCategoryIds.append(tags[0].id)
-                ageCategories.append(tags[0].name)
-                age = AgeResolver.resolve_fromIDs(row["SpeciesId"], tags[0].id, unit=self.ageUnit, 
-                                                  typeValue=self.ageTypeValue) 
-                numericalAges.append(age)
+                    raise ValueError("Issue encountered while processing annotation Parameter instance ID: " + 
+                                     str(self.sampleDF["Parameter instance ID"].values[ind]))
 
         self.sampleDF["AgeCategoryId"] = ageCategoryIds
         self.sampleDF["AgeCategory"]   = ageCategories
@@ -317,50 +596,61 @@ class ParamSample:
 
     
     def preprocess_ref(self):    
-        self.__operations.append(["preprocess_ref"])     
+        if self.__recordOperation(["preprocess_ref"]):
+            return
         
         if self.zotWrap is None:
             raise ValueError("To add references to the sample, you need first to set " +
                              "the Zotero library by calling LitSample.setZoteroLib()")
 
-        self.sampleDF["ref"] = [self.zotWrap.reference_creators_citation(annot.pubId)
-                                           for annot in self.sampleDF["obj_annotation"]]
+        self.sampleDF["ref"] = self.zotWrap.citations([annot.pubId for annot in self.sampleDF["obj_annotation"]])
     
         self.__report += "Preprocessing associated references.\n"            
     
         
     def filter_species(self, speciesTermId):
-        self.__operations.append(["filter_species", speciesTermId])     
+        if self.__recordOperation(["filter_species", speciesTermId]):
+            return
         
         self.rootSpeciesId = speciesTermId
-        childrenDict = getChildren(speciesTermId)
 
         if not "SpeciesId" in self.sampleDF:
             self.preprocess_species()
             
-        for index, row in self.sampleDF.iterrows():
-
-            if not row["SpeciesId"] in childrenDict:
-                statusStr = "Species filtered out. Not a children of " + speciesTermId + ".\n"
-                row["isValid"]   = False
-                row["statusStr"] += statusStr                
+        filteredOut = ~self.sampleDF["SpeciesId"].isin(getDescendantIds(speciesTermId)).values
+        self.__invalidate(filteredOut, "species_filtered_out", 
+                          "Species filtered out. Not a children of {}.", speciesTermId)
 
         self.__report += "Filter species using the species ID '" + speciesTermId + "'.\n"            
 
 
         
     def validateUndefined(self):
-        self.__operations.append(["validateUndefined"])          
+        if self.__recordOperation(["validateUndefined"]):
+            return
         
-        self.sampleDF.loc[np.equal(self.sampleDF["isValid"], None), "isValid"] = True
+        # Rows with other status bits set stay invalid because of these bits.
+        self.sampleDF["status"] = self.sampleDF["status"].values & ~self.STATUS_UNDEFINED
 
         self.__report += "Validated parameters with undefined status.\n"     
 
 
     def addAggregator(self, aggregator):        
         self.__aggregators[aggregator.paramName] = aggregator
-        self.__report += "Adding an aggregator for parameter '" + aggregator.paramName + \
-                         "':" + str(aggregator) + ".\n"            
+        self.__aggregatedVersion = None
+
+
+    def aggregate(self):
+        """
+        Run all the registered aggregators in a single pass over the sample.
+        Results are reused until the sample or the aggregators change.
+        """
+        if self.lazy:
+            self.execute()
+        if self.__aggregatedVersion == self.__version:
+            return
+        aggregateSample(self, list(self.__aggregators.values()))
+        self.__aggregatedVersion = self.version
         
     def getParamValues(self, paramName=None, paramId=None, useOnlyValids=True):
         """
@@ -381,7 +671,7 @@ class ParamSample:
         
         df = self.sampleDF
         if useOnlyValids:
-            df = df[df["isValid"] == True]
+            df = df[self.isValid]
 
         df.loc[:, "paramNames"] = [getParameterTypeNameFromID(param.typeId) for param in df["obj_parameter"]]
 
@@ -394,7 +684,8 @@ class ParamSample:
         for the independant variable for which interpolation should be run and
         the values are the value to which the parameter should be interpolated.
         """        
-        self.__operations.append(["interpolate", interpValues])          
+        if self.__recordOperation(["interpolate", interpValues]):
+            return
         
         df = self.sampleDF
         self.interpValues = interpValues
@@ -418,19 +709,97 @@ class ParamSample:
         aggregation method specified by the associated aggregator.
         """        
         
-        return self.__aggregators[paramName].values(self)
+        self.aggregate()
+        return self.__aggregators[paramName].values()
+
+    @property 
+    def isValid(self):
+        """
+        Boolean series indicating the valid rows of sampleDF.
+        """
+        return self.sampleDF["status"] == 0
 
     @property 
     def validSample(self):
-        return self.sampleDF.loc[self.sampleDF["isValid"]]
+        return self.sampleDF.loc[self.isValid]
         
     @property 
     def invalidSample(self):
-        return self.sampleDF.loc[np.logical_not(self.sampleDF["isValid"])]
+        return self.sampleDF.loc[~self.isValid]
+
+
+    def __reasons(self):
+        # (bit, code, message, details by row or None) of every reason.
+        reasons = [(self.STATUS_UNDEFINED, "undefined", "Validity not yet determined.", None)]
+        reasons.extend([(bit, code, message, self.__statusDetails.get(code)) 
+                        for code, (bit, message) in self.__statusReasons.items()])
+        return reasons
+
+
+    def statusReasons(self):
+        """
+        Return a DataFrame of the registered status reasons with their bit,
+        code, message, and the number of rows flagged with them. For the 
+        reasons with details by row, the message lists the details of the
+        flagged rows.
+        """
+        rows     = self.sampleDF
+        reasons  = self.__reasons()
+        messages = []
+        for bit, _, message, details in reasons:
+            if not details is None:
+                flagged = (rows["status"].values & bit) != 0
+                rowDetails = details.reindex(rows.index).values[flagged]
+                message = message.format(", ".join(sorted(set(map(str, rowDetails)))))
+            messages.append(message)
+        return pd.DataFrame({"bit"    : [bit for bit, _, _, _ in reasons],
+                             "code"   : [code for _, code, _, _ in reasons],
+                             "message": messages,
+                             "count"  : [np.count_nonzero(rows["status"].values & bit) 
+                                         for bit, _, _, _ in reasons]})
+
+
+    def statusCounts(self):
+        """
+        Return the number of rows flagged with each status reason code.
+        """
+        reasons = self.statusReasons()
+        return reasons.groupby("code", sort=False)["count"].sum()
+
+
+    def statusStr(self, rows=None):
+        """
+        Return, as a series aligned with sampleDF (or with rows, a subset of
+        it), the text describing the status of each row. The text is only 
+        rendered when this method is called.
+        """
+        if rows is None:
+            rows = self.sampleDF
+        status = rows["status"].values
+
+        # The messages of each reason, None for the rows not flagged with it.
+        rowMessages = []
+        for bit, _, message, details in self.__reasons():
+            flagged = (status & bit) != 0
+            if not flagged.any():
+                continue
+            if details is None:
+                rowMessages.append([message if flag else None for flag in flagged])
+            else:
+                rowMessages.append([message.format(detail) if flag else None 
+                                    for flag, detail in zip(flagged, details.reindex(rows.index).values)])
+
+        texts = ["\n".join([message for message in messages if not message is None]) 
+                 for messages in zip(*rowMessages)] if len(rowMessages) else [""]*len(rows)
+        return pd.Series(texts, index=rows.index)
 
     @property 
     def report(self):
-        return self.__report
+        if self.lazy and not self.__executing:
+            self.execute()
+        return self.__report + "".join(["Adding an aggregator for parameter '" + paramName +
+                                        "':" + str(aggregator) + ".\n"
+                                        for paramName, aggregator in self.__aggregators.items()])
 
 
     def performOperation(self, operation):
@@ -438,9 +807,16 @@ class ParamSample:
 
 
     @staticmethod
-    def fromJSON(jsonParams):
+    def fromJSON(jsonParams, lazy=False, cacheDir=None):
+        """
+        Rebuild a sample from its JSON representation. The search and the 
+        operations are recorded as a plan. If lazy is False, the plan is 
+        executed immediately, reusing the results memoized in cacheDir (if 
+        any) for the longest matching prefix of the plan.
+        """
         paramSample = ParamSample(searcher=None, library_id=jsonParams["libraryId"], 
-                                  library_type=jsonParams["libraryType"], api_key=jsonParams["apiKey"])
+                                  library_type=jsonParams["libraryType"], api_key=jsonParams["apiKey"],
+                                  lazy=True, cacheDir=cacheDir)
         searchCondition = Condition.fromJSON(jsonParams["searchCondition"]) 
         paramSample.setSearchAttributes_withoutSearcher(jsonParams["pathDB"], searchCondition, 
                                                         jsonParams["onlyCentralTendancy"], 
@@ -451,7 +827,11 @@ class ParamSample:
 
         for operation in jsonParams["operations"]:
             paramSample.performOperation(operation)
-            
+
+        if not lazy:
+            paramSample.execute()
+            paramSample.lazy = False
+
         for aggJSON in jsonParams["aggregators"]:
             paramSample.addAggregator(SampleAggregator.fromJSON(jsonParams["aggregators"][aggJSON]))
 
@@ -485,6 +865,6 @@ class ParamSample:
                       
                       
     @staticmethod
-    def load(fileName):
+    def load(fileName, lazy=False, cacheDir=None):
         with open(fileName, "r") as inFile:        
-            return ParamSample.fromJSON(json.load(inFile))            
+            return ParamSample.fromJSON(json.load(inFile), lazy, cacheDir)            
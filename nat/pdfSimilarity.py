@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent TF-IDF index of the paper texts of the database, used to check
+the similarity of uploaded PDFs with the stored ones.
+"""
+
+import os
+import sqlite3
+import string
+from glob import glob
+from os.path import join, basename
+from threading import Lock
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def buildVectorizer(nbFeatures=2**20):
+    """
+     Return a vectorizer counting the stemmed words of a text. The feature
+     space is hashed so that it doesn't depend on the indexed texts.
+    """
+    import nltk
+    from sklearn.feature_extraction.text import HashingVectorizer
+
+    stemmer = nltk.stem.porter.PorterStemmer()
+    remove_punctuation_map = dict((ord(char), None) for char in string.punctuation)
+
+    # remove punctuation, lowercase, stem
+    def normalize(text):
+        return [stemmer.stem(item) for item in
+                nltk.word_tokenize(text.lower().translate(remove_punctuation_map))]
+
+    return HashingVectorizer(tokenizer=normalize, token_pattern=None, stop_words='english',
+                             n_features=nbFeatures, alternate_sign=False, norm=None)
+
+
+
+class SimilarityIndex:
+    """
+     Word counts of the texts (.txt) of a directory, stored in a SQLite file
+     with one row per paper and updated incrementally when texts are added,
+     modified or removed. The document frequencies of the words, from which 
+     the IDF weights are computed, are kept in memory and updated with the 
+     rows.
+    """
+
+    def __init__(self, pathDB, fileName="similarity_index.sqlite"):
+        self.pathDB     = pathDB
+        self.indexPath  = join(pathDB, fileName)
+        self.vectorizer = buildVectorizer()
+        self.__lock     = Lock()
+
+        self.__execute("CREATE TABLE IF NOT EXISTS papers (paperId TEXT PRIMARY KEY, "
+                       "mtime INTEGER, size INTEGER, features BLOB, counts BLOB)")
+
+        # paperId -> ((mtime, size), sparse row of word counts)
+        self.__entries  = {paperId: (signature, row) for paperId, signature, row in 
+                           map(self.__decodeRow, self.__execute("SELECT * FROM papers"))}
+        self.__docFreqs = np.zeros(self.vectorizer.n_features, dtype=np.int64)
+        for signature, row in self.__entries.values():
+            self.__docFreqs[row.indices] += 1
+
+
+    def __execute(self, query, parameters=(), many=False):
+        # A connection per call, since several server processes might 
+        # update the index at the same time.
+        connection = sqlite3.connect(self.indexPath, timeout=30)
+        try:
+            with connection:
+                if many:
+                    return connection.executemany(query, parameters).fetchall()
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+
+    def __decodeRow(self, row):
+        paperId, mtime, size, features, counts = row
+        features = np.frombuffer(features, dtype=np.int32)
+        counts   = np.frombuffer(counts, dtype=np.float32).astype(np.float64)
+        matrix   = sp.csr_matrix((counts, features, [0, len(features)]), 
+                                 shape=(1, self.vectorizer.n_features))
+        return paperId, (mtime, size), matrix
+
+
+    @staticmethod
+    def __encodeRow(paperId, signature, row):
+        return (paperId, signature[0], signature[1], 
+                row.indices.astype(np.int32).tobytes(), row.data.astype(np.float32).tobytes())
+
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+    def vectorize(self, text):
+        matrix = self.vectorizer.transform([text]).tocsr()
+        matrix.sort_indices()
+        return matrix
+
+
+    def update(self, paperIds=None):
+        """
+         Index the texts added or modified since the last update and remove
+         the ones deleted. If paperIds is given, only these papers are checked.
+         Return True if the index changed.
+        """
+        if paperIds is None:
+            paperIds = set(basename(fileName)[:-4] for fileName in glob(join(self.pathDB, "*.txt")))
+            paperIds.update(self.__entries)
+
+        with self.__lock:
+            changed = False
+            removed = []
+            added   = []
+            for paperId in paperIds:
+                try:
+                    fileStat  = os.stat(join(self.pathDB, paperId + ".txt"))
+                except FileNotFoundError:
+                    if paperId in self.__entries:
+                        self.__setEntry(paperId, None)
+                        removed.append((paperId,))
+                        changed = True
+                    continue
+
+                signature = (fileStat.st_mtime_ns, fileStat.st_size)
+                if paperId in self.__entries and self.__entries[paperId][0] == signature:
+                    continue
+
+                # The text might have been indexed by another process.
+                rows = self.__execute("SELECT * FROM papers WHERE paperId=? AND mtime=? AND size=?",
+                                      (paperId,) + signature)
+                if rows:
+                    self.__setEntry(paperId, self.__decodeRow(rows[0])[1:])
+                    changed = True
+                    continue
+
+                with open(join(self.pathDB, paperId + ".txt"), 'r',
+                          encoding="utf-8", errors='ignore') as f:
+                    entry = (signature, self.vectorize(f.read()))
+                self.__setEntry(paperId, entry)
+                added.append(self.__encodeRow(paperId, *entry))
+                changed = True
+
+            if len(removed):
+                self.__execute("DELETE FROM papers WHERE paperId=?", removed, many=True)
+            if len(added):
+                self.__execute("INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?)", added, many=True)
+
+        return changed
+
+
+    def __setEntry(self, paperId, entry):
+        # Replace (or remove, if entry is None) the entry of the paper, 
+        # updating the document frequencies of its words.
+        if paperId in self.__entries:
+            self.__docFreqs[self.__entries.pop(paperId)[1].indices] -= 1
+        if not entry is None:
+            self.__entries[paperId] = entry
+            self.__docFreqs[entry[1].indices] += 1
+
+
+    def __weight(self, counts):
+        # TF-IDF rows, L2-normalized, for the current state of the index.
+        idf = np.log((1.0 + len(self.__entries))/(1.0 + self.__docFreqs[counts.indices])) + 1.0
+        return normalizeRows(sp.csr_matrix((counts.data*idf, counts.indices, counts.indptr), 
+                                           shape=counts.shape))
+
+
+    def similarities(self, text, paperIds=None):
+        """
+         Return the cosine similarities between the TF-IDF vectors of the text
+         and of the indexed papers as a dictionary {paperId: similarity}.
+         The papers not indexed are skipped.
+        """
+        query = self.vectorize(text)
+        with self.__lock:
+            if paperIds is None:
+                paperIds = sorted(self.__entries)
+            paperIds = [paperId for paperId in paperIds if paperId in self.__entries]
+            if not len(paperIds):
+                return {}
+
+            rows  = self.__weight(sp.vstack([self.__entries[paperId][1] for paperId in paperIds]).tocsr())
+            query = self.__weight(query)
+        return dict(zip(paperIds, (rows @ query.T).toarray().ravel().tolist()))
+
+
+
+def normalizeRows(matrix):
+    matrix = sp.csr_matrix(matrix)
+    norms  = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sp.diags(1.0/norms) @ matrix
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Content hashes of the PDFs stored in the database, used to recognize
+uploads identical to a stored PDF without extracting their text.
+"""
+
+import hashlib
+import os
+import sqlite3
+from os.path import join
+
+from . import utils
+
+
+def hashStream(stream, chunkSize=2**16):
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunkSize), b""):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+
+class PDFStore:
+    """
+     Map the paper ids to the SHA-256 of their stored PDF, and record the
+     hashes of the uploads known to correspond to a paper (e.g., the PDF
+     as uploaded before being rewritten by OCR). The hashes are kept in a
+     SQLite table and computed again only when a PDF file changes.
+    """
+
+    def __init__(self, pathDB, fileName="pdf_hashes.sqlite"):
+        self.pathDB = pathDB
+        self.storePath = join(pathDB, fileName)
+        self.__execute("CREATE TABLE IF NOT EXISTS storedPDFs (paperId TEXT PRIMARY KEY, "
+                       "pdfHash TEXT, mtime INTEGER, size INTEGER)")
+        self.__execute("CREATE TABLE IF NOT EXISTS knownPDFs (pdfHash TEXT, paperId TEXT, "
+                       "PRIMARY KEY (pdfHash, paperId))")
+        self.__execute("CREATE INDEX IF NOT EXISTS storedPDFsHash ON storedPDFs (pdfHash)")
+
+
+    def __execute(self, query, parameters=()):
+        # A connection per call, since requests are served by several threads.
+        connection = sqlite3.connect(self.storePath)
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+
+    def pdfFileName(self, paperId):
+        return join(self.pathDB, utils.Id2FileName(paperId) + ".pdf")
+
+
+    def contains(self, paperId):
+        return os.path.isfile(self.pdfFileName(paperId))
+
+
+    def storedHash(self, paperId):
+        """
+         Return the SHA-256 of the stored PDF of the paper, or None if there
+         is none.
+        """
+        try:
+            fileStat = os.stat(self.pdfFileName(paperId))
+        except FileNotFoundError:
+            self.__execute("DELETE FROM storedPDFs WHERE paperId=?", (paperId,))
+            return None
+
+        rows = self.__execute("SELECT pdfHash FROM storedPDFs WHERE paperId=? AND mtime=? AND size=?",
+                              (paperId, fileStat.st_mtime_ns, fileStat.st_size))
+        if rows:
+            return rows[0][0]
+
+        with open(self.pdfFileName(paperId), "rb") as f:
+            pdfHash = hashStream(f)
+        self.__execute("INSERT OR REPLACE INTO storedPDFs VALUES (?, ?, ?, ?)",
+                       (paperId, pdfHash, fileStat.st_mtime_ns, fileStat.st_size))
+        return pdfHash
+
+
+    def addKnownPDF(self, paperId, pdfHash):
+        self.__execute("INSERT OR IGNORE INTO knownPDFs VALUES (?, ?)", (pdfHash, paperId))
+
+
+    def forgetPDF(self, paperId, pdfHash):
+        """
+         Remove the hashes recorded for the paper and this upload, e.g., when
+         the stored PDF is deleted because its import failed.
+        """
+        self.__execute("DELETE FROM knownPDFs WHERE pdfHash=? AND paperId=?", (pdfHash, paperId))
+        self.__execute("DELETE FROM storedPDFs WHERE paperId=?", (paperId,))
+
+
+    def isKnownPDF(self, paperId, pdfHash):
+        """
+         Return True if the PDF with this hash is the stored PDF of the paper
+         or an upload already recognized as corresponding to this paper.
+        """
+        if self.__execute("SELECT 1 FROM knownPDFs WHERE pdfHash=? AND paperId=?",
+                          (pdfHash, paperId)):
+            return True
+        return self.storedHash(paperId) == pdfHash
+
+
+    def paperIds(self, pdfHash):
+        """
+         Return the ids of the papers whose stored PDF, or a known upload,
+         has this hash.
+        """
+        stored = [row[0] for row in self.__execute("SELECT paperId FROM storedPDFs WHERE pdfHash=?", 
+                                                   (pdfHash,))]
+        known  = [row[0] for row in self.__execute("SELECT paperId FROM knownPDFs WHERE pdfHash=?", 
+                                                   (pdfHash,))]
+        # The stored PDFs might have changed since they have been hashed.
+        stored = [paperId for paperId in stored if self.storedHash(paperId) == pdfHash]
+        return sorted(set(stored + known))
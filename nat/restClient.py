@@ -7,6 +7,7 @@ Created on Sun Jun  5 13:08:43 2016
 
 import requests   
 import json
+import asyncio
 import os
 import webbrowser
 from bs4 import BeautifulSoup as bs
@@ -16,6 +17,11 @@ import warnings
 from random import sample
 from itertools import combinations
 from glob import glob
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from . import utils
 
 class RESTClientError(Exception):
     def __init__(self, message):
@@ -24,23 +30,65 @@ class RESTClientError(Exception):
 
 
 class RESTImportPDFErr(RESTClientError):
-    def __init__(self, message):
+    def __init__(self, message, jobId=None):
         # Call the base class constructor with the parameters it needs
         super(RESTImportPDFErr, self).__init__(message)
+        # Id of the OCR job to poll with RESTClient.checkOCRFinished().
+        self.jobId = jobId
         
         
+def bundleHeaders(paperId, pathDB):
+    # The server answers 304 instead of sending the paper bundle if it has 
+    # the same version as the local PDF and text.
+    if pathDB is None:
+        return {}
+    fileName = os.path.join(pathDB, utils.Id2FileName(paperId))
+    if not os.path.isfile(fileName + ".pdf") or not os.path.isfile(fileName + ".txt"):
+        return {}
+    return {"If-None-Match": '"' + utils.paperBundleHash(fileName) + '"'}
+
+
 class RESTClient:
+    """
+     Client of the REST server. The requests go through a session keeping 
+     up to maxConnections connections to the server open, and the batch 
+     methods send up to maxConnections requests concurrently.
+    """
+
+    def __init__(self, serverURL, maxConnections=10):
+        self.serverURL      = serverURL
+        self.maxConnections = maxConnections
+        self.session        = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxConnections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def concurrentMap(self, function, argsList):
+        """
+         Return [function(*args) for args in argsList], with up to 
+         maxConnections calls running concurrently.
+        """
+        with ThreadPoolExecutor(max_workers=self.maxConnections) as executor:
+            return list(executor.map(lambda args: function(*args), argsList))
 
-    def __init__(self, serverURL):
-        self.serverURL = serverURL
 
     def getContext(self, paperId, contextLength, annotStart, annotStr):
                 
-        response = requests.post(self.serverURL + "get_context", 
-                                 json=json.dumps({"paperId"      : paperId, 
-                                                  "annotStr"     : annotStr,
-                                                  "contextLength": contextLength,
-                                                  "annotStart"   : annotStart}))
+        response = self.session.post(self.serverURL + "get_context", 
+                                     json={"paperId"      : paperId, 
+                                           "annotStr"     : annotStr,
+                                           "contextLength": contextLength,
+                                           "annotStart"   : annotStart})
 
         if not response:
             print(warnings.warn(response["message"]))
@@ -54,27 +102,94 @@ class RESTClient:
         return response["context"]        
         
 
+    def getContexts(self, queries):
+        """
+         Return the contexts for a list of (paperId, annotStart, annotLength, 
+         contextLength) tuples using a single request. The context is None 
+         for the papers not available on the server.
+        """
+        queries = [{"paperId"      : paperId, 
+                    "annotStart"   : annotStart,
+                    "annotLength"  : annotLength,
+                    "contextLength": contextLength} 
+                   for paperId, annotStart, annotLength, contextLength in queries]
+        response = self.session.post(self.serverURL + "get_contexts", 
+                                     json={"queries": queries})
+        response.raise_for_status()
+        return json.loads(response.content.decode("utf8"))["contexts"]
+
+
+
+
+    def getText(self, paperId, version=None):
+        """
+         Return (text, version) for the whole text of the paper, version being
+         the ETag of the text on the server. If version is given and the text 
+         still has this version, the text is not downloaded again and None is 
+         returned in its place. Return (None, None) if the text is not available 
+         on the server or if the server does not allow its download.
+        """
+        headers = {} if version is None else {"If-None-Match": '"' + version + '"'}
+        response = self.session.get(self.serverURL + "get_text/" + requests.utils.quote(paperId),
+                                    headers=headers)
+        if response.status_code in (403, 404):
+            return None, None
+        response.raise_for_status()
+        version = response.headers.get("ETag", "").strip('"') or None
+        if response.status_code == 304:
+            return None, version
+        return response.content.decode("utf8"), version
+
+
+
+    def search(self, searchType, conditions=None, page=0, pageSize=100, **options):
+        """
+         Run on the server a search of type "annotations" or "parameters" for
+         the conditions (a Condition object, or None for all the items). 
+         Return a dictionary with the number of results and the records of 
+         the requested page.
+        """
+        query = dict(options, page=page, pageSize=pageSize)
+        if not conditions is None:
+            query["conditions"] = conditions.toJSON()
+        response = self.session.post(self.serverURL + "search_" + searchType, 
+                                     json=query)
+        response.raise_for_status()
+        return json.loads(response.content.decode("utf8"))
+
 
 
     def importPDF(self, localPDF, paperId, pathDB):
-        files = {"file": (os.path.basename(localPDF), open(localPDF, 'rb'), 'application/octet-stream'),
-         "json": (None, json.dumps({"paperId": paperId}), 'application/json')}
+        with open(localPDF, 'rb') as pdfFile:
+            files = {"file": (os.path.basename(localPDF), pdfFile, 'application/octet-stream'),
+             "json": (None, json.dumps({"paperId": paperId}), 'application/json')}
  
-        response = requests.post(#"http://httpbin.org/post", 
-                                 self.serverURL + "import_pdf", 
-                                 files=files, stream=True)
+            response = self.session.post(#"http://httpbin.org/post", 
+                                         self.serverURL + "import_pdf", 
+                                         files=files, stream=True,
+                                         headers=bundleHeaders(paperId, pathDB))
 
         if response.status_code == 200:
             zipDoc = ZipFile(io.BytesIO(response.content)) 
             zipDoc.extractall(pathDB)
+
+        elif response.status_code == 304:
+            # The local PDF and text are up to date.
+            pass
             
         elif response.status_code == 201:            
             # Need to run OCR.   
             errMsg = "Optical character recognition needs to be run on this paper. " +\
                      "The process has been launched, but this process may take some" +\
                      " time (i.e., in the order of 10 minutes)."
-            raise RESTImportPDFErr(errMsg)            
-          
+            jobId = json.loads(response.content.decode("utf8")).get("jobId")
+            raise RESTImportPDFErr(errMsg, jobId)            
+
+        elif response.status_code == 503:
+            # The OCR queue of the server is full.
+            errMsg = json.loads(response.content.decode("utf8"))["message"]
+            raise RESTImportPDFErr(errMsg)
+
         else:
             path = os.path.abspath("error_log.html")
             url = 'file://' + path            
@@ -95,17 +210,50 @@ class RESTClient:
 
 
 
-    def checkOCRFinished(self, paperId, pathDB=None):
-        files = {"json": (None, json.dumps({"paperId": paperId}), 'application/json')}
+    def importPDFs(self, localPDFs, batchSize=50):
+        """
+         Import the PDFs of a list of (localPDF, paperId) pairs, uploading 
+         batchSize PDFs per request. Yield, as the server processes them, a 
+         dictionary {"paperId", "status", ...} per paper, whose status is
+         "ok", "needs OCR" (the "jobId" of the OCR job can be polled with 
+         checkOCRFinished()), "mismatch" or "error" (with a "message").
+         The PDFs and texts can then be retrieved with importPDF().
+        """
+        for start in range(0, len(localPDFs), batchSize):
+            batch = localPDFs[start:start+batchSize]
+            with ExitStack() as stack:
+                pdfFiles = [stack.enter_context(open(localPDF, 'rb')) for localPDF, paperId in batch]
+                files = [("file", (os.path.basename(localPDF), pdfFile, 'application/octet-stream'))
+                         for (localPDF, paperId), pdfFile in zip(batch, pdfFiles)]
+                files.append(("json", (None, json.dumps({"paperIds": [paperId for localPDF, paperId in batch]}),
+                                       'application/json')))
+                response = self.session.post(self.serverURL + "import_pdfs", files=files, stream=True)
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line.decode("utf8"))
+
+
+
+    def checkOCRFinished(self, paperId, pathDB=None, jobId=None):
+        if jobId is None:
+            query = {"paperId" : paperId}
+        else:
+            query = {"jobId" : jobId}
  
-        response = requests.post(self.serverURL + "check_OCR_finished", 
-                                 json=json.dumps({"paperId" : paperId}))
+        response = self.session.post(self.serverURL + "check_OCR_finished", 
+                                     json=query,
+                                     headers=bundleHeaders(paperId, pathDB))
 
         if response.status_code == 200:
             if not pathDB is None:
                 zipDoc = ZipFile(io.BytesIO(response.content)) 
                 zipDoc.extractall(pathDB)
             return True            
+
+        elif response.status_code == 304:
+            # The local PDF and text are up to date.
+            return True
             
         elif response.status_code == 201:
             return False
@@ -122,20 +270,108 @@ class RESTClient:
             raise AttributeError("REST server returned an error number " + 
                                  str(response.status_code) +
                                  "\Response content: " + str(response.content) +
-                                 "\nRequest sent to the URL: " + self.serverURL + "import_pdf" +
-                                 "\nContent of it 'files' argument: " + str(files))
+                                 "\nRequest sent to the URL: " + self.serverURL + "check_OCR_finished" +
+                                 "\nContent of the query: " + str(query))
 
 
     def checkSimilarity(self, localPDF, paperId):
-        files = {"file": (os.path.basename(localPDF), open(localPDF, 'rb'), 'application/octet-stream'),
-                 "json": (None, json.dumps({"paperId": paperId}), 'application/json')}
+        """
+         Return the similarity between the local PDF and the stored paper. If 
+         paperId is a list, return a dictionary {paperId: similarity} for the 
+         papers stored on the server, computed with a single request.
+        """
+        if isinstance(paperId, list):
+            query = {"paperIds": paperId}
+        else:
+            query = {"paperId": paperId}
+        with open(localPDF, 'rb') as pdfFile:
+            files = {"file": (os.path.basename(localPDF), pdfFile, 'application/octet-stream'),
+                     "json": (None, json.dumps(query), 'application/json')}
  
-        response = requests.post(#"http://httpbin.org/post",
-                                 self.serverURL + "check_similarity",
-                                 files=files)
+            response = self.session.post(#"http://httpbin.org/post",
+                                         self.serverURL + "check_similarity",
+                                         files=files)
+        if isinstance(paperId, list):
+            return json.loads(response.content.decode("utf8"))["similarities"]
         return response.content
 
 
+    def checkOCRFinishedBatch(self, jobs, pathDB=None):
+        """
+         Check the OCR jobs of a list of (paperId, jobId) pairs (jobId can be 
+         None to check the last job of the paper). Return the list of the 
+         results of checkOCRFinished().
+        """
+        return self.concurrentMap(lambda paperId, jobId: self.checkOCRFinished(paperId, pathDB, jobId), 
+                                  jobs)
+
+
+    def checkSimilarityBatch(self, comparisons):
+        """
+         Compare each local PDF of a list of (localPDF, paperIds) pairs with 
+         the stored papers of paperIds. Return the list of the dictionaries 
+         {paperId: similarity} returned by checkSimilarity().
+        """
+        return self.concurrentMap(lambda localPDF, paperIds: self.checkSimilarity(localPDF, list(paperIds)), 
+                                  comparisons)
+
+
+
+@lru_cache(maxsize=None)
+def sharedClient(serverURL):
+    # Client reused by the callers not keeping their own, so that the 
+    # connections to the server are reused.
+    return RESTClient(serverURL)
+
+
+
+class AsyncRESTClient:
+    """
+     asyncio variant of RESTClient: the methods are coroutines so that many
+     requests can be awaited together (e.g., with asyncio.gather), at most 
+     maxConcurrency of them being sent at the same time. The requests are 
+     run in a thread pool with a pooled RESTClient.
+    """
+
+    def __init__(self, serverURL, maxConcurrency=50):
+        self.client     = RESTClient(serverURL, maxConnections=maxConcurrency)
+        self.__executor = ThreadPoolExecutor(max_workers=maxConcurrency)
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+    async def __run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, partial(method, *args, **kwargs))
+
+
+    async def getContext(self, paperId, contextLength, annotStart, annotStr):
+        return await self.__run(self.client.getContext, paperId, contextLength, annotStart, annotStr)
+
+    async def getContexts(self, queries):
+        return await self.__run(self.client.getContexts, queries)
+
+    async def search(self, searchType, conditions=None, page=0, pageSize=100, **options):
+        return await self.__run(self.client.search, searchType, conditions, page, pageSize, **options)
+
+    async def importPDF(self, localPDF, paperId, pathDB):
+        return await self.__run(self.client.importPDF, localPDF, paperId, pathDB)
+
+    async def checkOCRFinished(self, paperId, pathDB=None, jobId=None):
+        return await self.__run(self.client.checkOCRFinished, paperId, pathDB, jobId)
+
+    async def checkSimilarity(self, localPDF, paperId):
+        return await self.__run(self.client.checkSimilarity, localPDF, paperId)
+
+
 def checkSimilarities(dbPath, sample_size=100):
     # FIXME Delayed refactoring. Define only once the REST server URL.
     client = RESTClient("https://bbpteam.epfl.ch/neurocurator/api/v1.0/")
@@ -155,13 +391,16 @@ def checkSimilarities(dbPath, sample_size=100):
     else:
         intra_sample = pdfs
 
+    # Each local PDF is uploaded once for all the papers it is compared to.
+    inter_groups = {}
     for f1, f2 in inter_sample:
-        try:
-            print(f1, f2)
-            response = client.checkSimilarity(f1, os.path.basename(f2)[:-4])
-            inter_sim.append(float(response))
-        except ValueError:
-            pass
+        inter_groups.setdefault(f1, []).append(os.path.basename(f2)[:-4])
+
+    inter_groups = list(inter_groups.items())
+    for (f1, paperIds), similarities in zip(inter_groups, client.checkSimilarityBatch(inter_groups)):
+        print(f1, paperIds)
+        inter_sim.extend(float(similarities[paperId]) for paperId in paperIds 
+                         if paperId in similarities)
 
     for f1 in intra_sample:
         try:
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the REST server: requests are sent concurrently to an endpoint 
+and the throughput and latencies are reported. Used to compare the 
+development server with the multi-worker one (runRESTServer with and 
+without nbWorkers), e.g.:
+
+    NAT_DB_PATH=<dbPath> gunicorn --preload -w 4 --threads 4 nat.wsgi:app
+    python -m nat.restLoadTest http://localhost:5000 --path /neurocurator/api/v1.0/is_pdf_in_db/<paperId>
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+
+def runLoadTest(serverURL, path="/neurocurator/api/v1.0/metrics", method="GET", data=None, 
+                nbRequests=200, concurrency=16, timeout=60):
+    """
+     Send nbRequests requests to serverURL + path from concurrency threads and
+     return a dictionary with the throughput (requests per second), the 
+     latency percentiles (in seconds) and the number of failed requests.
+    """
+    url = serverURL.rstrip("/") + path
+
+    def sendRequest(no):
+        start = time.perf_counter()
+        try:
+            response = requests.request(method, url, json=data, timeout=timeout)
+            failed   = response.status_code >= 500
+        except requests.RequestException:
+            failed = True
+        return time.perf_counter() - start, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(sendRequest, range(nbRequests)))
+    duration = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, failed in results])
+    return {"nbRequests": nbRequests,
+            "concurrency": concurrency,
+            "nbFailed": sum(failed for latency, failed in results),
+            "duration": duration,
+            "throughput": nbRequests/duration,
+            "latencyP50": float(np.percentile(latencies, 50)),
+            "latencyP90": float(np.percentile(latencies, 90)),
+            "latencyP99": float(np.percentile(latencies, 99))}
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the NAT REST server.")
+    parser.add_argument("serverURL")
+    parser.add_argument("--path", default="/neurocurator/api/v1.0/metrics")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--data", default=None, help="JSON body of the requests.")
+    parser.add_argument("--nbRequests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    data = None if args.data is None else json.loads(args.data)
+    results = runLoadTest(args.serverURL, args.path, args.method, data, 
+                          args.nbRequests, args.concurrency)
+    for key, value in results.items():
+        print("{:>12}: {}".format(key, round(value, 4) if isinstance(value, float) else value))
@@ -7,59 +7,205 @@ Created on Sun Jun  5 14:50:40 2016
 """
 
 
-from flask import Flask, jsonify, abort, make_response, request, Response, send_file
+from flask import Flask, jsonify, abort, make_response, request, Response, send_file, g
 import json, os
+import logging
 from subprocess import check_call, CalledProcessError
 import difflib as dl
 import time
 import zipfile
 import io
-from os.path import join, isfile
-from threading import Lock, Thread
+import shutil
+import tempfile
+from os.path import join, isfile, basename
+from glob import glob, escape
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from itertools import chain
 
 from . import utils
 from .runOCR import run_ocrmypdf
+from .ocrJobQueue import OCRJobQueue, OCRQueueFullError
+from .pdfSimilarity import SimilarityIndex
+from .pdfStore import PDFStore, hashStream
+from .searchCorpus import SearchCorpus
+from .condition import Condition
+from .serverMetrics import Metrics
 
 #from nat.annotationSearch import AnnotationGetter
 
 
-dbPath = "/mnt/curator_DB/"
+# Can be set with the NAT_DB_PATH environment variable (e.g., for nat.wsgi).
+dbPath = os.environ.get("NAT_DB_PATH", "/mnt/curator_DB/")
+
+# Number of OCR jobs run concurrently and maximal number of pending OCR jobs,
+# for all the server processes sharing the database.
+nbOCRWorkers    = 2
+maxOCRQueueSize = 20
+
+# Number of paper texts kept in memory to extract contexts.
+paperTextCacheSize = 128
+
+# If True, the whole texts of the papers can be downloaded (e.g., by the 
+# clients to compute contexts offline).
+allowTextDownload = False
+
+# Size of the chunks used to stream the paper bundles.
+bundleChunkSize = 2**16
+
+# Interval (in seconds) between the checks for changes of the annotation 
+# files and maximal number of search results per page.
+corpusCheckInterval = 10.0
+maxSearchPageSize   = 1000
+
+# Minimal cosine similarity between the TF-IDF vectors of an uploaded PDF and
+# of the stored text of a paper for the upload to be taken as a version of 
+# this paper. The value 0.6 comes from the former check, which computed the
+# IDF weights over the two compared texts only. With the IDF of the whole
+# corpus (see SimilarityIndex), the words common to most papers weigh less,
+# which tends to lower the similarity of distinct papers more than that of
+# two versions of a same paper. The value is kept, but it can be adjusted 
+# for a given database from the similarities returned by check_similarity
+# for known pairs of versions and of distinct papers.
+minPDFSimilarity = 0.6
+
+# Number of pdftotext processes run concurrently by the batch imports and 
+# maximal number of PDFs per batch.
+nbTextExtractionWorkers = 4
+maxImportBatchSize      = 200
+
+# If True, a JSON line is logged per request with the "nat.restServer" logger.
+logRequests   = False
+requestLogger = logging.getLogger("nat.restServer")
 
 app = Flask(__name__)
 
-app.OCRLock = Lock()
-app.OCRFiles = []
+app.OCRQueue     = None
+app.OCRQueueLock = Lock()
 
+app.similarityIndex     = None
+app.similarityIndexLock = Lock()
 
+app.PDFStore     = None
+app.PDFStoreLock = Lock()
+
+app.searchCorpus     = None
+app.searchCorpusLock = Lock()
+
+# Shared by the workers through the database directory.
+app.metrics = Metrics(join(dbPath, "server_metrics.sqlite"))
+# The queue is created if needed, the jobs left by a previous run being
+# counted (and resumed) even before a first OCR request.
+app.metrics.addGauge("nat_ocr_queue_depth", "Number of OCR jobs queued or running.",
+                     lambda: getOCRQueue().nbPendingJobs())
+
+# fileName -> (signature of the files, ETag, bundle file name)
+app.bundles     = {}
+app.bundlesLock = Lock()
+
+app.textExtractionPool     = None
+app.textExtractionPoolLock = Lock()
+
+
+def getOCRQueue():
+    # Created on first use, the job table being stored in the database directory.
+    with app.OCRQueueLock:
+        if app.OCRQueue is None:
+            app.OCRQueue = OCRJobQueue(join(dbPath, "ocr_jobs.sqlite"), runOCR,
+                                       nbWorkers=nbOCRWorkers, maxQueueSize=maxOCRQueueSize)
+    return app.OCRQueue
+
+
+def getPDFStore():
+    with app.PDFStoreLock:
+        if app.PDFStore is None:
+            app.PDFStore = PDFStore(dbPath)
+    return app.PDFStore
+
+
+def getSearchCorpus():
+    with app.searchCorpusLock:
+        if app.searchCorpus is None:
+            app.searchCorpus = SearchCorpus(dbPath, corpusCheckInterval)
+    return app.searchCorpus
+
+
+def getTextExtractionPool():
+    # Threads waiting for the pdftotext processes, which run in parallel.
+    with app.textExtractionPoolLock:
+        if app.textExtractionPool is None:
+            app.textExtractionPool = ThreadPoolExecutor(max_workers=nbTextExtractionWorkers)
+    return app.textExtractionPool
+
+
+def getSimilarityIndex():
+    # Created on first use and then kept up to date paper by paper.
+    with app.similarityIndexLock:
+        if app.similarityIndex is None:
+            app.similarityIndex = SimilarityIndex(dbPath)
+            app.similarityIndex.update()
+    return app.similarityIndex
+
+
+def runOCR(fileName, setProgress=lambda progress: None):
+    setProgress("Running OCR.")
+    with app.metrics.timeProcess("ocrmypdf"):
+        process, out, err = run_ocrmypdf(fileName + ".pdf", fileName + ".pdf")
+        if process.returncode != 0:
+            raise RuntimeError("ocrmypdf failed with the exit code " + str(process.returncode) +
+                               ": " + err[-1000:])
+
+    setProgress("Converting the PDF to text.")
+    runPdfToText(fileName + ".pdf", fileName + ".txt")
+
+
+def runPdfToText(pdfFileName, txtFileName):
+    # check_call is blocking
+    with app.metrics.timeProcess("pdftotext"):
+        check_call(['pdftotext', '-enc', 'UTF-8', pdfFileName, txtFileName])
+
+
+
+@app.before_request
+def startRequestTimer():
+    # The endpoint is None for the URLs not matching any route.
+    g.requestEndpoint = str(request.endpoint)
+    g.requestStart    = time.perf_counter()
+    app.metrics.startRequest(g.requestEndpoint)
+
+
+@app.after_request
+def recordRequest(response):
+    endRequestTimer(response.status_code)
+    return response
+
+
+@app.teardown_request
+def recordFailedRequest(error):
+    # Only reached without a response if the request failed.
+    endRequestTimer(500)
+
+
+def endRequestTimer(status):
+    start = g.pop("requestStart", None)
+    if start is None:
+        return
+    duration = time.perf_counter() - start
+    app.metrics.endRequest(g.requestEndpoint, request.method, status, duration)
+    if logRequests:
+        requestLogger.info(json.dumps({"endpoint": g.requestEndpoint,
+                                       "method"  : request.method,
+                                       "path"    : request.path,
+                                       "status"  : status,
+                                       "duration": round(duration, 6)}))
+
+
+
+@app.route('/neurocurator/api/v1.0/metrics', methods=['GET'])
+def metrics():
+    return Response(app.metrics.format(), mimetype="text/plain; version=0.0.4")
 
-def acquireLockWithTimeout(): 
-    with app.app_context():
-        for i in range(60):
-            if app.OCRLock.acquire(blocking=False):
-                return
-            time.sleep(1)
-        if i == 59:
-            return genericError(jsonify(**{"status"  : "error",
-                                    "errorNo" :     11,
-                                    "message" : "The server seems to be dead-locked."
-                                   }))         
-
-
-def runOCR(fileName):
-    with app.app_context():
-
-        acquireLockWithTimeout()
-        app.OCRFiles.append(fileName)
-        app.OCRLock.release()    
-                
-        # Run OCR
-        run_ocrmypdf(fileName + ".pdf", fileName + ".pdf")
-        check_call(['pdftotext', '-enc', 'UTF-8', fileName + ".pdf", fileName + ".txt"])
- 
-        acquireLockWithTimeout()
-        del app.OCRFiles[app.OCRFiles.index(fileName)]
-        app.OCRLock.release()    
-        
 
 
 @app.errorhandler(404)
@@ -74,6 +220,15 @@ def genericError(error):
 
 
 
+def getRequestJSON():
+    # Older clients send the JSON body encoded a second time, as a string.
+    requestJSON = request.get_json(silent=True)
+    if isinstance(requestJSON, str):
+        requestJSON = json.loads(requestJSON)
+    return requestJSON
+
+
+
 """
 @app.route('/neurocurator/api/v1.0/localize', methods=['POST'])
 def localizeAnnotation():
@@ -117,11 +272,10 @@ def localizeAnnotation():
                                                   "annotStart"   : annotStart}))
 @app.route('/neurocurator/api/v1.0/get_context', methods=['POST'])
 def getContext():
-    if not request.json:
+    requestJSON = getRequestJSON()
+    if not requestJSON:
         abort(400)
 
-    requestJSON = json.loads(request.json)
-
     if (not 'paperId'        in requestJSON or
         not 'annotStr'       in requestJSON or
         not 'contextLength'  in requestJSON or
@@ -136,12 +290,8 @@ def getContext():
 
     try:
         txtFileName = join(dbPath, paperId + ".txt")
-        
-        with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
-            fileText = f.read()
-            contextStart = max(0, annotStart - contextLength)
-            contextEnd = min(annotStart + len(annotStr) + contextLength, len(fileText))
-            return jsonify({'context': fileText[contextStart:contextEnd]}) 
+        fileText = getPaperText(txtFileName)
+        return jsonify({'context': extractContext(fileText, annotStart, len(annotStr), contextLength)})
             
     except OSError: # as e:
         #if e.errno == errno.ENOENT:        
@@ -158,6 +308,136 @@ def getContext():
 
 
 
+
+
+
+@app.route('/neurocurator/api/v1.0/search_annotations', methods=['POST'])
+def searchAnnotations():
+    return runSearch("annotations")
+
+
+
+@app.route('/neurocurator/api/v1.0/search_parameters', methods=['POST'])
+def searchParameters():
+    return runSearch("parameters")
+
+
+
+def runSearch(searchType):
+    """
+     The request contains the search conditions as given by 
+     Condition.toJSON() (all the items if missing), and optionally the
+     page number (from 0), the page size, the result fields and 
+     findEquivalences.
+    """
+    requestJSON = getRequestJSON()
+    if not requestJSON:
+        abort(400)
+
+    try:
+        if "conditions" in requestJSON:
+            conditions = Condition.fromJSON(requestJSON["conditions"])
+        else:
+            conditions = Condition()
+        page     = int(requestJSON.get("page", 0))
+        pageSize = int(requestJSON.get("pageSize", 100))
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    if page < 0 or pageSize < 1 or pageSize > maxSearchPageSize:
+        abort(400)
+
+    version, nbResults, results = getSearchCorpus().search(searchType, conditions, page, pageSize,
+                                                           requestJSON.get("findEquivalences", True),
+                                                           requestJSON.get("resultFields"))
+
+    return jsonify({"corpusVersion": version,
+                    "nbResults"    : nbResults,
+                    "page"         : page,
+                    "pageSize"     : pageSize,
+                    "results"      : results})
+
+
+
+@app.route('/neurocurator/api/v1.0/get_contexts', methods=['POST'])
+def getContexts():
+    """
+     Batch version of get_context. The request contains a list of queries 
+     with the keys paperId, annotStart, annotLength and contextLength. The 
+     response contains the list of the corresponding contexts, None for the 
+     papers not in the database.
+    """
+    requestJSON = getRequestJSON()
+    if not requestJSON:
+        abort(400)
+
+    if not 'queries' in requestJSON:
+        abort(400)
+
+    contexts = []
+    for query in requestJSON['queries']:
+        if (not 'paperId'        in query or
+            not 'annotStart'     in query or
+            not 'annotLength'    in query or
+            not 'contextLength'  in query):
+            abort(400)
+
+        txtFileName = join(dbPath, utils.Id2FileName(query['paperId']) + ".txt")
+        try:
+            fileText = getPaperText(txtFileName)
+        except OSError:
+            contexts.append(None)
+            continue
+        contexts.append(extractContext(fileText, query['annotStart'], 
+                                       query['annotLength'], query['contextLength']))
+
+    return jsonify({'contexts': contexts})
+
+
+
+@app.route('/neurocurator/api/v1.0/get_text/<path:paperId>', methods=['GET'])
+def getText(paperId):
+    if not allowTextDownload:
+        abort(403)
+    txtFileName = join(dbPath, utils.Id2FileName(paperId) + ".txt")
+    try:
+        fileStat = os.stat(txtFileName)
+    except FileNotFoundError:
+        abort(404)
+
+    # The version of the text changes when it is extracted again (e.g., OCR).
+    etag = "{}-{}".format(fileStat.st_mtime_ns, fileStat.st_size)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = Response(getPaperText(txtFileName), mimetype="text/plain")
+    response.set_etag(etag)
+    return response
+
+
+
+def extractContext(fileText, annotStart, annotLength, contextLength):
+    contextStart = max(0, annotStart - contextLength)
+    contextEnd = min(annotStart + annotLength + contextLength, len(fileText))
+    return fileText[contextStart:contextEnd]
+
+
+
+def getPaperText(txtFileName):
+    # The modification time and the size are part of the cache key so that
+    # texts rewritten (e.g., after OCR) are read again.
+    fileStat = os.stat(txtFileName)
+    return readPaperText(txtFileName, fileStat.st_mtime_ns, fileStat.st_size)
+
+
+
+@lru_cache(maxsize=paperTextCacheSize)
+def readPaperText(txtFileName, mtime, size):
+    with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f :
+        return f.read()
+
+
+
 """    
 
     # paperId, contextLength, annotStart, annotText
@@ -178,45 +458,104 @@ def getContext():
 
 
 
-def returnPDF(fileName):        
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w') as zf:
-
-        with open(fileName + ".pdf", 'rb') as f:
-            data = zipfile.ZipInfo(os.path.basename(fileName + ".pdf"))
-            data.date_time = time.localtime(time.time())[:6]
-            data.compress_type = zipfile.ZIP_DEFLATED
-            zf.writestr(data, f.read())
-
-        with open(fileName + ".txt", 'rb') as f:
-            data = zipfile.ZipInfo(os.path.basename(fileName + ".txt"))
-            data.date_time = time.localtime(time.time())[:6]
-            data.compress_type = zipfile.ZIP_DEFLATED
-            zf.writestr(data, f.read())
-
-    memory_file.seek(0)
-    return send_file(memory_file, attachment_filename='paper.zip', as_attachment=True)       
+def getBundle(fileName):
+    """
+     Return the ETag and the file name of the zip bundle of the PDF and the
+     text of a paper. Bundles are built once per content and stored in the
+     "bundles" directory of the database.
+    """
+    signature = tuple((fileStat.st_mtime_ns, fileStat.st_size) for fileStat in 
+                      [os.stat(fileName + ".pdf"), os.stat(fileName + ".txt")])
+    with app.bundlesLock:
+        if fileName in app.bundles and app.bundles[fileName][0] == signature:
+            return app.bundles[fileName][1:]
+
+    etag = utils.paperBundleHash(fileName)
+    bundleDir = join(dbPath, "bundles")
+    bundleFileName = join(bundleDir, basename(fileName) + "-" + etag + ".zip")
+    if not isfile(bundleFileName):
+        os.makedirs(bundleDir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=bundleDir, suffix=".tmp", delete=False) as f:
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.write(fileName + ".pdf", basename(fileName + ".pdf"))
+                zf.write(fileName + ".txt", basename(fileName + ".txt"))
+        os.replace(f.name, bundleFileName)
+
+        # Bundles of the previous versions of the paper.
+        for oldFileName in glob(join(bundleDir, escape(basename(fileName)) + "-" + "[0-9a-f]"*40 + ".zip")):
+            if oldFileName != bundleFileName:
+                try:
+                    os.remove(oldFileName)
+                except OSError:
+                    pass
+
+    with app.bundlesLock:
+        app.bundles[fileName] = (signature, etag, bundleFileName)
+    return etag, bundleFileName
+
+
+
+def returnPDF(fileName):
+    etag, bundleFileName = getBundle(fileName)
+
+    # The client already holds this version of the paper.
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
+    # Opened here so that the bundle can be replaced while being streamed.
+    bundleFile = open(bundleFileName, 'rb')
+    def generateChunks():
+        with bundleFile:
+            for chunk in iter(lambda: bundleFile.read(bundleChunkSize), b""):
+                yield chunk
+
+    response = Response(generateChunks(), mimetype="application/zip")
+    response.headers["Content-Disposition"] = "attachment; filename=paper.zip"
+    response.headers["Content-Length"] = str(os.fstat(bundleFile.fileno()).st_size)
+    response.set_etag(etag)
+    return response
     
     
 
 @app.route('/neurocurator/api/v1.0/check_OCR_finished', methods=['POST'])
 def checkOCRFinished():
-    if not request.json:
+    requestJSON = getRequestJSON()
+    if not requestJSON:
         abort(400)
 
-    requestJSON = json.loads(request.json)
-
-    if not 'paperId' in requestJSON:
-        abort(400)    
-    
-    paperId       = utils.Id2FileName(requestJSON['paperId'])
-    fileName = join(dbPath, paperId)
-
-    if fileName in app.OCRFiles:
-        return make_response(jsonify({'Response': "Still running OCR for " + fileName + "."}), 201)
+    # Jobs are polled by id. Polling by paper id is kept for older clients.
+    if 'jobId' in requestJSON:
+        job = getOCRQueue().job(requestJSON['jobId'])
+        if job is None:
+            abort(404)
+        fileName = job["fileName"]
+    elif 'paperId' in requestJSON:
+        paperId  = utils.Id2FileName(requestJSON['paperId'])
+        fileName = join(dbPath, paperId)
+        job      = getOCRQueue().lastJob(fileName)
     else:
+        abort(400)
+
+    if job is None:
         return returnPDF(fileName)
 
+    if job["status"] in OCRJobQueue.activeStatuses:
+        return make_response(jsonify({'Response': "Still running OCR for " + fileName + ".",
+                                      'jobId'   : job["jobId"],
+                                      'status'  : job["status"],
+                                      'progress': job["progress"]}), 201)
+
+    if job["status"] == "failed":
+        return make_response(jsonify({"status"  : "error",
+                                      "errorNo" : 13,
+                                      "jobId"   : job["jobId"],
+                                      "message" : "OCR failed for " + fileName + ". " + job["error"]
+                                     }), 500)
+
+    return returnPDF(fileName)
+
 
 @app.route('/neurocurator/api/v1.0/is_pdf_in_db/<string:paperId>', methods=['GET'])
 def is_pdf_in_db(paperId):
@@ -224,6 +563,13 @@ def is_pdf_in_db(paperId):
 
 
 
+@app.route('/neurocurator/api/v1.0/find_pdf/<string:pdfHash>', methods=['GET'])
+def findPDF(pdfHash):
+    # Papers whose stored PDF or a validated upload has this SHA-256.
+    return jsonify({"paperIds": getPDFStore().paperIds(pdfHash)})
+
+
+
 @app.route('/neurocurator/api/v1.0/import_pdf', methods=['POST'])
 def importPDF():
     if (not request.files       or
@@ -236,19 +582,23 @@ def importPDF():
     paperId  = json.loads(request.form["json"])["paperId"]
     pdf      = request.files["file"]
     fileName = join(dbPath, utils.Id2FileName(paperId))
+    pdfHash  = hashUpload(pdf)
 
     if not isPDFInDb(paperId):
         pdf.save(fileName + ".pdf")
-        # check_call is blocking
+        # Recorded since OCR rewrites the stored PDF.
+        getPDFStore().addKnownPDF(paperId, pdfHash)
         try:
-            check_call(['pdftotext', '-enc', 'UTF-8', fileName + ".pdf", fileName + ".txt"])
+            runPdfToText(fileName + ".pdf", fileName + ".txt")
         except CalledProcessError:
+            discardImportedPDF(paperId, fileName, pdfHash)
             return genericError(jsonify(**{"status"  : "error",
                                            "errorNo" : 10,
                                            "message" : "pdftotext failed to convert the PDF of this paper to txt. " +
                                                        "Command ran: " +
                                                        " ".join(['pdftotext', '-enc', 'UTF-8', fileName + ".pdf", fileName + ".txt"])}))
         except OSError:
+            discardImportedPDF(paperId, fileName, pdfHash)
             return genericError(jsonify(**{"status"  : "error",
                                            "errorNo" : 11,
                                            "message" : "pdftotext failed to convert the PDF of this paper to txt. " +
@@ -258,7 +608,7 @@ def importPDF():
 
             
     else:
-        if not isUserPDFValid(paperId, pdf):
+        if not isUserPDFValid(paperId, pdf, pdfHash):
             return genericError(jsonify(**{"status"  : "error",
                                     "errorNo" :     2,
                                     "message" : "The database already contains a PDF "   +
@@ -267,17 +617,154 @@ def importPDF():
                                                 "version."
                                    }))
 
-    if os.path.getsize(fileName + ".txt") < 2024:
-        # If file size is smaller than 2kb than it is most likely a scanned PDF
-        # with no OCR. We need to perform OCR.    
-        thread = Thread(target = runOCR, args = (fileName, ))
-        thread.start()            
-        return make_response(jsonify({'Response': "Running OCR."}), 201)
+    if needsOCR(fileName):
+        try:
+            jobId = getOCRQueue().submit(fileName)
+        except OCRQueueFullError as error:
+            response = make_response(jsonify({"status"  : "error",
+                                              "errorNo" : 12,
+                                              "message" : str(error)}), 503)
+            response.headers["Retry-After"] = "60"
+            return response
+        return make_response(jsonify({'Response': "Running OCR.", 'jobId': jobId}), 201)
 
     return returnPDF(fileName)
 
 
 
+def needsOCR(fileName):
+    # If file size is smaller than 2kb than it is most likely a scanned PDF
+    # with no OCR. We need to perform OCR.    
+    return os.path.getsize(fileName + ".txt") < 2024
+
+
+
+@app.route('/neurocurator/api/v1.0/import_pdfs', methods=['POST'])
+def importPDFs():
+    """
+     Import several PDFs, sent as "file" parts with a "json" part giving 
+     their paper ids in the same order ({"paperIds": [...]}). The texts are
+     extracted concurrently and a JSON line {"paperId", "status", ...} is 
+     streamed per paper as soon as it is processed, with the status "ok", 
+     "needs OCR" (with the "jobId" of the OCR job), "mismatch" (the stored 
+     PDF is different) or "error" (with a "message").
+    """
+    if (not request.form or
+        not "json" in request.form):
+        abort(400)
+
+    paperIds = json.loads(request.form["json"]).get("paperIds")
+    pdfs     = request.files.getlist("file")
+    if not isinstance(paperIds, list) or len(paperIds) != len(pdfs):
+        abort(400)
+    if len(paperIds) > maxImportBatchSize:
+        return genericError(jsonify(**{"status"  : "error",
+                                       "errorNo" : 14,
+                                       "message" : "At most " + str(maxImportBatchSize) +
+                                                   " PDFs can be imported per request."}))
+
+    # The uploads are saved before streaming since the request files are not 
+    # available afterward. The uploads of papers already in the database
+    # are saved in a private directory to be compared with the stored PDF.
+    tmpDir    = tempfile.mkdtemp()
+    results   = []
+    futures   = {}
+    processed = set()
+    try:
+        for no, (paperId, pdf) in enumerate(zip(paperIds, pdfs)):
+            if paperId in processed:
+                results.append((paperId, lambda paperId: {"paperId": paperId, "status": "error", 
+                                                          "message": "This paper is already in the batch."}))
+                continue
+            processed.add(paperId)
+
+            fileName = join(dbPath, utils.Id2FileName(paperId))
+            pdfHash  = hashUpload(pdf)
+            if not isPDFInDb(paperId):
+                pdf.save(fileName + ".pdf")
+                # Recorded since OCR rewrites the stored PDF.
+                getPDFStore().addKnownPDF(paperId, pdfHash)
+                future = getTextExtractionPool().submit(runPdfToText, fileName + ".pdf", fileName + ".txt")
+                futures[future] = (paperId, partial(checkImportedText, future, fileName=fileName, 
+                                                    pdfHash=pdfHash))
+            elif getPDFStore().isKnownPDF(paperId, pdfHash):
+                results.append((paperId, partial(finishImport, fileName=fileName)))
+            else:
+                uploadFileName = join(tmpDir, str(no))
+                pdf.save(uploadFileName + ".pdf")
+                future = getTextExtractionPool().submit(runPdfToText, uploadFileName + ".pdf", 
+                                                        uploadFileName + ".txt")
+                futures[future] = (paperId, partial(checkImportedText, future, fileName=fileName, 
+                                                    uploadFileName=uploadFileName, pdfHash=pdfHash))
+    except:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        raise
+
+    def generateResults():
+        # Pairs (paperId, function returning the status of the paper).
+        completed = (futures[future] for future in as_completed(futures))
+        try:
+            for paperId, getStatus in chain(results, completed):
+                # An error for a paper does not interrupt the stream.
+                try:
+                    status = getStatus(paperId)
+                except Exception as error:
+                    status = {"paperId": paperId, "status": "error", "message": str(error)}
+                yield json.dumps(status) + "\n"
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    return Response(generateResults(), mimetype="application/x-ndjson")
+
+
+
+def checkImportedText(future, paperId, fileName, uploadFileName=None, pdfHash=None):
+    # Status of a paper of a batch import once the text of its PDF has been
+    # extracted (uploadFileName is None for the papers new to the database).
+    try:
+        future.result()
+    except (CalledProcessError, OSError) as error:
+        if uploadFileName is None:
+            discardImportedPDF(paperId, fileName, pdfHash)
+        return {"paperId": paperId, "status": "error", 
+                "message": "pdftotext failed to convert the PDF of this paper to txt: " + str(error)}
+
+    if not uploadFileName is None:
+        with open(uploadFileName + ".txt", 'r', encoding="utf-8", errors='ignore') as f:
+            similarity = computeTextSimilarities([paperId], f.read()).get(paperId)
+        if similarity is None or similarity < minPDFSimilarity:
+            return {"paperId": paperId, "status": "mismatch",
+                    "message": "The database already contains a PDF for this publication " +
+                               "and the provided PDF does not correspond to the stored version."}
+        getPDFStore().addKnownPDF(paperId, pdfHash)
+
+    return finishImport(paperId, fileName)
+
+
+
+def discardImportedPDF(paperId, fileName, pdfHash):
+    # The PDF of a new paper whose text cannot be extracted is removed, so 
+    # that the paper is not taken as being in the database.
+    for extension in [".pdf", ".txt"]:
+        try:
+            os.remove(fileName + extension)
+        except FileNotFoundError:
+            pass
+    getPDFStore().forgetPDF(paperId, pdfHash)
+
+
+
+def finishImport(paperId, fileName):
+    if not needsOCR(fileName):
+        return {"paperId": paperId, "status": "ok"}
+    try:
+        jobId = getOCRQueue().submit(fileName)
+    except OCRQueueFullError as error:
+        return {"paperId": paperId, "status": "error", "message": str(error)}
+    return {"paperId": paperId, "status": "needs OCR", "jobId": jobId}
+
+
+
 @app.route('/neurocurator/api/v1.0/check_similarity', methods=['POST'])
 def checkSimilarity():
     if (not request.files    or
@@ -287,9 +774,17 @@ def checkSimilarity():
         not 'paperId' in request.form["json"]):
         abort(400)
 
-    paperId = json.loads(request.form["json"])["paperId"]
-    pdf     = request.files["file"] #.read()
+    requestJSON = json.loads(request.form["json"])
+    pdf         = request.files["file"] #.read()
+
+    # Similarities with several papers, the upload being vectorized once.
+    if "paperIds" in requestJSON:
+        paperIds = [paperId for paperId in requestJSON["paperIds"] if isPDFInDb(paperId)]
+        similarities = computePDFSimilarities(paperIds, pdf)
+        return jsonify({"similarities": {paperId: float(similarity) 
+                                         for paperId, similarity in similarities.items()}})
 
+    paperId = requestJSON["paperId"]
     if isPDFInDb(paperId):
         similarity = computePDFSimilarity(paperId, pdf)
         return str(similarity)
@@ -320,16 +815,30 @@ def getServerPDF():
 
 
 def isPDFInDb(paperId):
-    return isfile(join(dbPath, paperId) + ".pdf")
+    return getPDFStore().contains(paperId)
 
 
 
+def hashUpload(userPDF):
+    pdfHash = hashStream(userPDF.stream)
+    userPDF.stream.seek(0)
+    return pdfHash
 
-def isUserPDFValid(paperId, userPDF):
+
+
+def isUserPDFValid(paperId, userPDF, pdfHash=None):
     if not isPDFInDb(paperId):
          return None
 
-    if computePDFSimilarity(paperId, userPDF) >= 0.6:
+    # Uploads identical to the stored PDF, or to an upload previously 
+    # validated, are recognized without extracting their text.
+    if pdfHash is None:
+        pdfHash = hashUpload(userPDF)
+    if getPDFStore().isKnownPDF(paperId, pdfHash):
+        return True
+
+    if computePDFSimilarity(paperId, userPDF) >= minPDFSimilarity:
+         getPDFStore().addKnownPDF(paperId, pdfHash)
          return True
     return False
 
@@ -340,38 +849,38 @@ def computePDFSimilarity(paperId, userPDF):
     if not isPDFInDb(paperId):
          return None
 
-    userPDF.save("temp.pdf")
-    # check_call is blocking
-    check_call(['pdftotext', '-enc', 'UTF-8', "temp.pdf", "temp.txt"])
-    os.remove("temp.pdf")
-    
-    a = open("temp.txt", 'r').read()
-    b = open(join(dbPath, paperId) + ".txt", 'r').read()
+    return computePDFSimilarities([paperId], userPDF).get(paperId)
 
-    import nltk, string
-    from sklearn.feature_extraction.text import TfidfVectorizer
 
-    stemmer = nltk.stem.porter.PorterStemmer()
-    remove_punctuation_map = dict((ord(char), None) for char in string.punctuation)
 
-    def stem_tokens(tokens):
-        return [stemmer.stem(item) for item in tokens]
+def computePDFSimilarities(paperIds, userPDF):
+    """
+     Return the similarities {paperId: similarity} between the uploaded PDF 
+     and the texts of the stored papers, using the TF-IDF similarity index.
+    """
+    return computeTextSimilarities(paperIds, getPDFText(userPDF))
 
-    '''remove punctuation, lowercase, stem'''
-    def normalize(text):
-        return stem_tokens(nltk.word_tokenize(text.lower().translate(remove_punctuation_map)))
 
-    vectorizer = TfidfVectorizer(tokenizer=normalize, stop_words='english')
 
-    def cosine_sim(text1, text2):
-        tfidf = vectorizer.fit_transform([text1, text2])
-        return ((tfidf * tfidf.T).A)[0,1]
+def computeTextSimilarities(paperIds, text):
+    # The texts are indexed by file name.
+    fileNames = {utils.Id2FileName(paperId): paperId for paperId in paperIds}
+    index = getSimilarityIndex()
+    index.update(list(fileNames))
+    similarities = index.similarities(text, list(fileNames))
+    return {fileNames[fileName]: similarity for fileName, similarity in similarities.items()}
 
-    similarity = cosine_sim(a, b)
 
-    os.remove("temp.txt")
 
-    return similarity
+def getPDFText(userPDF):
+    # A private directory per request, since requests are served concurrently.
+    with tempfile.TemporaryDirectory() as tmpDir:
+        pdfFileName = join(tmpDir, "upload.pdf")
+        txtFileName = join(tmpDir, "upload.txt")
+        userPDF.save(pdfFileName)
+        runPdfToText(pdfFileName, txtFileName)
+        with open(txtFileName, 'r', encoding="utf-8", errors='ignore') as f:
+            return f.read()
 
     
 
@@ -383,9 +892,78 @@ def getDbTxt(paperId):
 
 
 
-def runRESTServer(port=None):
-    #annotGetter = AnnotationGetter(dbPath)
+def configure(pathDB):
+    """
+     Serve the database at pathDB. The resources loaded for the previous
+     database are dropped.
+    """
+    global dbPath
+    dbPath = pathDB
+    app.metrics.storePath = join(dbPath, "server_metrics.sqlite")
+    with app.OCRQueueLock:
+        if not app.OCRQueue is None:
+            app.OCRQueue.shutdown(wait=False)
+        app.OCRQueue = None
+    with app.similarityIndexLock:
+        app.similarityIndex = None
+    with app.PDFStoreLock:
+        app.PDFStore = None
+    with app.searchCorpusLock:
+        app.searchCorpus = None
+    with app.bundlesLock:
+        app.bundles = {}
+
+
+def preload():
+    """
+     Load the search corpus and the similarity index. With a multi-worker 
+     server, this is done before forking the workers so that they share 
+     the loaded memory instead of each loading it on its first requests.
+     The OCR queue is not created here since its worker threads would not 
+     survive the fork; it is started in each worker (see nat.gunicornConfig).
+    """
+    getSearchCorpus().state()
+    getPDFStore()
+    try:
+        getSimilarityIndex()
+    except ImportError as error:
+        # nltk and sklearn are only needed for the similarity checks.
+        requestLogger.warning("Similarity index not loaded: " + str(error))
+
+
+
+def runRESTServer(port=None, dbPath=None, nbWorkers=None, nbThreads=4, debug=True):
+    """
+     Run the server with the Flask development server, or, if nbWorkers is
+     given, with nbWorkers gunicorn worker processes each serving requests
+     with nbThreads threads. The latter requires gunicorn and is the mode to
+     use in production (it is the same as running 
+     "gunicorn --preload -w <nbWorkers> --threads <nbThreads> nat.wsgi:app").
+    """
+    if not dbPath is None:
+        configure(dbPath)
     if port is None:
-        app.run(debug=True, host= '0.0.0.0')
-    else:
-        app.run(debug=True, host='0.0.0.0', port=port)
+        port = 5000
+
+    # Loaded before serving so that the first searches are not delayed.
+    preload()
+
+    if nbWorkers is None:
+        app.run(debug=debug, host='0.0.0.0', port=port)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "0.0.0.0:" + str(port))
+            self.cfg.set("workers", nbWorkers)
+            self.cfg.set("threads", nbThreads)
+            self.cfg.set("preload_app", True)
+            # Imports of large PDFs and OCR status checks can be slow.
+            self.cfg.set("timeout", 300)
+
+        def load(self):
+            return app
+
+    GunicornApplication().run()
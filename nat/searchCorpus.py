@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Annotation corpus kept in memory by the REST server to answer searches.
+"""
+
+import json
+import time
+from collections import namedtuple
+from copy import copy
+from itertools import islice
+from threading import Lock
+
+from .annotationSearch import AnnotationSearch, ParameterSearch, getCorpusVersion
+
+
+CorpusState = namedtuple("CorpusState", ["version", "annotationSearch", "parameterSearch"])
+
+
+class LoadedCorpus:
+    # Annotations already read, shared by the searches (see CompiledCorpus).
+    def __init__(self, annotations):
+        self.annotations = annotations
+
+    def getAllAnnotations(self):
+        return self.annotations
+
+
+
+class SearchCorpus:
+    """
+     Annotations, parameters and ontologies of a database loaded once and
+     shared by the searches. The corpus is reloaded when the annotation
+     files change, which is checked at most every checkInterval seconds.
+     The searches in progress keep using the previous state.
+    """
+
+    def __init__(self, pathDB, checkInterval=10.0):
+        self.pathDB        = pathDB
+        self.checkInterval = checkInterval
+        self.__state       = None
+        self.__lastCheck   = 0.0
+        self.__reloadLock  = Lock()
+
+
+    def __load(self, version):
+        annotationSearch = AnnotationSearch(self.pathDB)
+        parameterSearch  = ParameterSearch(self.pathDB, LoadedCorpus(annotationSearch.annotations))
+        return CorpusState(version, annotationSearch, parameterSearch)
+
+
+    def state(self):
+        state = self.__state
+        if not state is None and time.time() - self.__lastCheck < self.checkInterval:
+            return state
+
+        # A single request checks the corpus version (and reloads it) while
+        # the others keep using the current state, if there is one.
+        if not self.__reloadLock.acquire(blocking=state is None):
+            return state
+        try:
+            state = self.__state
+            if state is None or time.time() - self.__lastCheck >= self.checkInterval:
+                version = getCorpusVersion(self.pathDB)
+                if state is None or state.version != version:
+                    state = self.__load(version)
+                    # Swapped at once; the searches in progress hold the previous state.
+                    self.__state = state
+                self.__lastCheck = time.time()
+        finally:
+            self.__reloadLock.release()
+        return state
+
+
+    def search(self, searchType, conditions, page=0, pageSize=100,
+               findEquivalences=True, resultFields=None):
+        """
+         Run a search of type "annotations" or "parameters" and return the
+         corpus version, the number of results and the requested page of
+         results as a list of records.
+        """
+        state = self.state()
+        if searchType == "annotations":
+            searcher = copy(state.annotationSearch)
+        elif searchType == "parameters":
+            searcher = copy(state.parameterSearch)
+        else:
+            raise ValueError("Unknown search type: " + str(searchType))
+
+        searcher.setSearchConditions(conditions)
+        searcher.findEquivalences = findEquivalences
+        if not resultFields is None:
+            searcher.setResultFields(resultFields)
+
+        # Only the items of the page are formatted.
+        items = searcher.selectItems()
+        start = page*pageSize
+        if searchType == "annotations":
+            pageItems = items[start:start+pageSize]
+        else:
+            pageItems = dict(islice(items.items(), start, start+pageSize))
+
+        return state.version, len(items), formatRecords(searcher.formatOutput(pageItems))
+
+
+
+def formatRecords(resultDF):
+    # The annotation and parameter objects are replaced by their ids.
+    resultDF = resultDF.copy()
+    if "obj_annotation" in resultDF:
+        resultDF["obj_annotation"] = [annot.ID for annot in resultDF["obj_annotation"]]
+        resultDF = resultDF.rename(columns={"obj_annotation": "Annotation ID"})
+    if "obj_parameter" in resultDF:
+        resultDF = resultDF.drop(columns="obj_parameter")
+    return json.loads(resultDF.to_json(orient="records", default_handler=str))
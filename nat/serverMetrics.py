@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Request and subprocess metrics of the REST server, exposed in the
+Prometheus text format.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+import warnings
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+latencyBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0]
+
+
+class Histogram:
+
+    def __init__(self, buckets=latencyBuckets):
+        self.buckets = buckets
+        self.counts  = [0]*(len(buckets) + 1)
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def formatLines(self, name, labels):
+        lines = []
+        cumulated = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulated += count
+            lines.append(name + "_bucket" + formatLabels(labels + [("le", str(bound))]) + " " + str(cumulated))
+        lines.append(name + "_sum" + formatLabels(labels) + " " + repr(self.sum))
+        lines.append(name + "_count" + formatLabels(labels) + " " + str(self.count))
+        return lines
+
+    def toJSON(self):
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+    def add(self, other):
+        # Adds the observations of another histogram, given by toJSON().
+        self.counts = [count + otherCount for count, otherCount in zip(self.counts, other["counts"])]
+        self.sum   += other["sum"]
+        self.count += other["count"]
+
+
+
+def formatLabels(labels):
+    if not len(labels):
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+
+class Metrics:
+    """
+     Counters, gauges and histograms updated by the request hooks and the
+     timed subprocesses. The updates take a single lock for a few additions.
+
+     With a multi-worker server, each worker only sees its own requests. If
+     storePath is given, every process writes a snapshot of its metrics in
+     this SQLite file every flushInterval seconds, and format() reports the
+     sum of the snapshots of all the processes. The counters of the
+     processes that exited are kept, so that the totals do not decrease.
+     The gauges are computed by the process formatting the metrics.
+    """
+
+    def __init__(self, storePath=None, flushInterval=1.0):
+        self.storePath     = storePath
+        self.flushInterval = flushInterval
+        self.__lock        = Lock()
+        self.__gauges      = {}  # name -> (help, callable)
+        self.__reset()
+
+
+    def __reset(self):
+        self.__requests   = {}  # (endpoint, method, status) -> count
+        self.__latencies  = {}  # endpoint -> Histogram
+        self.__inFlight   = {}  # endpoint -> count
+        self.__processes  = {}  # (command, outcome) -> Histogram
+        self.__pid        = os.getpid()
+        self.__processKey = "{}-{}-{}".format(socket.gethostname(), self.__pid, uuid.uuid4().hex)
+        self.__flusher    = None
+
+
+    def __checkProcess(self):
+        # Called with the lock held. A forked worker starts with empty
+        # metrics and its own snapshot, written by its own thread.
+        if self.__pid != os.getpid():
+            self.__reset()
+        if not self.storePath is None and self.__flusher is None:
+            self.__flusher = Thread(target=self.__flushPeriodically, daemon=True)
+            self.__flusher.start()
+
+
+    def startRequest(self, endpoint):
+        with self.__lock:
+            self.__checkProcess()
+            self.__inFlight[endpoint] = self.__inFlight.get(endpoint, 0) + 1
+
+
+    def endRequest(self, endpoint, method, status, duration):
+        with self.__lock:
+            self.__checkProcess()
+            self.__inFlight[endpoint] = self.__inFlight.get(endpoint, 0) - 1
+            key = (endpoint, method, status)
+            self.__requests[key] = self.__requests.get(key, 0) + 1
+            if not endpoint in self.__latencies:
+                self.__latencies[endpoint] = Histogram()
+            self.__latencies[endpoint].observe(duration)
+
+
+    def observeProcess(self, command, outcome, duration):
+        with self.__lock:
+            self.__checkProcess()
+            key = (command, outcome)
+            if not key in self.__processes:
+                self.__processes[key] = Histogram()
+            self.__processes[key].observe(duration)
+
+
+    @contextmanager
+    def timeProcess(self, command):
+        start   = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "success"
+        finally:
+            self.observeProcess(command, outcome, time.perf_counter() - start)
+
+
+    def addGauge(self, name, help, getValue):
+        """
+         Register a gauge whose value is given by getValue() when the metrics
+         are formatted.
+        """
+        self.__gauges[name] = (help, getValue)
+
+
+    def __snapshot(self):
+        # JSON-serializable copy of the metrics of this process.
+        with self.__lock:
+            self.__checkProcess()
+            return {"requests" : [list(key) + [count] for key, count in self.__requests.items()],
+                    "inFlight" : dict(self.__inFlight),
+                    "latencies": {key: histogram.toJSON() for key, histogram in self.__latencies.items()},
+                    "processes": [list(key) + [histogram.toJSON()]
+                                  for key, histogram in self.__processes.items()]}
+
+
+    def __execute(self, query, parameters=()):
+        # A connection per call, since the metrics are flushed by a thread.
+        connection = sqlite3.connect(self.storePath, timeout=30)
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS snapshots (process TEXT PRIMARY KEY, "
+                                   "snapshot TEXT, updated REAL)")
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+
+    def flush(self):
+        # The snapshot is written even if unchanged, its update time telling
+        # that the process (and its requests in flight) is still alive.
+        snapshot = json.dumps(self.__snapshot())
+        self.__execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                       (self.__processKey, snapshot, time.time()))
+
+
+    def __flushPeriodically(self):
+        while True:
+            time.sleep(self.flushInterval)
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as error:
+                warnings.warn("The metrics cannot be shared with the other processes: " + str(error))
+                return
+
+
+    def __collect(self):
+        # Snapshots of all the processes (only this one without store).
+        if self.storePath is None:
+            return [self.__snapshot()]
+        try:
+            self.flush()
+            rows = self.__execute("SELECT snapshot, updated FROM snapshots")
+        except (OSError, sqlite3.Error) as error:
+            warnings.warn("The metrics of the other processes cannot be read: " + str(error))
+            return [self.__snapshot()]
+
+        snapshots = []
+        for snapshot, updated in rows:
+            snapshot = json.loads(snapshot)
+            # The requests in flight of the processes that exited are dropped.
+            if updated < time.time() - 5*self.flushInterval:
+                snapshot["inFlight"] = {}
+            snapshots.append(snapshot)
+        return snapshots
+
+
+    def format(self):
+        requests  = {}
+        inFlight  = {}
+        latencies = {}
+        processes = {}
+        for snapshot in self.__collect():
+            for endpoint, method, status, count in snapshot["requests"]:
+                key = (endpoint, method, status)
+                requests[key] = requests.get(key, 0) + count
+            for endpoint, count in snapshot["inFlight"].items():
+                inFlight[endpoint] = inFlight.get(endpoint, 0) + count
+            for endpoint, histogram in snapshot["latencies"].items():
+                latencies.setdefault(endpoint, Histogram()).add(histogram)
+            for command, outcome, histogram in snapshot["processes"]:
+                processes.setdefault((command, outcome), Histogram()).add(histogram)
+
+        lines = ["# HELP nat_requests_total Number of requests by endpoint, method and status.",
+                 "# TYPE nat_requests_total counter"]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            labels = [("endpoint", endpoint), ("method", method), ("status", status)]
+            lines.append("nat_requests_total" + formatLabels(labels) + " " + str(count))
+
+        lines += ["# HELP nat_requests_in_flight Number of requests being served by endpoint.",
+                  "# TYPE nat_requests_in_flight gauge"]
+        for endpoint, count in sorted(inFlight.items()):
+            lines.append("nat_requests_in_flight" + formatLabels([("endpoint", endpoint)]) + " " + str(count))
+
+        lines += ["# HELP nat_request_duration_seconds Request latencies by endpoint.",
+                  "# TYPE nat_request_duration_seconds histogram"]
+        for endpoint, histogram in sorted(latencies.items()):
+            lines += histogram.formatLines("nat_request_duration_seconds", [("endpoint", endpoint)])
+
+        lines += ["# HELP nat_subprocess_duration_seconds Durations of the pdftotext and ocrmypdf runs.",
+                  "# TYPE nat_subprocess_duration_seconds histogram"]
+        for (command, outcome), histogram in sorted(processes.items()):
+            lines += histogram.formatLines("nat_subprocess_duration_seconds",
+                                           [("command", command), ("outcome", outcome)])
+
+        for name, (help, getValue) in sorted(self.__gauges.items()):
+            lines += ["# HELP " + name + " " + help,
+                      "# TYPE " + name + " gauge",
+                      name + " " + str(getValue())]
+
+        return "\n".join(lines) + "\n"
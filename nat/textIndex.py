@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Character n-gram index of a paper text, used to find approximate matches
+of annotated strings (e.g., in noisy OCR text) in near-linear time.
+"""
+
+import re
+from difflib import SequenceMatcher
+
+import numpy as np
+
+
+# Runs of whitespaces and end-of-line hyphenations.
+separatorPattern = re.compile(r"-[ \t]*\n\s*|\s+")
+
+
+def normalizeText(text):
+    """
+     Return the text in lower case, with the runs of whitespaces replaced by
+     a space and the end-of-line hyphenations removed, together with the
+     array of the positions in the original text of the normalized characters.
+    """
+    pieces    = []
+    positions = []
+    last = 0
+    for match in separatorPattern.finditer(text):
+        pieces.append(text[last:match.start()])
+        positions.append(np.arange(last, match.start()))
+        if not match.group().startswith("-"):
+            pieces.append(" ")
+            positions.append(np.array([match.start()]))
+        last = match.end()
+    pieces.append(text[last:])
+    positions.append(np.arange(last, len(text)))
+
+    normalized = "".join(pieces)
+    lowered    = normalized.lower()
+    # A few characters change length when lowered.
+    if len(lowered) != len(normalized):
+        lowered = "".join(char.lower() if len(char.lower()) == 1 else char for char in normalized)
+    return lowered, np.concatenate(positions).astype(np.int64)
+
+
+def hashNGrams(text, n):
+    # Polynomial hashes (modulo 2**64) of the n-grams of the text.
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    nbNGrams = len(codes) - n + 1
+    if nbNGrams <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.zeros(nbNGrams, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for offset in range(n):
+            hashes = hashes*np.uint64(1000003) + codes[offset:offset+nbNGrams]
+    return hashes
+
+
+
+class TextIndex:
+    """
+     Index of the n-grams of a normalized text (see normalizeText). The
+     approximate matches of a query are found by voting: each n-gram of the
+     query found in the text votes for the alignment (diagonal) of the query
+     with the text, and the alignments with the most votes, within a tolerance
+     for insertions and deletions, are the candidates. Only the candidates are
+     then compared character by character with the query.
+    """
+
+    def __init__(self, text, n=5, maxOccurrences=1000):
+        """
+         The n-grams occurring more than maxOccurrences times in the text
+         (e.g., " the ") are ignored since they hardly locate the query.
+        """
+        self.text           = text
+        self.n              = n
+        self.maxOccurrences = maxOccurrences
+        self.normalized, self.positions = normalizeText(text)
+
+        hashes = hashNGrams(self.normalized, n)
+        self.order  = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[self.order]
+
+
+    def __len__(self):
+        return len(self.text)
+
+
+    def exactMatches(self, normalizedQuery):
+        # Spans (start, end) in the text of the matches of the normalized query.
+        spans = []
+        start = self.normalized.find(normalizedQuery)
+        while start >= 0 and len(normalizedQuery):
+            end = start + len(normalizedQuery)
+            spans.append((int(self.positions[start]), int(self.positions[end-1]) + 1))
+            start = self.normalized.find(normalizedQuery, start + 1)
+        return spans
+
+
+    def __candidateSpans(self, query, maxCandidates):
+        # Spans (start, end) in the normalized text of the best alignments.
+        n = self.n
+        queryHashes = hashNGrams(query, n)
+        if not len(queryHashes) or not len(self.hashes):
+            return []
+
+        lows   = np.searchsorted(self.hashes, queryHashes, side="left")
+        counts = np.searchsorted(self.hashes, queryHashes, side="right") - lows
+        counts[counts > self.maxOccurrences] = 0
+        if not counts.sum():
+            return []
+
+        # Text and query positions of all the n-gram hits.
+        queryPositions = np.repeat(np.arange(len(queryHashes)), counts)
+        offsets        = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        textPositions  = self.order[np.repeat(lows, counts) + offsets]
+        diagonals      = textPositions - queryPositions
+
+        sortOrder      = np.argsort(diagonals, kind="stable")
+        diagonals      = diagonals[sortOrder]
+        textPositions  = textPositions[sortOrder]
+        queryPositions = queryPositions[sortOrder]
+
+        # Number of hits on the diagonals within the tolerance of each hit.
+        tolerance = max(3, len(query)//10)
+        bandEnds  = np.searchsorted(diagonals, diagonals + tolerance, side="right")
+        votes     = bandEnds - np.arange(len(diagonals))
+
+        spans = []
+        available = np.ones(len(diagonals), dtype=bool)
+        while len(spans) < maxCandidates and available.any():
+            best = np.argmax(np.where(available, votes, -1))
+            band = slice(best, bandEnds[best])
+            first = np.argmin(textPositions[band])
+            last  = np.argmax(textPositions[band])
+            start = textPositions[band][first] - queryPositions[band][first]
+            end   = textPositions[band][last] + len(query) - queryPositions[band][last]
+            spans.append((max(0, int(start)), min(len(self.normalized), int(end))))
+
+            # Alignments overlapping this candidate.
+            low  = np.searchsorted(diagonals, diagonals[best] - len(query)//2, side="left")
+            high = np.searchsorted(diagonals, diagonals[best] + tolerance + len(query)//2, side="right")
+            available[low:high] = False
+
+        return spans
+
+
+    def search(self, query, contextLength=50, maxCandidates=5, minRatio=0.5):
+        """
+         Return the candidate locations of the query in the text, best first,
+         as dictionaries with the keys start and end (positions in the text),
+         candidate (the text matched), contextBefore, contextAfter and ratio
+         (similarity between the query and the candidate, 1.0 for exact
+         matches up to the normalization). Candidates with a ratio below 
+         minRatio are dropped.
+        """
+        normalizedQuery = normalizeText(query)[0]
+        spans = self.exactMatches(normalizedQuery)
+        if len(spans):
+            ratios = [1.0]*len(spans)
+        else:
+            spans  = []
+            ratios = []
+            for start, end in self.__candidateSpans(normalizedQuery, maxCandidates):
+                if end <= start:
+                    continue
+                ratio = SequenceMatcher(None, normalizedQuery, self.normalized[start:end], 
+                                        autojunk=False).ratio()
+                if ratio >= minRatio:
+                    spans.append((int(self.positions[start]), int(self.positions[end-1]) + 1))
+                    ratios.append(ratio)
+
+        blocks = [{"start"        : start,
+                   "end"          : end,
+                   "candidate"    : self.text[start:end].replace("\n", " "),
+                   "contextBefore": self.text[max(0, start-contextLength):start],
+                   "contextAfter" : self.text[end:min(len(self.text), end+contextLength)],
+                   "ratio"        : ratio}
+                  for (start, end), ratio in zip(spans, ratios)]
+        return sorted(blocks, key=lambda block: block["ratio"], reverse=True)
@@ -3,8 +3,10 @@
 __author__ = 'oreilly'
 __email__  = 'christian.oreilly@epfl.ch'
 
+import hashlib
 import os
 import pickle
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
@@ -17,6 +19,9 @@ from .ontoDic import OntoDic
 from .tag import RequiredTag
 from .tagUtilities import nlx2ks
 
+# Children of the ontology terms, cached from the web-based ontology service.
+childrenFileName = os.path.join(os.path.dirname(__file__), "children.bin")
+
 rootIDs = {}
 
 # "Eumetazoa" includes almost all animals. 
@@ -58,7 +63,7 @@ def getChildren(root_id, maxDepth=100, relationshipType="subClassOf",
      has not already been cached. 
     """
     childrenDic = {}
-    fileName = os.path.join(os.path.dirname(__file__), "children.bin") 
+    fileName = childrenFileName
 
     #### CHECK FOR CASE OF BBP TAGS
     if root_id[:4] == "BBP_":
@@ -148,6 +153,40 @@ def getChildren(root_id, maxDepth=100, relationshipType="subClassOf",
     
 
 #http://matrix.neuinfo.org:9000/scigraph/graph/neighbors/UBERON:0000955?blankNodes=False&depth=1&direction=INCOMING&project=*&relationshipType=subClassOf
+
+
+
+def getOntologyVersion():
+    """
+     Return a string identifying the state of the files the children of the
+     ontology terms are read from (children.bin and the additions to the 
+     ontologies). It changes whenever one of them is modified.
+    """
+    version = hashlib.sha1()
+    for fileName in [childrenFileName, data_path("additionsToOntologies.csv")]:
+        try:
+            fileStat = os.stat(fileName)
+        except OSError:
+            continue
+        version.update("{};{};{}\n".format(os.path.basename(fileName), fileStat.st_size, 
+                                            fileStat.st_mtime_ns).encode("utf-8"))
+    return version.hexdigest()
+
+
+
+def getDescendantIds(root_id):
+    """
+     Return the IDs of the children of root_id as a frozenset. The set is 
+     kept in memory so that repeated membership tests (e.g., with 
+     pandas.Series.isin) do not reload children.bin each time, until the
+     ontology version (see getOntologyVersion) changes.
+    """
+    return _getDescendantIds(root_id, getOntologyVersion())
+
+
+@lru_cache(maxsize=None)
+def _getDescendantIds(root_id, ontologyVersion):
+    return frozenset(getChildren(root_id))
     
     
 
@@ -6,6 +6,7 @@ Created on Wed Mar 16 12:12:13 2016
 """
 
 import os
+import hashlib
 from copy import copy
 from glob import glob
 from os.path import basename
@@ -80,6 +81,23 @@ def fileName2Id(fileName):
     
     
     
+def paperBundleHash(fileName, chunkSize=2**16):
+    """
+     Return the SHA-1 of the PDF (fileName + ".pdf") and of the text 
+     (fileName + ".txt") of a paper. It identifies the bundle of these 
+     files served by the REST server and is used as its ETag.
+    """
+    sha1 = hashlib.sha1()
+    for extension in [".pdf", ".txt"]:
+        fileHash = hashlib.sha1()
+        with open(fileName + extension, "rb") as f:
+            for chunk in iter(lambda: f.read(chunkSize), b""):
+                fileHash.update(chunk)
+        sha1.update(fileHash.digest())
+    return sha1.hexdigest()
+
+
+
 def reprocessFileNames(path = "/home/oreilly/curator_DB/"):
     for f in glob(path + "*"):   
         f_in  = basename(f)
@@ -18,6 +18,21 @@ statisticList  = ["raw",
                   "deviation", "average"]
 
 
+def readOnly(value):
+    """
+    Return value with its numpy arrays (also within tuples) replaced by
+    read-only views, so that the memoized results cannot be modified by the
+    callers.
+    """
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, tuple):
+        return tuple(readOnly(item) for item in value)
+    return value
+
+
 def unitIsValid(unit):
     try:
         pq.Quantity(1, unit)
@@ -241,6 +256,53 @@ class ValuesCompound(Values):
         self.valueLst    = valueLst
 
 
+    @property
+    def valueLst(self):
+        return self.__valueLst
+
+    @valueLst.setter
+    def valueLst(self, valueLst):
+        """
+        Setting the list of values rebuilds the statistic -> index lookup
+        table and invalidates the memoized results. Code modifying the
+        ValuesSimple objects of valueLst in place must reassign valueLst
+        (or call invalidateCache()) for the changes to be seen. The arrays
+        returned by the statistic accessors are read-only; copy them to 
+        modify them.
+        """
+        self.__valueLst = valueLst
+        self.__statIndex = {}
+        for ind, value in enumerate(valueLst):
+            # Keep the first occurrence, as list.index() would.
+            self.__statIndex.setdefault(value.statistic, ind)
+        self.__cache = {}
+
+
+    def invalidateCache(self):
+        self.__cache = {}
+
+
+    def __memoize(self, key, compute):
+        if not key in self.__cache:
+            self.__cache[key] = readOnly(compute())
+        return self.__cache[key]
+
+
+    def __hasStats(self, *stats):
+        return all(stat in self.__statIndex for stat in stats)
+
+
+    def __stat(self, stat):
+        return self.__valueLst[self.__statIndex[stat]]
+
+
+    def __firstStat(self, stats):
+        for stat in stats:
+            if stat in self.__statIndex:
+                return stat
+        return None
+
+
     def __len__(self):
         return len(self.valueLst[0])
 
@@ -248,6 +310,7 @@ class ValuesCompound(Values):
     def applyTransform(self, rule):
         for value in self.valueLst:
             value.applyTransform(rule)
+        self.invalidateCache()
 
 
 
@@ -269,62 +332,44 @@ class ValuesCompound(Values):
     def __matOperator__(self, other, operatorFct):
 
         retVal = deepcopy(self)
-        for ind, value in enumerate(retVal.valueLst):
-            if value.statistic != "N":
-                retVal.valueLst[ind] = value.__matOperator__(other, operatorFct)
+        retVal.valueLst = [value.__matOperator__(other, operatorFct)
+                           if value.statistic != "N" else value
+                           for value in retVal.valueLst]
         return retVal
 
 
     def rescale(self, unit):
         retVal = deepcopy(self)
-        for ind, value in enumerate(retVal.valueLst):
-            if value.statistic != "N":
-                retVal.valueLst[ind] = value.rescale(unit)
+        retVal.valueLst = [value.rescale(unit) if value.statistic != "N" else value
+                           for value in retVal.valueLst]
         return retVal
 
 
     def text(self, withUnit=False):
+        return self.__memoize(("text", withUnit), lambda: self.__computeText(withUnit))
 
-        stats = [value.statistic for value in self.valueLst]
-        if "raw" in stats :
-            return self.valueLst[stats.index("raw")].text(withUnit)
-
-        if "sem" in stats :
-            dev = "+/- " + self.valueLst[stats.index("sem")].text()
-        elif "sd" in stats :
-            dev = "+/- " + self.valueLst[stats.index("sd")].text()
-        elif "var" in stats :
-            dev = "+/- " + self.valueLst[stats.index("var")].text()
-        elif "deviation" in stats :
-            dev = "+/- " + self.valueLst[stats.index("deviation")].text()
-        else:
-            dev = ""
-
-        if "min" in stats and "max" in stats :
-            inter = "[" + self.valueLst[stats.index("min")].text() + " - " + self.valueLst[stats.index("max")].text() + "]"
-        elif "CI_01" in stats and  "CI_99" in stats :
-            inter = "[" + self.valueLst[stats.index("CI_01")].text() + " - " + self.valueLst[stats.index("CI_99")].text() + "]"
-        elif "CI_02.5" in stats and  "CI_97.5" in stats :
-            inter = "[" + self.valueLst[stats.index("CI_02.5")].text() + " - " + self.valueLst[stats.index("CI_97.5")].text() + "]"
-        else:
-            inter = ""
 
-        if "N" in stats:
-            sampSize = "(n=" + self.valueLst[stats.index("N")].text() +")"
-        else:
-            sampSize = ""
+    def __computeText(self, withUnit):
+
+        if self.__hasStats("raw"):
+            return self.__stat("raw").text(withUnit)
+
+        stat = self.__firstStat(["sem", "sd", "var", "deviation"])
+        dev = "" if stat is None else "+/- " + self.__stat(stat).text()
+
+        inter = ""
+        for statMin, statMax in [("min", "max"), ("CI_01", "CI_99"), ("CI_02.5", "CI_97.5")]:
+            if self.__hasStats(statMin, statMax):
+                inter = "[" + self.__stat(statMin).text() + " - " + self.__stat(statMax).text() + "]"
+                break
 
-        if "mean" in stats :
-            avg = self.valueLst[stats.index("mean")].text()
-        elif "median" in stats :
-            avg = self.valueLst[stats.index("median")].text()
-        elif "mode" in stats :
-            avg = self.valueLst[stats.index("mode")].text()
-        elif "average" in stats :
-            avg = self.valueLst[stats.index("average")].text()
+        if self.__hasStats("N"):
+            sampSize = "(n=" + self.__stat("N").text() +")"
         else:
-            avg = ""
+            sampSize = ""
 
+        stat = self.__firstStat(["mean", "median", "mode", "average"])
+        avg = "" if stat is None else self.__stat(stat).text()
 
         if withUnit:
             return " ".join([avg, dev, inter, sampSize, self.textUnit()])
@@ -333,27 +378,23 @@ class ValuesCompound(Values):
 
 
     def textUnit(self):
+        return self.__memoize(("textUnit",), self.__computeTextUnit)
+
+
+    def __computeTextUnit(self):
+
+        if self.__hasStats("raw"):
+            return self.__stat("raw").textUnit()
 
-        stats = [value.statistic for value in self.valueLst]
         unit = ""
-        if "raw" in stats :
-            return self.valueLst[stats.index("raw")].textUnit()
-
-        if "min" in stats and "max" in stats :
-            unit = self.valueLst[stats.index("min")].unit
-        elif "CI_01" in stats and  "CI_99" in stats :
-            unit = self.valueLst[stats.index("CI_01")].unit
-        elif "CI_02.5" in stats and  "CI_97.5" in stats :
-            unit = self.valueLst[stats.index("CI_02.5")].unit
-
-        if "mean" in stats :
-            unit = self.valueLst[stats.index("mean")].unit
-        elif "median" in stats :
-            unit = self.valueLst[stats.index("median")].unit
-        elif "mode" in stats :
-            unit = self.valueLst[stats.index("mode")].unit
-        elif "average" in stats :
-            unit = self.valueLst[stats.index("average")].unit
+        for statMin, statMax in [("min", "max"), ("CI_01", "CI_99"), ("CI_02.5", "CI_97.5")]:
+            if self.__hasStats(statMin, statMax):
+                unit = self.__stat(statMin).unit
+                break
+
+        stat = self.__firstStat(["mean", "median", "mode", "average"])
+        if not stat is None:
+            unit = self.__stat(stat).unit
 
         return unit
 
@@ -376,30 +417,25 @@ class ValuesCompound(Values):
             """
 
             def getReturnVals():
-                stats = [value.statistic for value in self.valueLst]
-                for stat in ["mean", "median", "mode", "average"]:
-                    if stat in stats :
-                        return self.valueLst[stats.index(stat)].values, stat
-        
-                if "min" in stats and "max" in stats :
-                    return (self.valueLst[stats.index("min")].values +
-                            self.valueLst[stats.index("max")].values)/2.0, "mid-range"
-                if "CI_01" in stats and  "CI_99" in stats :
-                    return (self.valueLst[stats.index("CI_01")].values +
-                            self.valueLst[stats.index("CI_99")].values)/2.0, "mid-range"
-                if "CI_02.5" in stats and  "CI_97.5" in stats :
-                    return (self.valueLst[stats.index("CI_02.5")].values +
-                            self.valueLst[stats.index("CI_97.5")].values)/2.0, "mid-range"
-        
-                if "raw" in stats :
-                    return self.valueLst[stats.index("raw")].values, "raw"
+                stat = self.__firstStat(["mean", "median", "mode", "average"])
+                if not stat is None:
+                    return self.__stat(stat).values, stat
+
+                for statMin, statMax in [("min", "max"), ("CI_01", "CI_99"), ("CI_02.5", "CI_97.5")]:
+                    if self.__hasStats(statMin, statMax):
+                        return (self.__stat(statMin).values +
+                                self.__stat(statMax).values)/2.0, "mid-range"
+
+                if self.__hasStats("raw"):
+                    return self.__stat("raw").values, "raw"
         
                 return np.nan, "N/A"
 
+            returnVals = self.__memoize(("centralTendancy", "within"), getReturnVals)
             if returnStat:
-                return getReturnVals()
+                return returnVals
             else:
-                return getReturnVals()[0]
+                return returnVals[0]
                 
         else:
             raise ValueError("Only types 'across' and 'within' are acceptable.")
@@ -416,28 +452,25 @@ class ValuesCompound(Values):
        
         elif type == "within":
             def getReturnVals():
-                stats = [value.statistic for value in self.valueLst]
-                for stat in ["sd", "sem", "var", "deviation"]:
-                    if stat in stats :
-                        return self.valueLst[stats.index(stat)].values, stat
-        
-                if "min" in stats and "max" in stats :
-                    return (self.valueLst[stats.index("max")].values -
-                            self.valueLst[stats.index("min")].values), "range_width"
-                if "CI_01" in stats and  "CI_99" in stats :
-                    return (self.valueLst[stats.index("CI_99")].values -
-                            self.valueLst[stats.index("CI_01")].values), "CI_98_width"
-                if "CI_02.5" in stats and  "CI_97.5" in stats :
-                    return (self.valueLst[stats.index("CI_97.5")].values -
-                            self.valueLst[stats.index("CI_02.5")].values), "CI_95_width"
-        
-                if "raw" in stats :
-                    return np.zeros_like(self.valueLst[stats.index("raw")].values), "sd"            
-                    
+                stat = self.__firstStat(["sd", "sem", "var", "deviation"])
+                if not stat is None:
+                    return self.__stat(stat).values, stat
+
+                for statMin, statMax, statWidth in [("min", "max", "range_width"),
+                                                    ("CI_01", "CI_99", "CI_98_width"),
+                                                    ("CI_02.5", "CI_97.5", "CI_95_width")]:
+                    if self.__hasStats(statMin, statMax):
+                        return (self.__stat(statMax).values -
+                                self.__stat(statMin).values), statWidth
+
+                if self.__hasStats("raw"):
+                    return np.zeros_like(self.__stat("raw").values), "sd"            
+
+            returnVals = self.__memoize(("deviation", "within"), getReturnVals)
             if returnStat:
-                return getReturnVals() 
+                return returnVals
             else:
-                return getReturnVals()[0]
+                return returnVals[0]
                 
         else:
             raise ValueError("Only types 'across' and 'within' are acceptable.")
@@ -447,44 +480,38 @@ class ValuesCompound(Values):
     def size(self, type, returnStat=False):
         if type == "across":        
             def getReturnVals():            
-                stats = [value.statistic for value in self.valueLst]
-                for stat in ["mean", "median", "mode", "mid-range"]:
-                    if stat in stats :
-                        return len(self.valueLst[stats.index(stat)].values)
-        
-                if "min" in stats and "max" in stats :
-                    return len(self.valueLst[stats.index("min")].values)
-                if "CI_01" in stats and  "CI_99" in stats :
-                    return len(self.valueLst[stats.index("CI_01")].values)
-                if "CI_02.5" in stats and  "CI_97.5" in stats :
-                    return len(self.valueLst[stats.index("CI_02.5")].values)
-        
-                if "raw" in stats :
-                    return len(self.valueLst[stats.index("raw")].values)
+                stat = self.__firstStat(["mean", "median", "mode", "mid-range"])
+                if not stat is None:
+                    return len(self.__stat(stat).values)
+
+                for statMin, statMax in [("min", "max"), ("CI_01", "CI_99"), ("CI_02.5", "CI_97.5")]:
+                    if self.__hasStats(statMin, statMax):
+                        return len(self.__stat(statMin).values)
+
+                if self.__hasStats("raw"):
+                    return len(self.__stat("raw").values)
         
                 return np.nan            
 
+            size = self.__memoize(("size", "across"), getReturnVals)
             if returnStat:
-                return getReturnVals(), "N"
+                return size, "N"
             else:
-                return getReturnVals()
+                return size
                 
 
         elif type == "within":
-            stats = [value.statistic for value in self.valueLst]
-            if "N" in stats:
-                if returnStat:
-                    return self.valueLst[stats.index("N")].values, "N"   
-                else:
-                    return self.valueLst[stats.index("N")].values
+            if self.__hasStats("N"):
+                size = readOnly(self.__stat("N").values)
             else:
-                if returnStat:
-                    return np.ones_like(self.centralTendancy(type="within")), "N"   
-                else:
-                    return np.ones_like(self.centralTendancy(type="within"))              
+                size = self.__memoize(("size", "within"),
+                                      lambda: np.ones_like(self.centralTendancy(type="within")))
+            if returnStat:
+                return size, "N"   
+            else:
+                return size
 
 
     @property
     def unit(self):
         return self.textUnit()
-
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point of the REST server, for production deployments:
+
+    NAT_DB_PATH=/mnt/curator_DB/ gunicorn -c python:nat.gunicornConfig -w 4 --threads 4 nat.wsgi:app
+
+With these settings (see nat.gunicornConfig), the search corpus and the 
+similarity index are loaded once before the workers are forked, and the 
+OCR queue is started in each worker as soon as it is forked. The durable 
+state (OCR jobs, PDF hashes, similarity index, bundles) is kept in the 
+database directory and shared by the workers, as are the metrics (each
+worker writing its own in server_metrics.sqlite). The in-memory caches are
+per worker.
+"""
+
+from .restServer import app, preload
+
+preload()
@@ -4,8 +4,13 @@ __maintainer__ = "Pierre-Alexandre Fonta"
 import os
 import pickle
 import re
+import time
+from bisect import insort
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 
+import pandas as pd
 from dateutil.parser import parse
 from pyzotero.zotero import Zotero
 from pyzotero.zotero_errors import InvalidItemFields
@@ -16,56 +21,208 @@ class ZoteroWrap:
     CACHE_REFERENCE_LIST = "references"
     CACHE_REFERENCE_TYPES = "reference_types"
     CACHE_REFERENCE_TEMPLATES = "reference_templates"
+    CACHE_LIBRARY_VERSION = "library_version"
+    CACHE_REFERENCE_COLUMNS = "reference_columns"
+    CACHE_SCHEMA_VERSION = "schema_version"
+
+    # Fields derived from the reference data and materialized for all references.
+    REFERENCE_COLUMNS = ["key", "id", "type", "title", "creators", "year", "journal", "citation"]
+
+    # Number of reference upserts journaled before the cache is rewritten.
+    JOURNAL_MAX_SIZE = 1000
+
+    # Maximal number of reference templates retrieved concurrently.
+    TEMPLATE_WORKERS = 8
 
     def __init__(self, library_id, library_type, api_key, directory):
         cache_filename = "{}-{}-{}.pkl".format(library_id, library_type, api_key)
         self.cache_path = os.path.join(directory, cache_filename)
+        journal_filename = "{}-{}-{}-journal.pkl".format(library_id, library_type, api_key)
+        self.journal_path = os.path.join(directory, journal_filename)
+        self._journal_size = 0
         # reference_types and reference_templates must have the same ordering.
         self.reference_types = []
         self.reference_templates = {}
+        # Version of the Zotero library the references are synchronized with.
+        self.library_version = 0
+        # Version of the Zotero schema the reference templates come from.
+        self.schema_version = None
         self._zotero_lib = Zotero(library_id, library_type, api_key)
         self._references = []
+        # Map from the reference IDs to the (sorted) indexes of the references
+        # and derived fields of the references (one list per REFERENCE_COLUMNS).
+        # References appended to _references are indexed on the next lookup.
+        self._reference_indexes = {}
+        self._reference_columns = {x: [] for x in self.REFERENCE_COLUMNS}
+        self._indexed_references = None
+        self._indexed_count = 0
+        # Indexes of the references modified in place and not indexed again
+        # yet, or None if all the references must be (see invalidate_references()).
+        self._modified_indexes = set()
 
     # Data I/O methods section.
 
-    def initialize(self):
-        """Load the cached Zotero data, or retrieve them if there is none."""
+    def initialize(self, synchronize=False):
+        """Load the cached Zotero data, or retrieve them if there is none.
+
+        If 'synchronize' is True, the cached Zotero data are then synchronized.
+        """
         try:
             self.load_cache()
         except FileNotFoundError:
             self.load_distant()
+        else:
+            if synchronize:
+                self.synchronize()
 
     def load_cache(self):
-        """Load the cached Zotero data."""
+        """Load the cached Zotero data, including the journaled reference upserts."""
         with open(self.cache_path, "rb") as f:
             print("Loading cached Zotero data...")
             cache = pickle.load(f)
             self._references = cache[self.CACHE_REFERENCE_LIST]
             self.reference_types = cache[self.CACHE_REFERENCE_TYPES]
             self.reference_templates = cache[self.CACHE_REFERENCE_TEMPLATES]
-            print("Cached Zotero data loaded.")
+            # Caches created before the synchronization support have no version.
+            self.library_version = cache.get(self.CACHE_LIBRARY_VERSION, 0)
+            self.schema_version = cache.get(self.CACHE_SCHEMA_VERSION)
+            # Caches created before the columnar format have no derived fields.
+            columns = cache.get(self.CACHE_REFERENCE_COLUMNS)
+            if columns is not None and len(columns["id"]) == len(self._references):
+                self._reference_columns = columns
+                self._reference_indexes = {}
+                for index, ref_id in enumerate(columns["id"]):
+                    self._reference_indexes.setdefault(ref_id, []).append(index)
+                self._indexed_references = self._references
+                self._indexed_count = len(self._references)
+        self._journal_size = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                while True:
+                    try:
+                        index, ref = pickle.load(f)
+                    except EOFError:
+                        break
+                    # NB: The next upserts depend on this one, so the replay stops.
+                    if not 0 <= index <= self.reference_count():
+                        print("Invalid journaled upsert at index {} ignored, "
+                              "with the following ones.".format(index))
+                        break
+                    self._upsert_reference(index, ref)
+                    self._journal_size += 1
+        except FileNotFoundError:
+            pass
+        self._index_references()
+        print("Cached Zotero data loaded.")
 
     def load_distant(self):
         """Load the distant Zotero data."""
         print("Loading distant Zotero data...")
+        start = time.perf_counter()
         self._references = self.get_references()
-        self.reference_types = self.get_reference_types()
-        self.reference_templates = self.get_reference_templates(self.reference_types)
-        print("Distant Zotero data loaded.")
+        print("{} references retrieved in {:.2f} s.".format(self.reference_count(),
+                                                            time.perf_counter() - start))
+        self.update_reference_templates()
+        # The library version is at least the one of the last modified reference.
+        self.library_version = max((ref["version"] for ref in self._references), default=0)
+        self._index_references()
+        print("Distant Zotero data loaded in {:.2f} s.".format(time.perf_counter() - start))
+        self.cache()
+
+    def update_reference_templates(self):
+        """Retrieve the reference types and the templates of the new types.
+
+        The templates are all retrieved again if the Zotero schema version has
+        changed, or if it is unknown. Return True if any template was retrieved.
+        """
+        start = time.perf_counter()
+        ref_types = self.get_reference_types()
+        schema_version = self.get_schema_version()
+        if schema_version is None or schema_version != self.schema_version:
+            cached = {}
+        else:
+            cached = self.reference_templates
+        retrieved = self.get_reference_templates([x for x in ref_types if x not in cached])
+        self.reference_templates = OrderedDict([(x, cached[x] if x in cached else retrieved[x])
+                                                for x in ref_types])
+        self.reference_types = ref_types
+        self.schema_version = schema_version
+        print("{} reference templates retrieved ({} cached) in {:.2f} s.".format(
+              len(retrieved), len(ref_types) - len(retrieved), time.perf_counter() - start))
+        return len(retrieved) > 0
+
+    def synchronize(self):
+        """Apply to the cached Zotero data the changes of the distant library.
+
+        Only the references modified or deleted since the last synchronization
+        are retrieved. The references are updated in place, keyed by their
+        Zotero item key. Modified references not in the cache are appended.
+        The reference templates are updated with update_reference_templates().
+        Return True if the distant library has changed since then.
+        """
+        templates_updated = self.update_reference_templates()
+        version = self._zotero_lib.last_modified_version()
+        if version == self.library_version:
+            if templates_updated:
+                self.cache()
+            return False
+        print("Synchronizing Zotero data...")
+        modified = self.get_references(since=self.library_version)
+        deleted = set(self.get_deleted_references(since=self.library_version))
+        references = list(self._references)
+        positions = {ref["key"]: i for i, ref in enumerate(references)}
+        for ref in modified:
+            index = positions.get(ref["key"])
+            if index is None:
+                positions[ref["key"]] = len(references)
+                references.append(ref)
+            else:
+                references[index] = ref
+        if deleted:
+            references = [ref for ref in references if ref["key"] not in deleted]
+        # A new list so that the reference indexes are rebuilt on the next lookup.
+        self._references = references
+        self.library_version = version
+        print("Zotero data synchronized: {} modified, {} deleted.".format(len(modified), len(deleted)))
         self.cache()
+        return True
 
     def cache(self):
-        """Cache the Zotero data."""
-        with open(self.cache_path, "wb") as f:
+        """Cache the Zotero data, including the derived fields of the references."""
+        self._index_references()
+        temporary_path = self.cache_path + ".tmp"
+        with open(temporary_path, "wb") as f:
             cache = {self.CACHE_REFERENCE_LIST: self._references,
                      self.CACHE_REFERENCE_TYPES: self.reference_types,
-                     self.CACHE_REFERENCE_TEMPLATES: self.reference_templates}
+                     self.CACHE_REFERENCE_TEMPLATES: self.reference_templates,
+                     self.CACHE_LIBRARY_VERSION: self.library_version,
+                     self.CACHE_SCHEMA_VERSION: self.schema_version,
+                     self.CACHE_REFERENCE_COLUMNS: self._reference_columns}
             pickle.dump(cache, f)
+        os.replace(temporary_path, self.cache_path)
+        # The journaled upserts are now part of the cache.
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_size = 0
+
+    def cache_reference(self, index, ref):
+        """Cache the upsert of the reference at this index.
+
+        The upsert is appended to a journal replayed by load_cache(). The whole
+        cache is rewritten if there is none or if the journal is full.
+        """
+        if not os.path.exists(self.cache_path) or self._journal_size >= self.JOURNAL_MAX_SIZE:
+            self.cache()
+        else:
+            with open(self.journal_path, "ab") as f:
+                pickle.dump((index, ref), f)
+            self._journal_size += 1
 
     def create_local_reference(self, ref):
         """Append the reference at the end of the reference list and cache it."""
-        self._references.append(ref)
-        self.cache()
+        index = self.reference_count()
+        self._upsert_reference(index, ref)
+        self.cache_reference(index, ref)
 
     def create_distant_reference(self, ref_data):
         """Validate and create the reference in Zotero and return the created item."""
@@ -80,8 +237,10 @@ class ZoteroWrap:
 
     def update_local_reference(self, index, ref):
         """Replace the reference in the reference list and cache it."""
-        self._references[index] = ref
-        self.cache()
+        # NB: Raise IndexError if there is no reference at this index.
+        index = range(self.reference_count())[index]
+        self._upsert_reference(index, ref)
+        self.cache_reference(index, ref)
 
     def update_distant_reference(self, ref):
         """Validate and update the reference in Zotero.
@@ -101,9 +260,17 @@ class ZoteroWrap:
         except InvalidItemFields as e:
             raise InvalidZoteroItemError from e
 
-    def get_references(self):
-        """Return all references in the Zotero database. Takes time..."""
-        return self._zotero_lib.everything(self._zotero_lib.top())
+    def get_references(self, since=None):
+        """Return all references in the Zotero database. Takes time...
+
+        If 'since' is a library version, return only the references modified after it.
+        """
+        query = self._zotero_lib.top() if since is None else self._zotero_lib.top(since=since)
+        return self._zotero_lib.everything(query)
+
+    def get_deleted_references(self, since):
+        """Return the keys of the references deleted after this library version."""
+        return self._zotero_lib.deleted(since=since).get("items", [])
 
     def get_reference_types(self):
         """Return the reference types.
@@ -114,17 +281,31 @@ class ZoteroWrap:
         return sorted([x["itemType"] for x in item_types])
 
     def get_reference_templates(self, ref_types):
-        """Return the reference templates for the types as an ordered dictionary."""
-        return OrderedDict([(x, self.get_reference_template(x)) for x in ref_types])
+        """Return the reference templates for the types as an ordered dictionary.
+
+        The templates are retrieved concurrently by at most TEMPLATE_WORKERS threads.
+        """
+        with ThreadPoolExecutor(max_workers=self.TEMPLATE_WORKERS) as executor:
+            templates = list(executor.map(self.get_reference_template, ref_types))
+        return OrderedDict(zip(ref_types, templates))
 
     def get_reference_template(self, ref_type):
         """Return the reference template for the type as an ordered dictionary.
 
         Zotero.item_template() caches data after the first API call.
         """
-        template = self._zotero_lib.item_template(ref_type)
+        # NB: A Zotero instance stores its last request, so it can't be shared
+        # between threads. Its copies share the cached templates.
+        template = copy(self._zotero_lib).item_template(ref_type)
         return OrderedDict(sorted(template.items(), key=lambda x: x[0]))
 
+    def get_schema_version(self):
+        """Return the Zotero schema version of the last API response, otherwise None."""
+        request = getattr(self._zotero_lib, "request", None)
+        if request is None:
+            return None
+        return request.headers.get("Zotero-Schema-Version")
+
     def get_reference(self, ref_key):
         """Return the reference for the key."""
         return self._zotero_lib.item(ref_key)
@@ -241,18 +422,101 @@ class ZoteroWrap:
 
     # Public methods section.
 
+    def _reference_row(self, index):
+        """Return the derived fields of the reference, ordered as REFERENCE_COLUMNS."""
+        getters = [self.reference_key, self.reference_id, self.reference_type,
+                   self.reference_title, self.reference_creator_surnames_str,
+                   self.reference_year, self.reference_journal, self._creators_citation]
+        row = []
+        for getter in getters:
+            # NB: Notes and attachments don't have all the fields.
+            try:
+                row.append(getter(index))
+            except (KeyError, IndexError):
+                row.append("")
+        return row
+
+    def _index_references(self):
+        """Update the map from the reference IDs to the indexes of the references.
+
+        The derived fields of the references are materialized at the same time.
+        Only the references not indexed yet or invalidated are processed, unless
+        the reference list has been replaced or shortened since the last update.
+        """
+        if (self._modified_indexes is None
+                or self._indexed_references is not self._references
+                or self._indexed_count > len(self._references)):
+            self._reference_indexes = {}
+            self._reference_columns = {x: [] for x in self.REFERENCE_COLUMNS}
+            self._indexed_references = self._references
+            self._indexed_count = 0
+            self._modified_indexes = set()
+        for index in sorted(self._modified_indexes):
+            if index < self._indexed_count:
+                self._reindex_reference(index)
+        self._modified_indexes = set()
+        for index in range(self._indexed_count, len(self._references)):
+            row = self._reference_row(index)
+            for column, value in zip(self.REFERENCE_COLUMNS, row):
+                self._reference_columns[column].append(value)
+            self._reference_indexes.setdefault(self._reference_columns["id"][index], []).append(index)
+        self._indexed_count = len(self._references)
+
+    def _upsert_reference(self, index, ref):
+        """Replace the reference at this index, or append it if the index is the reference count."""
+        self._index_references()
+        if index == len(self._references):
+            self._references.append(ref)
+            self._index_references()
+            return
+        self._references[index] = ref
+        self._reindex_reference(index)
+
+    def _reindex_reference(self, index):
+        """Update the derived fields and the ID index of an indexed reference."""
+        old_id = self._reference_columns["id"][index]
+        old_indexes = self._reference_indexes[old_id]
+        old_indexes.remove(index)
+        if not old_indexes:
+            del self._reference_indexes[old_id]
+        row = self._reference_row(index)
+        for column, value in zip(self.REFERENCE_COLUMNS, row):
+            self._reference_columns[column][index] = value
+        insort(self._reference_indexes.setdefault(self._reference_columns["id"][index], []), index)
+
+    def invalidate_references(self, index=None):
+        """Declare that the reference at this index (all if None) has been modified in place.
+
+        The references modified other than with create_local_reference() or
+        update_local_reference(), e.g. through reference_data(), must be declared
+        for their derived fields and ID to be updated on the next lookup.
+        """
+        if index is None:
+            self._modified_indexes = None
+        elif self._modified_indexes is not None:
+            # NB: Raise IndexError if there is no reference at this index.
+            self._modified_indexes.add(range(self.reference_count())[index])
+
+    def reference_table(self):
+        """Return the derived fields of all the references as a DataFrame."""
+        self._index_references()
+        return pd.DataFrame(self._reference_columns, columns=self.REFERENCE_COLUMNS)
+
     def reference_index(self, ref_id):
         """Return the first reference with this ID."""
+        self._index_references()
         try:
-            indexes = range(self.reference_count())
-            return next(i for i in indexes if self.reference_id(i) == ref_id)
-        except StopIteration as e:
+            return self._reference_indexes[ref_id][0]
+        except KeyError as e:
             raise ReferenceNotFoundError("ID: " + ref_id) from e
 
     def reference_creators_citation(self, ref_id):
         """Return for citation the creator surnames (locally defined) and the publication year."""
-        # FIXME Delayed refactoring. Use an index instead of an ID.
         index = self.reference_index(ref_id)
+        return self._reference_columns["citation"][index]
+
+    def _creators_citation(self, index):
+        """Return for citation the creator surnames and the publication year of the reference."""
         creators = self.reference_creator_surnames(index)
         creator_count = len(creators)
         if creator_count == 0:
@@ -265,6 +529,10 @@ class ZoteroWrap:
         else:
             return "{} et al. ({})".format(creators[0], year)
 
+    def citations(self, ref_ids):
+        """Return as a list the reference_creators_citation() of each ID."""
+        return [self.reference_creators_citation(x) for x in ref_ids]
+
 
 class CreateZoteroItemError(Exception):
     """Raise if Zotero.create_items() fails."""
@@ -45,6 +45,7 @@ setup(
     ],
     extras_require={
         "test": ["pytest", "pytest-cov", "pytest-lazy-fixture", "pytest-mock"],
+        "server": ["flask", "gunicorn"],
     },
     package_data={
         "nat": ["data/*.csv"],
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nat.aggregators import SampleAggregator, sampleDispersion
+from nat.values import ValuesSimple, ValuesCompound
+
+
+TYPE_ID = "BBP-001001"  # time
+PARAM_NAME = "time"
+
+
+def compound(**stats):
+    """Return a ValuesCompound of single values, e.g., compound(mean=2, N=10)."""
+    return ValuesCompound([ValuesSimple([value], "ms" if stat != "N" else "dimensionless", stat)
+                           for stat, value in stats.items()])
+
+
+def param(paramId, values):
+    return SimpleNamespace(id=paramId, typeId=TYPE_ID,
+                           description=SimpleNamespace(depVar=SimpleNamespace(values=values)))
+
+
+def sample(rows):
+    """Return a sample with the valid rows (paramId, values, species)."""
+    params = [param(paramId, values) for paramId, values, species in rows]
+    df = pd.DataFrame({"obj_parameter": params,
+                       "Values": [values.centralTendancy("within")[0] for _, values, _ in rows],
+                       "Species": [species for _, _, species in rows]})
+    return SimpleNamespace(validSample=df)
+
+
+MEAN_N = [("p1", compound(mean=1.0, N=10), "rat"),
+          ("p2", compound(mean=3.0, N=30), "rat"),
+          ("p3", compound(mean=10.0, N=5), "mouse")]
+
+MEAN_SD = [("p1", compound(mean=1.0, sd=2.0, N=4), "rat"),
+           ("p2", compound(mean=3.0, sd=2.0, N=16), "rat")]
+
+MEAN_SEM = [("p1", compound(mean=1.0, sem=1.0, N=4), "rat"),
+            ("p2", compound(mean=4.0, sem=0.5, N=16), "rat"),
+            ("p3", compound(mean=5.0, N=8), "rat")]
+
+
+def aggregate(rows, method, groupingFactors=None, **methodOptions):
+    aggregator = SampleAggregator(paramName=PARAM_NAME, groupingFactors=groupingFactors,
+                                  method=method, methodOptions=methodOptions)
+    aggregator.aggregate(sample(rows))
+    return aggregator
+
+
+def test_dispersion_mean_n_only():
+    N, sem = sampleDispersion(param("p1", compound(mean=1.0, N=10)))
+    assert N == 10 and np.isnan(sem)
+
+
+def test_dispersion_sd():
+    assert sampleDispersion(param("p1", compound(mean=1.0, sd=2.0, N=4))) == (4, 1.0)
+
+
+def test_mean():
+    assert aggregate(MEAN_N, "mean").values() == {(): pytest.approx(14/3)}
+
+
+def test_mean_grouped():
+    assert aggregate(MEAN_N, "mean", ["Species"]).values() == {"rat": 2.0, "mouse": 10.0}
+
+
+def test_n_weighted_mean_without_dispersion():
+    aggregator = aggregate(MEAN_N, "n_weighted_mean")
+    assert aggregator.values() == {(): pytest.approx((10 + 90 + 50)/45)}
+    assert aggregator.stats()[()]["N"] == 45
+
+
+def test_n_weighted_mean_grouped():
+    values = aggregate(MEAN_N, "n_weighted_mean", ["Species"]).values()
+    assert values == {"rat": pytest.approx(2.5), "mouse": pytest.approx(10.0)}
+
+
+def test_inverse_variance_mean_sd():
+    # SEMs of 1.0 and 0.5.
+    aggregator = aggregate(MEAN_SD, "inverse_variance_mean")
+    assert aggregator.values()[()] == pytest.approx((1 + 4*3)/5)
+    assert aggregator.stats()[()]["sem"] == pytest.approx(np.sqrt(1/5))
+
+
+def test_inverse_variance_mean_ignores_missing_sem():
+    aggregator = aggregate(MEAN_SEM, "inverse_variance_mean")
+    assert aggregator.values()[()] == pytest.approx((1 + 4*4)/5)
+    assert aggregator.aggreatedLst[0].ids == ("p1", "p2")
+
+
+def test_inverse_variance_mean_grouped():
+    values = aggregate(MEAN_SEM + [("p4", compound(mean=7.0, sem=1.0, N=3), "cat")],
+                       "inverse_variance_mean", ["Species"]).values()
+    assert values == {"rat": pytest.approx(17/5), "cat": pytest.approx(7.0)}
+
+
+def test_inverse_variance_mean_without_sem():
+    assert np.isnan(aggregate(MEAN_N, "inverse_variance_mean").values()[()])
+
+
+def test_bootstrap():
+    aggregator = aggregate(MEAN_N, "bootstrap", nbResamples=200, seed=1)
+    stats = aggregator.stats()[()]
+    assert aggregator.values()[()] == pytest.approx(14/3)
+    assert stats["ci_low"] <= 14/3 <= stats["ci_high"]
+    assert aggregate(MEAN_N, "bootstrap", nbResamples=200, seed=1).stats()[()] == stats
+
+
+def test_bootstrap_weighted_grouped():
+    aggregator = aggregate(MEAN_SD + MEAN_N, "bootstrap", ["Species"], 
+                           nbResamples=200, weighted=True)
+    assert aggregator.values()["mouse"] == pytest.approx(10.0)
+    assert aggregator.stats()["mouse"]["ci_low"] == pytest.approx(10.0)
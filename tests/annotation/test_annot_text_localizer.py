@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+from nat.annotTextLocalizer import unescapeAnnotationText, relocalizePaper
+
+
+PAPER_TEXT = ("Recordings were made in slices. The dendrites were 25 µm wide\n"
+              "at 34 °C, and the spines were\ncounted on each branch.")
+
+
+def escape(text):
+    """Escape a text as Annotation.text does."""
+    return text.encode("ascii", "backslashreplace").decode("ascii").replace("\n", "\\n")
+
+
+def test_unescape_non_ascii():
+    assert unescapeAnnotationText(escape("25 µm wide")) == "25 µm wide"
+
+
+def test_unescape_multi_line():
+    assert unescapeAnnotationText(escape("spines were\ncounted")) == "spines were\ncounted"
+
+
+def test_unescape_keeps_literal_backslashes():
+    for text in [r"\alpha band", r"C:\xfiles", r"\N-type", "25 µm \\ 34 °C"]:
+        assert unescapeAnnotationText(escape(text)) == text
+
+
+def test_unescape_invalid_code_point():
+    with pytest.raises(ValueError):
+        unescapeAnnotationText(r"\UFFFFFFFF")
+
+
+def test_relocalize_non_ascii(tmpdir):
+    txt = tmpdir.join("paper.txt")
+    txt.write_text(PAPER_TEXT, encoding="utf-8")
+    start = PAPER_TEXT.index("25 µm")
+    text = unescapeAnnotationText(escape("25 µm wide"))
+    assert relocalizePaper(str(txt), [("a1", text, start)]) == [("a1", start)]
+
+
+def test_relocalize_multi_line(tmpdir):
+    txt = tmpdir.join("paper.txt")
+    txt.write_text(PAPER_TEXT, encoding="utf-8")
+    start = PAPER_TEXT.index("spines were")
+    text = unescapeAnnotationText(escape("spines were\ncounted"))
+    assert relocalizePaper(str(txt), [("a1", text, start)]) == [("a1", start)]
+
+
+def test_relocalize_annotations_unchanged(tmpdir):
+    """The annotations at their true offsets are not moved."""
+    from nat import annotation
+    from nat.annotTextLocalizer import relocalizeAnnotations
+    tmpdir.join("PMID_1.txt").write_text(PAPER_TEXT, encoding="utf-8")
+    annotations = [SimpleNamespace(ID=str(no), pubId="PMID_1",
+                                   localizer=annotation.TextLocalizer(escape(text), PAPER_TEXT.index(text)))
+                   for no, text in enumerate(["25 µm wide\nat 34 °C", "spines were\ncounted"])]
+    assert relocalizeAnnotations(annotations, str(tmpdir), nbProcesses=1, update=True) == {}
+
+
+def test_relocalize_annotations_undecodable(tmpdir):
+    """The annotations whose text cannot be decoded are skipped."""
+    from nat import annotation
+    from nat.annotTextLocalizer import relocalizeAnnotations
+    tmpdir.join("PMID_1.txt").write_text(PAPER_TEXT, encoding="utf-8")
+    annotations = [SimpleNamespace(ID="0", pubId="PMID_1", localizer=annotation.TextLocalizer(r"\UFFFFFFFF", 3)),
+                   SimpleNamespace(ID="1", pubId="PMID_1", localizer=annotation.TextLocalizer("slices", 0))]
+    with pytest.warns(UserWarning):
+        changes = relocalizeAnnotations(annotations, str(tmpdir), nbProcesses=1)
+    assert changes == {"1": (0, PAPER_TEXT.index("slices"))}
@@ -0,0 +1,73 @@
+import os
+
+from nat import contextCache
+from nat.contextCache import ContextCache, fetchText
+
+
+class FakeClient:
+    """Server returning its text with a version, or 304 if not modified."""
+
+    def __init__(self, text, version):
+        self.text = text
+        self.version = version
+        self.requests = []
+
+    def getText(self, paperId, version=None):
+        self.requests.append(version)
+        if version == self.version:
+            return None, version
+        return self.text, self.version
+
+
+def test_fetch_text_revalidates_expired_text(tmpdir):
+    cache = ContextCache(str(tmpdir.join("cache.sqlite")), expiry=3600)
+    client = FakeClient("old text", "v1")
+    assert fetchText(client, "PMID_1", cache) == ("old text", "v1")
+    assert fetchText(client, "PMID_1", cache) == ("old text", "v1")
+    assert client.requests == [None]
+
+    cache.expiry = 0
+    assert fetchText(client, "PMID_1", cache) == ("old text", "v1")
+    client.text, client.version = "new text", "v2"
+    assert fetchText(client, "PMID_1", cache) == ("new text", "v2")
+    assert client.requests == [None, "v1", "v1"]
+
+
+def test_expired_contexts_are_not_returned(tmpdir):
+    cache = ContextCache(str(tmpdir.join("cache.sqlite")), expiry=3600)
+    key = ("PMID_1", 10, 5, 20)
+    cache.addContexts([key], ["context"])
+    assert cache.getContexts([key]) == ["context"]
+    cache.expiry = 0
+    assert cache.getContexts([key]) == [None]
+
+
+def test_default_cache_is_lazy(tmpdir, monkeypatch):
+    path = str(tmpdir.join("nat", "cache.sqlite"))
+    monkeypatch.setattr(contextCache, "defaultCachePath", path)
+    assert not os.path.exists(path)
+    assert contextCache.getDefaultCache().pathCache == path
+    assert os.path.exists(path)
+
+
+def test_default_cache_unusable(tmpdir, monkeypatch, recwarn):
+    # A file where the cache directory should be, as with a read-only home.
+    tmpdir.join("nat").write("")
+    monkeypatch.setattr(contextCache, "defaultCachePath", str(tmpdir.join("nat", "cache.sqlite")))
+    assert contextCache.getDefaultCache() is None
+    assert len(recwarn)
+
+
+def test_eviction_in_batches(tmpdir):
+    cache = ContextCache(str(tmpdir.join("cache.sqlite")), maxSize=100)
+    keys = [("PMID_1", start, 5, 20) for start in range(10)]
+    for key in keys:
+        cache.addContexts([key], ["x"*10])
+    assert cache.size() == 100
+
+    # Exceeding maxSize evicts the least recently used contexts down to 90.
+    cache.getContexts(keys[:1])
+    cache.addText("PMID_2", "y"*10, "v1")
+    assert cache.size() == 90
+    assert cache.getContexts(keys[:3]) == ["x"*10, None, None]
+    assert cache.getText("PMID_2")[0] == "y"*10
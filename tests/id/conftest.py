@@ -0,0 +1,39 @@
+from pytest import fixture
+
+from nat.id import MetadataResolver, Id2FileName
+from tests.id.data import (ESUMMARY, IDCONV, CROSSREF, HANDLE, DOI_1)
+
+
+class RecordedResponses:
+    """Replay the recorded responses and record the requested URLs."""
+
+    def __init__(self):
+        self.urls = []
+
+    def __call__(self, url):
+        self.urls.append(url)
+        if "esummary.fcgi" in url:
+            ids = url.split("id=")[1].split(",")
+            result = {key: value for key, value in ESUMMARY["result"].items() if key in ids}
+            result["uids"] = [uid for uid in ids if uid in result]
+            return {"header": ESUMMARY["header"], "result": result}
+        if "idconv" in url:
+            ids = url.split("ids=")[1].split(",")
+            return dict(IDCONV, records=[record for record in IDCONV["records"] if record["pmid"] in ids])
+        if url.endswith("/works/" + Id2FileName(DOI_1)):
+            return CROSSREF
+        if url.endswith("/handles/" + Id2FileName(DOI_1)):
+            return HANDLE
+        return None
+
+
+@fixture
+def recorded():
+    return RecordedResponses()
+
+
+@fixture
+def resolver(recorded, tmpdir):
+    """Return a resolver replaying the recorded responses with a cache."""
+    return MetadataResolver(str(tmpdir.join("cache.sqlite")), maxRequestsPerSecond=1000,
+                            fetch=recorded)
@@ -0,0 +1,64 @@
+# Responses recorded from the E-utilities, PMC ID converter, Crossref and
+# DOI handle APIs (trimmed to the fields used), keyed by request URL suffix.
+
+
+PMID_1 = "3309260"
+PMID_2 = "26601117"
+PMID_UNKNOWN = "3303249260"
+DOI_1 = "10.1126/science.1207502"
+DOI_UNKNOWN = "10.9999/unknown"
+
+
+ESUMMARY = {
+    "header": {"type": "esummary", "version": "0.3"},
+    "result": {
+        "uids": [PMID_1, PMID_2],
+        PMID_1: {
+            "uid": PMID_1,
+            "pubdate": "1987 Dec",
+            "title": "Dendritic spines of CA 1 pyramidal cells in the rat hippocampus.",
+            "fulljournalname": "The Journal of comparative neurology",
+            "volume": "266",
+            "issue": "4",
+            "authors": [{"name": "Harris KM", "authtype": "Author"},
+                        {"name": "Stevens JK", "authtype": "Author"}],
+        },
+        PMID_2: {
+            "uid": PMID_2,
+            "pubdate": "2015 Nov 25",
+            "title": "Cell type-specific synaptic dynamics.",
+            "fulljournalname": "eLife",
+            "volume": "4",
+            "issue": "",
+            "authors": [{"name": "Doe J", "authtype": "Author"},
+                        {"name": "Consortium X", "authtype": "CollectiveName"}],
+        },
+        PMID_UNKNOWN: {"uid": PMID_UNKNOWN, "error": "cannot get document summary"},
+    },
+}
+
+IDCONV = {
+    "status": "ok",
+    "responseDate": "2018-06-01 10:00:00",
+    "records": [
+        {"pmcid": "PMC000001", "pmid": PMID_1, "doi": "10.1002/cne.902660405"},
+        {"pmid": PMID_2},
+        {"pmid": PMID_UNKNOWN, "live": "false", "status": "error", "errmsg": "invalid article id"},
+    ],
+}
+
+CROSSREF = {
+    "status": "ok",
+    "message-type": "work",
+    "message": {
+        "DOI": DOI_1,
+        "title": ["Dopamine neurons projecting to the posterior striatum."],
+        "container-title": ["Science"],
+        "issued": {"date-parts": [[2011, 8, 19]]},
+        "volume": "333",
+        "author": [{"given": "Jane", "family": "Doe"},
+                   {"given": "John", "family": "Smith"}],
+    },
+}
+
+HANDLE = {"responseCode": 1, "handle": DOI_1}
@@ -0,0 +1,129 @@
+import copy
+import time
+import urllib.error
+
+import pytest
+
+from nat import id as natId
+from nat.id import MetadataResolver, parseCrossrefWork
+from tests.id.data import PMID_1, PMID_2, PMID_UNKNOWN, DOI_1, DOI_UNKNOWN, CROSSREF
+
+
+class TestMetadataResolver:
+
+    # pmidInfos
+
+    def test_pmid_infos_batched(self, resolver, recorded):
+        """The PMIDs are sent in a single request."""
+        infos = resolver.pmidInfos([PMID_1, PMID_2, PMID_UNKNOWN])
+        assert len(recorded.urls) == 1
+        assert infos[PMID_1] == {"authors": "Harris KM; Stevens JK",
+                                 "journal": "The Journal of comparative neurology",
+                                 "year": "1987", "issue": "4", "volume": "266",
+                                 "title": "Dendritic spines of CA 1 pyramidal cells in the rat hippocampus."}
+        assert infos[PMID_2]["authors"] == "Doe J"
+        assert infos[PMID_UNKNOWN] is None
+
+    def test_pmid_infos_batch_size(self, resolver, recorded):
+        resolver.batchSize = 2
+        resolver.pmidInfos([PMID_1, PMID_2, PMID_UNKNOWN])
+        assert len(recorded.urls) == 2
+
+    def test_pmid_infos_cached(self, resolver, recorded):
+        """The results, including the PMIDs not found, are cached."""
+        first = resolver.pmidInfos([PMID_1, PMID_UNKNOWN])
+        assert resolver.pmidInfos([PMID_UNKNOWN, PMID_1]) == first
+        assert len(recorded.urls) == 1
+        resolver.pmidInfos([PMID_1, PMID_2])
+        assert recorded.urls[-1].endswith("id=" + PMID_2)
+
+    def test_pmid_infos_cache_persistent(self, resolver, recorded):
+        resolver.pmidInfos([PMID_1])
+        other = MetadataResolver(resolver.cachePath, fetch=recorded)
+        assert other.pmidInfos([PMID_1])[PMID_1]["year"] == "1987"
+        assert len(recorded.urls) == 1
+
+    def test_pmid_infos_expired(self, resolver, recorded):
+        resolver.pmidInfos([PMID_1])
+        resolver.expiry = 0
+        time.sleep(0.01)
+        resolver.pmidInfos([PMID_1])
+        assert len(recorded.urls) == 2
+
+    def test_pmid_infos_error_not_cached(self, resolver, recorded):
+        def failing(url):
+            raise urllib.error.URLError("offline")
+        resolver.fetch = failing
+        assert resolver.pmidInfos([PMID_1]) == {PMID_1: None}
+        resolver.fetch = recorded
+        assert resolver.pmidInfos([PMID_1])[PMID_1] is not None
+
+    def test_pmid_infos_incomplete_record(self, resolver, recorded):
+        """A record that cannot be parsed only leaves its PMID unresolved."""
+        def incomplete(url):
+            response = copy.deepcopy(recorded(url))
+            del response["result"][PMID_2]["title"]
+            return response
+        resolver.fetch = incomplete
+        infos = resolver.pmidInfos([PMID_1, PMID_2])
+        assert infos[PMID_1]["year"] == "1987"
+        assert infos[PMID_2] is None
+        resolver.fetch = recorded
+        assert resolver.pmidInfos([PMID_2])[PMID_2]["authors"] == "Doe J"
+
+    def test_misses_expire_sooner(self, resolver, recorded):
+        resolver.pmidInfos([PMID_1, PMID_UNKNOWN])
+        resolver.missExpiry = 0
+        time.sleep(0.01)
+        resolver.pmidInfos([PMID_1, PMID_UNKNOWN])
+        assert recorded.urls[-1].endswith("id=" + PMID_UNKNOWN)
+
+    # pmidIDs
+
+    def test_pmid_ids(self, resolver):
+        assert resolver.pmidIDs([PMID_1, PMID_2, PMID_UNKNOWN]) == {
+            PMID_1: "10.1002/cne.902660405", PMID_2: "PMID_" + PMID_2, PMID_UNKNOWN: None}
+
+    # doiInfos
+
+    def test_doi_infos(self, resolver, recorded):
+        infos = resolver.doiInfos([DOI_1, DOI_UNKNOWN])
+        assert infos[DOI_1] == {"authors": "Doe, Jane; Smith, John", "journal": "Science",
+                                "year": 2011, "title": "Dopamine neurons projecting to the posterior striatum.",
+                                "issue": "", "volume": "333"}
+        assert infos[DOI_UNKNOWN] is None
+        resolver.doiInfos([DOI_1, DOI_UNKNOWN])
+        assert len(recorded.urls) == 2
+
+    def test_doi_infos_rate_limited(self, recorded):
+        resolver = MetadataResolver(maxRequestsPerSecond=20, fetch=recorded)
+        start = time.time()
+        resolver.doiInfos(["10.1/" + str(no) for no in range(5)])
+        assert time.time() - start >= 4/20
+
+    def test_doi_infos_author_without_given_name(self):
+        work = copy.deepcopy(CROSSREF["message"])
+        work["author"].append({"name": "Consortium X"})
+        work["author"].append({"family": "Lee"})
+        assert parseCrossrefWork(work)["authors"] == "Doe, Jane; Smith, John; Consortium X; Lee"
+
+    def test_check_dois(self, resolver):
+        assert resolver.checkDOIs([DOI_1, DOI_UNKNOWN]) == {DOI_1: True, DOI_UNKNOWN: False}
+
+    def test_check_offline_raises(self, resolver, monkeypatch):
+        def failing(url):
+            raise urllib.error.URLError("offline")
+        resolver.fetch = failing
+        assert resolver.checkDOIs([DOI_1]) == {DOI_1: None}
+        monkeypatch.setattr(natId, "getDefaultResolver", lambda: resolver)
+        with pytest.raises(urllib.error.URLError):
+            natId.checkDOI(DOI_1)
+        with pytest.raises(urllib.error.URLError):
+            natId.checkPMID("PMID_" + PMID_1)
+
+    # infos
+
+    def test_infos(self, resolver):
+        infos = resolver.infos(["PMID_" + PMID_1, DOI_1])
+        assert infos["PMID_" + PMID_1]["year"] == "1987"
+        assert infos[DOI_1]["year"] == 2011
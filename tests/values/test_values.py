@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from nat.values import ValuesSimple, ValuesCompound
+
+
+def compound(**stats):
+    """Return a ValuesCompound, e.g., compound(mean=[1, 2], N=[10, 20])."""
+    return ValuesCompound([ValuesSimple(values, "ms" if stat != "N" else "dimensionless", stat)
+                           for stat, values in stats.items()])
+
+
+def test_memoized_results_are_reused():
+    values = compound(min=[1.0, 2.0], max=[3.0, 6.0])
+    first = values.centralTendancy("within", returnStat=True)
+    assert first[1] == "mid-range"
+    np.testing.assert_array_equal(first[0], [2.0, 4.0])
+    assert values.centralTendancy("within", returnStat=True)[0] is first[0]
+    assert values.deviation("within") is values.deviation("within")
+
+
+def test_memoized_results_are_read_only():
+    values = compound(min=[1.0, 2.0], max=[3.0, 6.0])
+    with pytest.raises(ValueError):
+        values.centralTendancy("within")[0] = 0.0
+    with pytest.raises(ValueError):
+        values.deviation("within")[0] = 0.0
+    np.testing.assert_array_equal(values.centralTendancy("within"), [2.0, 4.0])
+    np.testing.assert_array_equal(values.deviation("within"), [2.0, 4.0])
+
+
+def test_stat_values_stay_writable():
+    """The read-only results do not lock the arrays of the ValuesSimple objects."""
+    values = compound(mean=[1.0, 2.0], N=[10, 20])
+    with pytest.raises(ValueError):
+        values.size("within")[0] = 0
+    values.centralTendancy("within")
+    values.valueLst[0].values[0] = 5.0
+    assert values.valueLst[0].values[0] == 5.0
+
+
+def test_valueLst_reassignment_invalidates():
+    values = compound(mean=[1.0, 2.0], sd=[0.5, 0.5])
+    np.testing.assert_array_equal(values.centralTendancy("within"), [1.0, 2.0])
+    assert values.deviation("within", returnStat=True)[1] == "sd"
+    assert values.text() == values.text()
+
+    values.valueLst = [ValuesSimple([4.0, 8.0], "ms", "median"), ValuesSimple([1.0, 1.0], "ms", "sem")]
+    assert values.centralTendancy("within", returnStat=True)[1] == "median"
+    np.testing.assert_array_equal(values.centralTendancy("within"), [4.0, 8.0])
+    assert values.deviation("within", returnStat=True)[1] == "sem"
+
+
+def test_applyTransform_invalidates():
+    values = compound(mean=[1.0, 2.0])
+    np.testing.assert_array_equal(values.centralTendancy("within"), [1.0, 2.0])
+    values.applyTransform(lambda value: value*10)
+    np.testing.assert_array_equal(values.centralTendancy("within"), [10.0, 20.0])
@@ -1,13 +1,15 @@
 __author__ = "Pierre-Alexandre Fonta"
 __maintainer__ = "Pierre-Alexandre Fonta"
 
+from collections import OrderedDict
 from copy import deepcopy
+from types import SimpleNamespace
 
 from pytest import fixture
 
 from nat import ZoteroWrap
 from tests.zotero.data import (REFERENCES, REFERENCE_TYPES, REFERENCE_TEMPLATES,
-                               ARTICLE_TEMPLATE, BOOK_TEMPLATE, ITEM_TYPES)
+                               ARTICLE_TEMPLATE, BOOK_TEMPLATE, ITEM_TYPES, ITEM_TEMPLATES)
 
 
 # Fixture for the data which might be changed during a test.
@@ -72,6 +74,66 @@ def shared_directory(tmpdir_factory):
     return str(tmpdir_factory.mktemp("zotero"))
 
 
+class ZoteroStandIn:
+    """Local stand-in for the versioned endpoints of a Zotero library.
+
+    Each modification or deletion increments the library version. The items
+    modified or deleted since a version can be retrieved as with PyZotero.
+    The responses have the header giving the Zotero schema version.
+    """
+
+    def __init__(self, references):
+        self.items = OrderedDict()
+        self.deletions = {}
+        self.version = 0
+        self.request = SimpleNamespace(headers={"Zotero-Schema-Version": "1"})
+        # Shared with the copies of the instance.
+        self.item_template_calls = []
+        for ref in references:
+            self.modify(ref)
+
+    def modify(self, ref):
+        """Create or replace the item with the key of the reference."""
+        self.version += 1
+        item = deepcopy(ref)
+        item["version"] = self.version
+        self.items[item["key"]] = item
+        return item
+
+    def delete(self, key):
+        """Delete the item with this key."""
+        self.version += 1
+        del self.items[key]
+        self.deletions[key] = self.version
+
+    def last_modified_version(self):
+        return self.version
+
+    def top(self, since=0):
+        return [deepcopy(x) for x in self.items.values() if x["version"] > since]
+
+    def everything(self, query):
+        return query
+
+    def deleted(self, since):
+        return {"items": [k for k, v in self.deletions.items() if v > since]}
+
+    def item_types(self):
+        return deepcopy(ITEM_TYPES)
+
+    def item_template(self, ref_type):
+        self.item_template_calls.append(ref_type)
+        return deepcopy(ITEM_TEMPLATES[REFERENCE_TYPES.index(ref_type)])
+
+
+@fixture
+def zotero_stand_in(references):
+    """Return a Zotero library stand-in holding references with distinct keys."""
+    for i, ref in enumerate(references):
+        ref["key"] = "KEY{}".format(i)
+    return ZoteroStandIn(references)
+
+
 # Fixtures for the ZoteroWrap instances.
 
 
@@ -91,6 +153,18 @@ def zw0(tmpdir):
     return ZoteroWrap(LIBRARY_ID, LIBRARY_TYPE, API_KEY, str(tmpdir))
 
 
+@fixture
+def zw_synchronized(tmpdir, zotero_stand_in):
+    """Return a ZoteroWrap instance synchronized with a Zotero library stand-in."""
+    zww = ZoteroWrap(LIBRARY_ID, LIBRARY_TYPE, API_KEY, str(tmpdir))
+    zww._zotero_lib = zotero_stand_in
+    zww._references = zww.get_references()
+    zww.library_version = zotero_stand_in.last_modified_version()
+    zww.update_reference_templates()
+    del zotero_stand_in.item_template_calls[:]
+    return zww
+
+
 @fixture
 def zw0_shared(shared_directory):
     """Return a non initialized ZoteroWrap instance with a shared temporary directory."""
@@ -2,6 +2,7 @@ __author__ = "Pierre-Alexandre Fonta"
 __maintainer__ = "Pierre-Alexandre Fonta"
 
 import os
+import pickle
 from copy import deepcopy
 
 import pyzotero
@@ -56,6 +57,13 @@ class TestZoteroWrap:
         # TODO Use assert_called_once() with Python 3.6+.
         nat.ZoteroWrap.load_distant.assert_called_once_with()
 
+    def test_initialize_synchronize(self, mocker, zw0):
+        """When there are data cached and a synchronization is requested."""
+        mocker.patch("nat.ZoteroWrap.load_cache")
+        mocker.patch("nat.ZoteroWrap.synchronize")
+        zw0.initialize(synchronize=True)
+        nat.ZoteroWrap.synchronize.assert_called_once_with()
+
     # cache
 
     def test_cache(self, zw0_shared, references, reference_types, reference_templates):
@@ -90,6 +98,66 @@ class TestZoteroWrap:
         assert zw0.reference_templates == REFERENCE_TEMPLATES
         assert os.path.getsize(zw0.cache_path) > 0
 
+    # synchronize
+
+    def test_synchronize_unchanged(self, zw_synchronized):
+        """When the distant library hasn't changed since the last synchronization."""
+        assert not zw_synchronized.synchronize()
+        assert not os.path.exists(zw_synchronized.cache_path)
+
+    def test_synchronize(self, zw_synchronized, zotero_stand_in, reference):
+        """When references have been modified, created, and deleted."""
+        references = deepcopy(zw_synchronized._references)
+        modified = deepcopy(references[2])
+        modified["data"]["DOI"] = DOI
+        modified = zotero_stand_in.modify(modified)
+        created = zotero_stand_in.modify(reference)
+        zotero_stand_in.delete(references[4]["key"])
+        assert zw_synchronized.synchronize()
+        expected = references[:2] + [modified] + references[3:4] + references[5:] + [created]
+        assert zw_synchronized._references == expected
+        assert zw_synchronized.library_version == zotero_stand_in.last_modified_version()
+        assert zw_synchronized.reference_index(DOI) == 2
+
+    def test_synchronize_cached(self, zw_synchronized, zotero_stand_in, zw0, reference):
+        """When the synchronized data are loaded back from the cache."""
+        zotero_stand_in.modify(reference)
+        zw_synchronized.synchronize()
+        zw0.load_cache()
+        assert zw0._references == zw_synchronized._references
+        assert zw0.library_version == zotero_stand_in.last_modified_version()
+
+    # update_reference_templates
+
+    def test_update_reference_templates(self, zw0, zotero_stand_in):
+        """When there are no reference templates cached."""
+        zw0._zotero_lib = zotero_stand_in
+        assert zw0.update_reference_templates()
+        assert zw0.reference_types == REFERENCE_TYPES
+        assert zw0.reference_templates == REFERENCE_TEMPLATES
+        assert zw0.schema_version == "1"
+        assert sorted(zotero_stand_in.item_template_calls) == REFERENCE_TYPES
+
+    def test_update_reference_templates_cached(self, zw_synchronized, zotero_stand_in):
+        """When the Zotero schema version hasn't changed."""
+        assert not zw_synchronized.update_reference_templates()
+        assert zw_synchronized.reference_templates == REFERENCE_TEMPLATES
+        assert zotero_stand_in.item_template_calls == []
+
+    def test_update_reference_templates_new_type(self, zw_synchronized, zotero_stand_in):
+        """When the Zotero schema version hasn't changed but there is a new type."""
+        del zw_synchronized.reference_templates["book"]
+        assert zw_synchronized.update_reference_templates()
+        assert zw_synchronized.reference_templates == REFERENCE_TEMPLATES
+        assert zotero_stand_in.item_template_calls == ["book"]
+
+    def test_update_reference_templates_schema_changed(self, zw_synchronized, zotero_stand_in):
+        """When the Zotero schema version has changed."""
+        zotero_stand_in.request.headers["Zotero-Schema-Version"] = "2"
+        assert zw_synchronized.update_reference_templates()
+        assert zw_synchronized.schema_version == "2"
+        assert sorted(zotero_stand_in.item_template_calls) == REFERENCE_TYPES
+
     # create_local_reference
 
     @mark.parametrize("zww", [
@@ -104,6 +172,36 @@ class TestZoteroWrap:
         assert zww._references[-1] == reference
         assert os.path.getsize(zww.cache_path) > 0
 
+    def test_create_local_reference_journaled(self, zw, zw0, reference):
+        """When the ZoteroWrap data have already been cached."""
+        zw.cache()
+        cache_size = os.path.getsize(zw.cache_path)
+        zw.create_local_reference(reference)
+        zw.update_local_reference(0, reference)
+        assert os.path.getsize(zw.cache_path) == cache_size
+        assert os.path.getsize(zw.journal_path) > 0
+        zw0.load_cache()
+        assert zw0._references == zw._references
+        assert zw0.reference_table().equals(zw.reference_table())
+
+    def test_load_cache_journal_invalid_index(self, zw, zw0, reference):
+        """When the journal has an upsert beyond the end of the reference list."""
+        zw.cache()
+        zw.create_local_reference(reference)
+        with open(zw.journal_path, "ab") as f:
+            pickle.dump((zw.reference_count() + 1, reference), f)
+        zw0.load_cache()
+        assert zw0._references == zw._references
+
+    def test_create_local_reference_journal_full(self, monkeypatch, zw, reference):
+        """When the journal has reached its maximal size."""
+        monkeypatch.setattr("nat.ZoteroWrap.JOURNAL_MAX_SIZE", 1)
+        zw.cache()
+        zw.create_local_reference(reference)
+        assert os.path.exists(zw.journal_path)
+        zw.create_local_reference(reference)
+        assert not os.path.exists(zw.journal_path)
+
     # create_distant_reference
 
     def test_create_distant_reference_successful(self, monkeypatch, zw0, reference):
@@ -463,6 +561,59 @@ class TestZoteroWrap:
         with raises(nat.zotero_wrap.ReferenceNotFoundError, match=exception_str):
             zw0.reference_index(DOI)
 
+    def test_reference_index_after_create(self, zw0):
+        """When the reference has been added with create_local_reference()."""
+        init(zw0, "extra", PMID_STR)
+        assert zw0.reference_index("PMID_" + PMID) == 0
+        ref = deepcopy(zw0._references[0])
+        ref["data"]["extra"] = UPID_STR
+        zw0.create_local_reference(ref)
+        assert zw0.reference_index("UNPUBLISHED_" + UPID) == 1
+
+    def test_reference_index_after_update(self, zw0):
+        """When the reference has been replaced with update_local_reference()."""
+        init(zw0, "extra", PMID_STR)
+        init(zw0, "DOI", DOI)
+        init(zw0, "extra", PMID_STR)
+        assert zw0.reference_index("PMID_" + PMID) == 0
+        ref = deepcopy(zw0._references[0])
+        ref["data"]["extra"] = UPID_STR
+        zw0.update_local_reference(0, ref)
+        assert zw0.reference_index("UNPUBLISHED_" + UPID) == 0
+        assert zw0.reference_index("PMID_" + PMID) == 2
+        assert zw0.reference_index(DOI) == 1
+
+    def test_reference_index_after_reset(self, zw0, references):
+        """When the reference list has been replaced."""
+        init(zw0, "DOI", DOI)
+        assert zw0.reference_index(DOI) == 0
+        zw0._references = []
+        with raises(nat.zotero_wrap.ReferenceNotFoundError):
+            zw0.reference_index(DOI)
+
+    def test_reference_index_after_invalidate(self, zw0):
+        """When a reference has been modified in place and declared with invalidate_references()."""
+        init(zw0, "extra", PMID_STR)
+        init(zw0, "DOI", DOI)
+        assert zw0.reference_index(DOI) == 1
+        zw0.reference_data(1)["DOI"] = ""
+        zw0.reference_data(1)["extra"] = UPID_STR
+        zw0.invalidate_references(1)
+        assert zw0.reference_index("UNPUBLISHED_" + UPID) == 1
+        assert list(zw0.reference_table()["id"]) == ["PMID_" + PMID, "UNPUBLISHED_" + UPID]
+        with raises(nat.zotero_wrap.ReferenceNotFoundError):
+            zw0.reference_index(DOI)
+
+    def test_reference_index_after_invalidate_all(self, zw0):
+        """When all the references have been declared modified."""
+        init(zw0, "extra", PMID_STR)
+        init(zw0, "extra", PMID_STR)
+        assert zw0.reference_index("PMID_" + PMID) == 0
+        zw0.reference_data(0)["extra"] = UPID_STR
+        zw0.invalidate_references()
+        assert zw0.reference_index("PMID_" + PMID) == 1
+        assert zw0.reference_index("UNPUBLISHED_" + UPID) == 0
+
     # reference_creators_citation
 
     @mark.parametrize("value, expected", [
@@ -494,3 +645,41 @@ class TestZoteroWrap:
         reference["data"]["date"] = ""
         reference["data"]["creators"] = value
         assert zw0.reference_creators_citation(DOI) == expected
+
+    # citations
+
+    def test_citations(self, zw0):
+        """When some reference IDs are repeated."""
+        reference = init(zw0, "DOI", DOI)
+        reference["data"]["date"] = DATE
+        reference["data"]["creators"] = CREATORS[:1]
+        reference = init(zw0, "extra", PMID_STR)
+        reference["data"]["date"] = DATE
+        reference["data"]["creators"] = CREATORS[:2]
+        ref_ids = [DOI, "PMID_" + PMID, DOI]
+        expected = ["AuthorLastA (2017)", "AuthorLastA and AuthorLast-B (2017)",
+                    "AuthorLastA (2017)"]
+        assert zw0.citations(ref_ids) == expected
+
+    def test_citations_not_found(self, zw0):
+        """When no reference in the reference list has one of the reference IDs."""
+        init(zw0, "DOI", DOI)
+        with raises(nat.zotero_wrap.ReferenceNotFoundError):
+            zw0.citations([DOI, "PMID_" + PMID])
+
+    # reference_table
+
+    def test_reference_table(self, zw0):
+        """Test ZoteroWrap.reference_table()."""
+        reference = init(zw0, "DOI", DOI)
+        reference["data"]["date"] = DATE
+        reference["data"]["creators"] = CREATORS[:2]
+        reference["data"]["publicationTitle"] = "Journal"
+        init(zw0, "extra", PMID_STR)
+        table = zw0.reference_table()
+        assert list(table.columns) == zw0.REFERENCE_COLUMNS
+        assert list(table["id"]) == [DOI, "PMID_" + PMID]
+        assert table.loc[0, "creators"] == "AuthorLastA, AuthorLast-B"
+        assert table.loc[0, "year"] == 2017
+        assert table.loc[0, "journal"] == "Journal"
+        assert table.loc[0, "citation"] == "AuthorLastA and AuthorLast-B (2017)"